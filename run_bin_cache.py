@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from tipp.cache import main
+
+# #########################################################################, a#
+#    Copyright 2014 Siavash Mirarab, Nam Nguyen, and Tandy Warnow.
+#    This file is part of SEPP.
+#
+#    SEPP is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    SEPP is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with SEPP.  If not, see <http://www.gnu.org/licenses/>.
+# ##########################################################################
+
+# MAIN
+if __name__ == '__main__':
+    main()
@@ -60,15 +60,17 @@ def profile(inputf, gene, output, prefix, threshold):
     sepp.config.set_main_config_path(tipp_config_path)
     opts = Namespace()
     sepp.config._read_config_file(open(tipp_config_path, 'r'), opts)
-    (taxon_map, level_map, key_map) = sepp.metagenomics.load_taxonomy(
+    taxonomy = tipp.metagenomics.load_taxonomy(
         "%s/%s.refpkg/all_taxon.taxonomy" % (opts.reference.path, gene))
-    gene_classification = sepp.metagenomics.generate_classification(
-        inputf, threshold)
-    sepp.metagenomics.remove_unclassified_level(gene_classification)
+    gene_classification = tipp.metagenomics.generate_classification(
+        inputf, threshold, taxonomy)
+    tipp.metagenomics.remove_unclassified_level(gene_classification,
+                                                taxonomy)
     tstr = str("%d" % (threshold * 100))
     cfile = str("%s/%s.classification_%s.txt" % (output, prefix, tstr))
-    sepp.metagenomics.write_classification(gene_classification, cfile)
-    sepp.metagenomics.write_abundance(gene_classification, output)
+    tipp.metagenomics.write_classification(gene_classification, cfile,
+                                           taxonomy)
+    tipp.metagenomics.write_abundance(gene_classification, output, taxonomy)
 
 
 def main():
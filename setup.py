@@ -197,9 +197,10 @@ setup(name="tipp",
       author_email="smirarab@gmail.com, namphuon@cs.utah.edu",
 
       license="General Public License (GPL)",
-      install_requires=["dendropy >= 4.0.0", "sepp"],
+      install_requires=["dendropy >= 4.0.0", "sepp", "numpy"],
       provides=["tipp"],
-      scripts=["run_abundance.py","run_tipp.py","run_tipp_tool.py"],
+      scripts=["run_abundance.py","run_tipp.py","run_tipp_tool.py",
+               "run_bin_cache.py", "run_compile_refpkg.py"],
       cmdclass={"tipp": ConfigTIPP},
       data_files=[('', ['home.path'])],
 
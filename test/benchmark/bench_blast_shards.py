@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+'''
+Benchmark of sharded BLAST binning: reports reads/second for a range of
+shard counts under a fixed core budget.
+
+Example:
+    python test/benchmark/bench_blast_shards.py -b `which blastn` \
+        -db $REFERENCE/markers-v3/blast/alignment.fasta.db \
+        -f reads.fastq.gz --cpu 64 --shards 1,2,4,8,16
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from tipp.reads import open_reads
+from tipp.binning import blast_sharded, shard_threads
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Reads/second of sharded blastn against shard count.')
+    parser.add_argument("-b", "--blastn", dest="blastn", required=True,
+                        help="blastn executable")
+    parser.add_argument("-db", "--database", dest="database", required=True,
+                        help="marker BLAST database")
+    parser.add_argument("-f", "--fragments", dest="fragments", required=True,
+                        help="reads (FASTA/FASTQ, plain or gzip'ed)")
+    parser.add_argument("--cpu", dest="cpu", type=int,
+                        default=os.cpu_count(),
+                        help="core budget [default: all cores]")
+    parser.add_argument("--shards", dest="shards", default="1,2,4,8",
+                        help="comma separated shard counts [default: "
+                             "%(default)s]")
+    parser.add_argument("--tempdir", dest="tempdir", default=None,
+                        help="where to write the BLAST outputs")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    reads = open_reads(args.fragments, args.cpu)
+    print("shards\tthreads\treads\tseconds\treads/s")
+    for requested in [int(s) for s in args.shards.split(',')]:
+        (shards, threads) = shard_threads(args.cpu, requested)
+        temp_dir = tempfile.mkdtemp(dir=args.tempdir)
+        outputs = ["%s/blast.%d.out" % (temp_dir, i) for i in range(shards)]
+        start = time.time()
+        count = blast_sharded(reads, args.blastn, args.database, outputs,
+                              threads)
+        elapsed = time.time() - start
+        shutil.rmtree(temp_dir)
+        print("%d\t%d\t%d\t%0.1f\t%0.1f" % (
+            shards, threads, count, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
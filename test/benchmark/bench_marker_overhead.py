@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+'''
+Benchmark of the per-marker overhead of abundance profiling: runs TIPP on
+one marker's fragments repeatedly, once as a run_tipp.py process per run
+(the default of run_abundance.py) and once in this process (--inProcess),
+and reports the mean seconds per run. With a handful of fragments the
+difference is the startup cost paid by every marker.
+
+Arguments after -- are passed to run_tipp.py, without -o/-d which are set
+per run. Example:
+    python test/benchmark/bench_marker_overhead.py -n 5 -- \
+        -c ~/.sepp/tipp.config -m dna -f few_reads.fas \
+        -t $REFPKG/pplacer.taxonomy.renamed.tree \
+        -adt $REFPKG/pplacer.taxonomy.renamed.tree \
+        -a $REFPKG/sate.fasta -r $REFPKG/sate.taxonomy.RAxML_info \
+        -tx $REFPKG/all_taxon.taxonomy -txm $REFPKG/species.mapping \
+        -at 0.95 -pt 0.0 -A 100 -P 1000
+'''
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+from tipp.exhaustive_tipp import run
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Seconds per marker of run_tipp.py processes against '
+                    'in-process TIPP runs.')
+    parser.add_argument("-n", "--runs", dest="runs", type=int, default=3,
+                        help="runs per mode [default: %(default)s]")
+    parser.add_argument("--tempdir", dest="tempdir", default=None,
+                        help="where to write the outputs")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+                        help="run_tipp.py arguments, after --")
+    args = parser.parse_args()
+    if args.args and args.args[0] == '--':
+        args.args = args.args[1:]
+    return args
+
+
+def subprocess_run(args):
+    subprocess.check_call(["run_tipp.py"] + args)
+
+
+def timed(runs, tipp_args, runner, tempdir):
+    elapsed = 0
+    for i in range(runs):
+        out_dir = tempfile.mkdtemp(dir=tempdir)
+        start = time.time()
+        runner(tipp_args + ["-o", "bench_%d" % i, "-d", out_dir])
+        elapsed += time.time() - start
+        shutil.rmtree(out_dir)
+    return elapsed / runs
+
+
+def main():
+    args = parse_args()
+    print("mode\truns\tseconds/marker")
+    for (mode, runner) in (("subprocess", subprocess_run),
+                           ("in-process", run)):
+        print("%s\t%d\t%0.2f" % (
+            mode, args.runs, timed(args.runs, args.args, runner,
+                                   args.tempdir)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+import numpy as np
+from tipp.taxonomy import Taxonomy
+from tipp.classification import ClassificationTable
+from tipp.abundance import lineage_clades, LevelCounts, DistributionCounts, \
+    UNCLASSIFIED, UNDEFINED
+from testTaxonomy import write_taxonomy
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        write_taxonomy(join(self.dir, "all_taxon.taxonomy"))
+        self.taxonomy = Taxonomy.from_csv(join(self.dir, "all_taxon.taxonomy"))
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, name, text):
+        with open(join(self.dir, name), 'w') as fp:
+            fp.write(text)
+        return ClassificationTable.read(join(self.dir, name), self.taxonomy)
+
+    def testLineageClades(self):
+        # Escherichia has no order: undefined there, not unclassified
+        genus = self.taxonomy.index(["561"])
+        clades = lineage_clades(self.taxonomy.lineages(genus))
+        assert clades[0, 0] == UNCLASSIFIED
+        assert clades[0, 1] == genus[0]
+        assert clades[0, 3] == UNDEFINED
+        # Nothing defined at any level
+        clades = lineage_clades(self.taxonomy.lineages([-1, 0]))
+        assert (clades == UNCLASSIFIED).all()
+
+    def testLevelCounts(self):
+        (species, genus, phylum) = self.taxonomy.index(
+            ["562", "561", "1224"]).tolist()
+        counts = LevelCounts(len(self.taxonomy), 6)
+        counts.add(self.taxonomy.lineages([species, genus]), [1, 3])
+        counts.add(self.taxonomy.lineages([phylum]))
+        assert counts.total == 5
+        (clades, abundances) = counts.abundance(0)
+        assert dict(zip(clades.tolist(), abundances.tolist())) == {
+            UNCLASSIFIED: 0.8, species: 0.2}
+        (clades, abundances) = counts.abundance(3)
+        assert dict(zip(clades.tolist(), abundances.tolist())) == {
+            UNCLASSIFIED: 0.2, UNDEFINED: 0.8}
+        # Only the clades with fragments are held, whatever the taxonomy size
+        counts = LevelCounts(1 << 40, 6)
+        counts.add(self.taxonomy.lineages([species, species, genus]))
+        assert len(counts.keys) == 7
+        (clades, abundances) = counts.abundance(1)
+        assert dict(zip(clades.tolist(), abundances.tolist())) == {
+            genus: 1.0}
+
+    def testDistributionCounts(self):
+        first = self.write("first.txt", (
+            "r1,1,root,root,1.0\n"
+            "r1,1224,Proteobacteria,phylum,1.0\n"
+            "r1,561,Escherichia,genus,0.75\n"
+            "r1,562,Escherichia coli,species,0.5\n"
+            "r1,9999,Unknown,species,0.25\n"))
+        # The last fragment of a file is not merged into the first of the
+        # next one, even with the same name
+        second = self.write("second.txt", (
+            "r1,1224,Proteobacteria,phylum,0.5\n"
+            "r2,1224,Proteobacteria,phylum,1.0\n"))
+        counts = DistributionCounts(6)
+        counts.add(first, {"r1": 2})
+        counts.add(second)
+        assert counts.total == 4
+        assert counts.clades[0] == {b"562": 1.0, b"9999": 0.5}
+        assert counts.clades[5] == {b"1224": 3.5}
+        assert np.allclose(counts.unclassified, [2.5, 2.5, 4, 4, 4, 0.5])
+
+        counts = DistributionCounts(6)
+        counts.add(first, cutoff=0.5)
+        assert counts.clades[0] == {b"562": 0.5}
+        assert counts.unclassified[0] == 0.5
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+'''
+Created on Oct 17, 2026
+'''
+import os
+import pickle
+import tempfile
+import unittest
+import numpy as np
+from tipp.assignment import assign_fragments, FragmentAssignment, \
+    AssignedFragments
+
+
+class Test(unittest.TestCase):
+    def assign(self, hits, threshold):
+        (fragment, subset, weight) = assign_fragments(
+            [f for (f, _, _) in hits], [s for (_, s, _) in hits],
+            [score for (_, _, score) in hits], threshold)
+        return list(zip(fragment.tolist(), subset.tolist(),
+                        np.round(weight, 6).tolist()))
+
+    def testAssign(self):
+        hits = [(1, 0, 10.0), (0, 2, 11.0), (0, 1, 12.0), (0, 0, 10.0),
+                (2, 1, 5.0)]
+        # Fragment 0 has probabilities 4/7, 2/7 and 1/7 over subsets 1, 2
+        # and 0
+        assert self.assign(hits, 0.5) == [
+            (0, 1, 1.0), (1, 0, 1.0), (2, 1, 1.0)]
+        assert self.assign(hits, 0.8) == [
+            (0, 1, round(4 / 6, 6)), (0, 2, round(2 / 6, 6)),
+            (1, 0, 1.0), (2, 1, 1.0)]
+        # The last subset of a fragment is never taken
+        assert self.assign(hits, 0.99) == self.assign(hits, 0.8)
+
+    def testTies(self):
+        # Equal probabilities are taken in hit order
+        hits = [(0, 3, 7.0), (0, 1, 7.0), (0, 2, 7.0)]
+        assert self.assign(hits, 0.5) == [(0, 3, 0.5), (0, 1, 0.5)]
+
+    def testLargeScores(self):
+        # Scores beyond the double range neither overflow nor underflow
+        hits = [(0, 0, 5000.0), (0, 1, 5000.0), (0, 2, 5000.0),
+                (1, 0, -2000.0), (1, 1, -2001.0), (1, 2, -3000.0)]
+        assert self.assign(hits, 0.5) == [
+            (0, 0, 0.5), (0, 1, 0.5), (1, 0, 1.0)]
+        assert self.assign(hits, 0.7) == [
+            (0, 0, 0.5), (0, 1, 0.5), (1, 0, round(2 / 3, 6)),
+            (1, 1, round(1 / 3, 6))]
+
+    def testEmpty(self):
+        assert self.assign([], 0.95) == []
+
+    def testFragmentAssignment(self):
+        store = {"a": "ACGT", "b": "GG", "c": "TTA"}
+        assignment = FragmentAssignment(
+            ["a", "b", "c"], [0, 0, 1, 2], [1, 0, 1, 1],
+            [0.75, 0.25, 1.0, 1.0], ["s0", "s1"])
+        views = [AssignedFragments(assignment, store, assignment.rows(i))
+                 for i in range(2)]
+        assert views[0].keys() == ["a_s0_250000"]
+        assert views[1].keys() == ["a_s1_750000", "b_s1_1000000",
+                                   "c_s1_1000000"]
+        assert views[1]["b_s1_1000000"] == "GG"
+        self.assertRaises(KeyError, views[1].__getitem__, "a_s0_250000")
+        assert assignment.resolve(["c_s1_1000000", "x"]).tolist() == [3, -1]
+
+        chunks = views[1].divide_to_equal_chunks(2)
+        assert [c.keys() for c in chunks] == [
+            ["a_s1_750000", "b_s1_1000000"], ["c_s1_1000000"]]
+        assert AssignedFragments(assignment, store, []).is_empty()
+
+        path = os.path.join(tempfile.mkdtemp(), "fragments.fasta")
+        chunks[0].write_to_path(path)
+        with open(path) as f:
+            assert f.read() == ">a_s1_750000\nACGT\n>b_s1_1000000\nGG\n"
+
+        # Copy names carry no weight unless weighted
+        unweighted = pickle.loads(pickle.dumps(FragmentAssignment(
+            ["a"], [0], [0], [0.5], ["s0"], weighted=False)))
+        assert unweighted.copy_names(unweighted.rows(0)) == ["a_s0_1000000"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,242 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+import os
+import stat
+import sys
+import time
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from tipp.reads import ReadStream
+from tipp.binning import FragmentBinner, stream_blast, parse_blast_hit, \
+    is_better_hit, blast_sharded, shard_threads, trim_bounds, BlastHitTable, \
+    bin_external, hash_names, BloomFilter
+import numpy as np
+
+# Reports two hits for every read whose name starts with "hit": a short one
+# on marker A, and a longer one on marker B in reverse orientation.
+FAKE_BLASTN = '''#!%s
+import sys
+out = sys.stdout
+if "-out" in sys.argv and sys.argv[sys.argv.index("-out") + 1] != "-":
+    out = open(sys.argv[sys.argv.index("-out") + 1], 'w')
+name = None
+for line in sys.stdin:
+    if line.startswith('>'):
+        name = line[1:].strip()
+    elif name.startswith('hit'):
+        qlen = len(line.strip())
+        out.write("%%s\\tsA\\t99\\t0\\t0\\t0\\t1\\t60\\t%%d"
+                  "\\t1\\t60\\t500\\t0\\t1\\n" %% (name, qlen))
+        out.write("%%s\\tsB\\t99\\t0\\t0\\t0\\t1\\t80\\t%%d"
+                  "\\t80\\t1\\t500\\t0\\t1\\n" %% (name, qlen))
+        out.flush()
+''' % sys.executable
+
+# Records its pid and never reads its input
+STUCK_BLASTN = '''#!%s
+import os
+import sys
+import time
+with open(sys.argv[sys.argv.index("-out") + 1] + ".pid", 'w') as fp:
+    fp.write(str(os.getpid()))
+time.sleep(60)
+''' % sys.executable
+
+MARKER_MAP = {"sA": "A", "sB": "B", "sC": "A"}
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.blastn = join(self.dir, "blastn")
+        with open(self.blastn, 'w') as fp:
+            fp.write(FAKE_BLASTN)
+        os.chmod(self.blastn, stat.S_IRWXU)
+        self.reads = join(self.dir, "reads.fas")
+        with open(self.reads, 'w') as fp:
+            for i in range(2000):
+                fp.write(">%s%d\n%s\n" % ("hit" if i % 3 else "miss", i,
+                                          "ACGT" * 25))
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testBestHit(self):
+        (_, short) = parse_blast_hit(
+            "r\tsA\t99\t0\t0\t0\t1\t60\t100\t1\t60\t500\t0\t1\n",
+            MARKER_MAP)
+        (_, long) = parse_blast_hit(
+            "r\tsB\t99\t0\t0\t0\t1\t80\t100\t80\t1\t500\t0\t1\n",
+            MARKER_MAP)
+        assert short["qcov"] == 60 and long["gene"] == "B"
+        assert is_better_hit(short, None, 50)
+        assert not is_better_hit(short, None, 70)
+        assert is_better_hit(long, short, 50)
+        assert not is_better_hit(short, long, 50)
+
+    def testStreamBlast(self):
+        binner = FragmentBinner(["A", "B"], self.dir)
+        with open(join(self.dir, "blast.out"), 'wb') as raw:
+            stream_blast(ReadStream(self.reads), [self.blastn],
+                         MARKER_MAP, 50, binner, raw)
+        binned = binner.close()
+        assert binned["A"]["nfrags"] == 0
+        assert binned["B"]["nfrags"] == 1333
+        fragments = list(ReadStream(binned["B"]["file"]))
+        assert fragments[0][0] == "hit1"
+        # Trimmed to the hit, then reverse complemented
+        assert fragments[0][1] == ("ACGT" * 20)[::-1].translate(
+            str.maketrans("ACGT", "TGCA"))
+        with open(join(self.dir, "blast.out")) as fp:
+            assert len(fp.readlines()) == 2 * 1333
+
+    def testShardThreads(self):
+        assert shard_threads(64, 8) == (8, 8)
+        assert shard_threads(64, 8, 4) == (8, 4)
+        assert shard_threads(64, 8, 16) == (8, 8)
+        assert shard_threads(4, 8) == (4, 1)
+        assert shard_threads(10, 3) == (3, 3)
+
+    def testBlastSharded(self):
+        outputs = [join(self.dir, "blast.%d.out" % i) for i in range(4)]
+        count = blast_sharded(ReadStream(self.reads), self.blastn, "db",
+                              outputs, 1)
+        assert count == 2000
+        names = []
+        for output in outputs:
+            with open(output) as fp:
+                shard = set(line.split('\t')[0] for line in fp)
+            assert shard
+            names.extend(shard)
+        assert len(names) == len(set(names)) == 1333
+
+    def testBlastShardedFailure(self):
+        outputs = [join(self.dir, "blast.%d.out" % i) for i in range(2)]
+
+        class FailingReads(ReadStream):
+            def batches(self):
+                yield [(b"hit0", b"ACGT")]
+                # Fails once every shard is running
+                while not all(os.path.exists(output + ".pid")
+                              for output in outputs):
+                    time.sleep(0.01)
+                raise ValueError("bad read")
+
+        with open(self.blastn, 'w') as fp:
+            fp.write(STUCK_BLASTN)
+        with self.assertRaises(ValueError):
+            blast_sharded(FailingReads(self.reads), self.blastn, "db",
+                          outputs, 1)
+        # Every shard has been stopped and reaped
+        for output in outputs:
+            with open(output + ".pid") as fp:
+                pid = int(fp.read())
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+    def testTrimBounds(self):
+        rng = np.random.RandomState(7)
+        qlen = rng.randint(50, 300, 1000)
+        qstart = rng.randint(1, 40, 1000)
+        qend = qlen - rng.randint(0, 40, 1000)
+        slen = rng.randint(300, 600, 1000)
+        sstart = rng.randint(1, 300, 1000)
+        send = sstart + rng.choice([-1, 1], 1000) * rng.randint(1, 200, 1000)
+        for trim in (True, False):
+            columns = trim_bounds(qstart, qend, qlen, sstart, send, slen,
+                                  trim)
+            for i in range(1000):
+                scalar = trim_bounds(int(qstart[i]), int(qend[i]),
+                                     int(qlen[i]), int(sstart[i]),
+                                     int(send[i]), int(slen[i]), trim)
+                assert tuple(int(c[i]) for c in columns) == scalar
+        # Hit covers 11..60 of a 100bp read and the marker ends at the hit
+        assert trim_bounds(11, 60, 100, 1, 50, 50) == (10, 70, 10, 60)
+        assert trim_bounds(11, 60, 100, 20, 69, 100) == (0, 100, 0, 100)
+
+    def testBlastHitTable(self):
+        output = join(self.dir, "blast.out")
+        line = "%s\t%s\t99\t0\t0\t0\t%d\t%d\t100\t1\t50\t500\t0\t1\n"
+        with open(output, 'w') as fp:
+            fp.write(line % ("q2", "sA", 1, 60))
+            fp.write(line % ("q2", "sB", 1, 80))
+            # Ties keep the first hit
+            fp.write(line % ("q2", "sC", 1, 80))
+            fp.write(line % ("q1", "sC", 1, 30))
+            fp.write(line % ("q3", "sA", 1, 70))
+            fp.write(line % ("q1", "sB", 1, 40))
+            fp.write(line % ("q3", "sC", 21, 90))
+        for chunk_size in (10, 100, 1 << 20):
+            table = BlastHitTable(MARKER_MAP).read([output], 45, chunk_size)
+            assert len(table) == 2
+            rows = table.lookup(np.array([b"q3", b"q1", b"q2", b"q22"]))
+            assert rows[1] == rows[3] == -1
+            assert table.hit(rows[2])["sseqid"] == "sB"
+            assert table.hit(rows[2])["gene"] == "B"
+            assert table.hit(rows[0])["sseqid"] == "sA"
+            assert table.hit(rows[0])["qcov"] == 70
+            assert table.genes[table.marker[rows[0]]] == "A"
+
+    def testAddBatch(self):
+        outputs = [join(self.dir, "blast.%d.out" % i) for i in range(3)]
+        blast_sharded(ReadStream(self.reads), self.blastn, "db", outputs, 1)
+        table = BlastHitTable(MARKER_MAP).read(outputs, 50)
+        assert len(table) == 1333
+        binner = FragmentBinner(["A", "B"], self.dir)
+        for batch in ReadStream(self.reads).batches():
+            binner.add_batch(batch, table)
+        binned = binner.close()
+        assert binned["B"]["nfrags"] == 1333
+        with open(binned["B"]["file"]) as fp:
+            batch_fragments = fp.read()
+
+        os.mkdir(join(self.dir, "single"))
+        binner = FragmentBinner(["A", "B"], join(self.dir, "single"))
+        for (header, seq) in ReadStream(self.reads):
+            row = table.lookup(np.array([header.encode()]))[0]
+            if row >= 0:
+                binner.add(header.encode(), seq.encode(), table.hit(row))
+        binned = binner.close()
+        with open(binned["B"]["file"]) as fp:
+            assert fp.read() == batch_fragments
+
+    def testHashNames(self):
+        names = np.array([b"read%d" % i for i in range(1000)])
+        hashes = hash_names(names)
+        assert len(set(hashes.tolist())) == 1000
+        assert (hash_names(names.astype('S40')) == hashes).all()
+        bloom = BloomFilter(500)
+        bloom.add(hashes[:500])
+        assert bloom.contains(hashes[:500]).all()
+        assert bloom.contains(hashes[500:]).mean() < 0.05
+        # Capped, a filter only lets more names through
+        bloom = BloomFilter(500, max_bits=2048)
+        assert bloom.size == 2048
+        bloom.add(hashes[:500])
+        assert bloom.contains(hashes[:500]).all()
+
+    def testBinExternal(self):
+        outputs = [join(self.dir, "blast.%d.out" % i) for i in range(2)]
+        blast_sharded(ReadStream(self.reads), self.blastn, "db", outputs, 1)
+        os.mkdir(join(self.dir, "memory"))
+        binner = FragmentBinner(["A", "B"], join(self.dir, "memory"))
+        table = BlastHitTable(MARKER_MAP).read(outputs, 50)
+        for batch in ReadStream(self.reads).batches():
+            binner.add_batch(batch, table)
+        expected = list(ReadStream(binner.close()["B"]["file"]))
+
+        binner = FragmentBinner(["A", "B"], self.dir)
+        bin_external(ReadStream(self.reads), outputs,
+                     BlastHitTable(MARKER_MAP), binner,
+                     join(self.dir, "partitions"), 5, 50, chunk_size=1000)
+        binned = binner.close()
+        assert binned["B"]["nfrags"] == 1333
+        assert sorted(ReadStream(binned["B"]["file"])) == sorted(expected)
+        assert os.listdir(join(self.dir, "partitions")) == []
+
+
+if __name__ == "__main__":
+    unittest.main()
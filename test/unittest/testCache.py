@@ -0,0 +1,82 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from tipp.cache import BinCache, file_stamp
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.input = join(self.dir, "reads.fas")
+        with open(self.input, 'w') as fp:
+            fp.write(">r1\nACGT\n")
+        self.refpkg = join(self.dir, "file-map-for-tipp.txt")
+        with open(self.refpkg, 'w') as fp:
+            fp.write("blast:database=blast/db\n")
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def binned(self, name, size):
+        path = join(self.dir, name)
+        with open(path, 'w') as fp:
+            fp.write("A" * size)
+        return {"g1": {"file": path, "nfrags": 2},
+                "g2": {"file": path + ".empty", "nfrags": 0}}
+
+    def testKey(self):
+        cache = BinCache(join(self.dir, "cache"), 1e9)
+        key = cache.key(self.input, self.refpkg, bin="blast", no_trim=False)
+        assert key == cache.key(self.input, self.refpkg, no_trim=False,
+                                bin="blast")
+        assert key != cache.key(self.input, self.refpkg, bin="blast",
+                                no_trim=True)
+        # The files of a batch of samples
+        batch = cache.key([self.input, self.refpkg], self.refpkg,
+                          bin="blast", no_trim=False)
+        assert batch != key
+        assert batch != cache.key([self.refpkg, self.input], self.refpkg,
+                                  bin="blast", no_trim=False)
+        with open(self.input, 'a') as fp:
+            fp.write(">r2\nACGT\n")
+        assert key != cache.key(self.input, self.refpkg, bin="blast",
+                                no_trim=False)
+
+    def testFileStamp(self):
+        stamp = file_stamp(self.input)
+        assert stamp == file_stamp(self.input)
+        with open(self.input, 'a') as fp:
+            fp.write(">r2\nACGT\n")
+        assert stamp != file_stamp(self.input)
+
+    def testUnwritable(self):
+        # run_abundance.py then goes on without a cache
+        self.assertRaises(OSError, BinCache, join(self.input, "cache"), 1e9)
+
+    def testPutGet(self):
+        cache = BinCache(join(self.dir, "cache"), 1e9)
+        assert cache.get("k1") is None
+        binned = cache.put("k1", self.binned("f1", 10), {"r1": 3})
+        assert list(binned.keys()) == ["g1"]
+        assert binned["g1"]["nfrags"] == 2
+        assert binned["g1"]["file"].startswith(cache.path)
+        assert cache.get("k1") == (binned, {"r1": 3})
+
+    def testEvict(self):
+        cache = BinCache(join(self.dir, "cache"), 2500)
+        cache.put("k1", self.binned("f1", 1000))
+        cache.put("k2", self.binned("f2", 1000))
+        os.utime(join(cache.path, "k1", "entry.json"), (0, 0))
+        cache.put("k3", self.binned("f3", 1000))
+        assert [e[0] for e in cache.entries()] == ["k2", "k3"]
+        cache.remove("k2")
+        assert cache.get("k2") is None
+
+
+if __name__ == "__main__":
+    unittest.main()
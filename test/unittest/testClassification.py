@@ -0,0 +1,108 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from tipp.taxonomy import Taxonomy
+from tipp.classification import ClassificationTable, ClassificationWriter
+from tipp.abundance import LevelCounts
+from testTaxonomy import write_taxonomy
+
+# r1 reaches species at 0.6, genus at 0.97; r2 has two genus placements, the
+# first highest one wins; r3 only has placements below any threshold but the
+# root; r4 is placed at a taxon outside the taxonomy
+CLASSIFICATION = '''\
+r1,1,root,root,1.0
+r1,1224,Proteobacteria,phylum,1.0
+r1,1236,Gammaproteobacteria,class,0.99
+r1,561,Escherichia,genus,0.97
+r1,562,Escherichia coli,species,0.6
+r2,562,Escherichia coli,species,0.3
+r2,543,Enterobacteriaceae,family,0.9
+r2,561,Escherichia,genus,0.7
+r2,561,Escherichia, with a comma,genus,0.7
+r2,2759,Eukaryota,superkingdom,0.99
+r3,1,root,root,1.0
+r3,1224,Proteobacteria,phylum,0.2
+r4,1,root,root,1.0
+r4,9999,Unknown,phylum,0.8
+'''
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        write_taxonomy(join(self.dir, "all_taxon.taxonomy"))
+        self.taxonomy = Taxonomy.from_csv(join(self.dir, "all_taxon.taxonomy"))
+        with open(join(self.dir, "classification.txt"), 'w') as fp:
+            fp.write(CLASSIFICATION)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testClassify(self):
+        table = ClassificationTable.read(join(self.dir, "classification.txt"),
+                                         self.taxonomy, block_size=64)
+        assert table.names.tolist() == ["r1", "r2", "r3", "r4"]
+        assert len(table.probability) == 14
+
+        def ids(threshold):
+            classifications = table.classifications(threshold)
+            return dict((name, self.taxonomy.tax_ids(taxon))
+                        for (name, taxon) in classifications.items())
+
+        assert ids(0.5) == {"r1": "562", "r2": "561", "r3": "1", "r4": "NA"}
+        assert ids(0.8) == {"r1": "561", "r2": "543", "r3": "1", "r4": "1"}
+        assert ids(0.95) == {"r1": "561", "r2": "1", "r3": "1", "r4": "1"}
+        assert ids(0.0)["r3"] == "1224"
+        # Of the two equal genus placements of r2, the first one is kept
+        assert (table.classify(0.5)[1] == table.taxon[7])
+
+    def testSplit(self):
+        table = ClassificationTable.read(join(self.dir, "classification.txt"),
+                                         self.taxonomy)
+        # r1 and r3 in group 2, r2 and r4 in group 0
+        tables = table.split([2, 0, 2, 0], names=["a", "b", "c", "d"])
+        assert [group for (group, _) in tables] == [0, 2]
+        (first, second) = (tables[0][1], tables[1][1])
+        assert first.names.tolist() == ["b", "d"]
+        assert second.names.tolist() == ["a", "c"]
+        assert len(first.probability) + len(second.probability) == 14
+        assert second.probability[:5].tolist() == [1.0, 1.0, 0.99, 0.97, 0.6]
+        assert self.taxonomy.tax_ids(first.classify(0.5)) == ["561", "NA"]
+        assert self.taxonomy.tax_ids(second.classify(0.5)) == ["562", "1"]
+
+    def testEmpty(self):
+        with open(join(self.dir, "classification.txt"), 'w') as fp:
+            fp.write("")
+        table = ClassificationTable.read(join(self.dir, "classification.txt"),
+                                         self.taxonomy)
+        assert table.classifications(0.5) == {}
+
+    def testWriter(self):
+        (species, genus, eukaryota) = self.taxonomy.index(
+            ["562", "561", "2759"]).tolist()
+        output = join(self.dir, "all.classification")
+        counts = LevelCounts(len(self.taxonomy), 6)
+        # Runs of two fragments spill to disk; the last classification of
+        # r2 wins, and r5 is left out, not being defined at the phylum level
+        writer = ClassificationWriter(output, self.taxonomy, self.dir,
+                                      run_size=2, level=6, counts=counts,
+                                      weights={"r1": 3})
+        writer.add(["r3", "r2", "r1"], [species, species, genus])
+        writer.add(["r2", "r5"], [genus, eukaryota])
+        writer.add(["r0"], [-1])
+        assert writer.close() == 3
+        with open(output) as fp:
+            lines = [line.split("\t") for line in fp.read().splitlines()]
+        assert [line[0] for line in lines] == ["fragment", "r1", "r2", "r3"]
+        assert lines[2][1:3] == ["NA", "561"]
+        assert counts.total == 5
+        (clades, abundances) = counts.abundance(1)
+        assert dict(zip(clades.tolist(), abundances.tolist())) == {genus: 1}
+
+
+if __name__ == "__main__":
+    unittest.main()
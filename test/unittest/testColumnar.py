@@ -0,0 +1,83 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+import numpy as np
+from tipp.taxonomy import Taxonomy
+from tipp.classification import ClassificationWriter
+from tipp.abundance import UNCLASSIFIED, UNDEFINED
+from tipp.columnar import ColumnWriter, load_columns, \
+    write_abundance_columns, abundance_matrix
+from testTaxonomy import write_taxonomy
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testColumns(self):
+        path = join(self.dir, "test.columns")
+        writer = ColumnWriter(path, "test", {"sample": "s1"})
+        writer.append("matrix", np.arange(6, dtype=np.int32).reshape(3, 2))
+        writer.append("matrix", np.arange(2, dtype=np.int32).reshape(1, 2))
+        writer.append_strings("names", ["a", "é"])
+        writer.append_strings("names", [""])
+        writer.append_strings("names", ["bc"])
+        writer.write("empty", np.array([], dtype=np.float32))
+        self.assertRaises(ValueError, writer.append, "matrix",
+                          np.arange(3, dtype=np.int32))
+        writer.close()
+
+        columns = load_columns(path)
+        assert columns.kind == "test"
+        assert columns.metadata == {"sample": "s1"}
+        assert isinstance(columns["matrix"], np.memmap)
+        assert columns["matrix"].tolist() == [[0, 1], [2, 3], [4, 5], [0, 1]]
+        assert columns.strings("names") == ["a", "é", "", "bc"]
+        assert columns.string("names", 3) == "bc"
+        assert len(columns["empty"]) == 0
+
+    def testAbundanceMatrix(self):
+        paths = [join(self.dir, "s%d.columns" % i) for i in range(2)]
+        write_abundance_columns(
+            paths[0], "abundance", ["species", "genus"],
+            [[0, UNCLASSIFIED], [1, UNDEFINED]], [[0.75, 0.25], [0.5, 0.5]],
+            ["562", "561"], ["Escherichia coli", "Escherichia"])
+        write_abundance_columns(
+            paths[1], "abundance", ["species", "genus"],
+            [[0], [0]], [[1.0], [1.0]], ["9"], ["Buchnera"])
+        (clades, matrix) = abundance_matrix(paths, 0)
+        assert clades == ["562", "9", "unclassified"]
+        assert matrix.tolist() == [[0.75, 0, 0.25], [0, 1.0, 0]]
+        (clades, matrix) = abundance_matrix(paths, 1)
+        assert clades == ["", "561", "9"]
+        assert matrix.tolist() == [[0.5, 0.5, 0], [0, 0, 1.0]]
+
+    def testClassification(self):
+        write_taxonomy(join(self.dir, "all_taxon.taxonomy"))
+        taxonomy = Taxonomy.from_csv(join(self.dir, "all_taxon.taxonomy"))
+        output = join(self.dir, "all.classification")
+        writer = ClassificationWriter(output, taxonomy, self.dir,
+                                      run_size=1, columnar=True,
+                                      metadata={"sample": "s1"})
+        writer.add(["r2", "r1"], taxonomy.index(["561", "1224"]))
+        writer.close()
+
+        columns = load_columns(output + ".columns")
+        assert columns.kind == "classification"
+        assert columns.strings("fragment") == ["r1", "r2"]
+        lineage = np.asarray(columns["lineage"])
+        tax_ids = columns.strings("tax_ids")
+        assert [tax_ids[t] if t != -1 else "NA" for t in lineage[1]] == \
+            ["NA", "561", "543", "NA", "1236", "1224"]
+        assert columns.string("names", lineage[0, 5]) == "Proteobacteria"
+
+
+if __name__ == "__main__":
+    unittest.main()
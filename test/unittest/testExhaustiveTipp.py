@@ -0,0 +1,177 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+import io
+import json
+import os
+import subprocess
+import sys
+from argparse import Namespace
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join, dirname, abspath
+import sepp.config
+from sepp.config import options
+import tipp.exhaustive_tipp as exhaustive_tipp
+
+ARGS = ["-A", "10", "-P", "10", "-at", "0.95", "-pt", "0.5",
+        "-cb", "python", "-o", "marker"]
+# Options set anew for every run
+PER_RUN = ("outdir", "tempdir")
+
+
+def described(value):
+    '''The options of a run as JSON'''
+    if isinstance(value, Namespace):
+        return dict((k, described(v)) for (k, v) in vars(value).items())
+    if isinstance(value, io.IOBase):
+        return getattr(value, "name", None)
+    if isinstance(value, (list, tuple)):
+        return [described(v) for v in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+class RecordingAlgorithm(object):
+    '''Stands in for TIPPExhaustiveAlgorithm, writing the options of a run
+    to <outdir>/<output>_options.json as its output'''
+    def __init__(self):
+        self.classification = None
+
+    def run(self):
+        recorded = described(options())
+        for key in PER_RUN:
+            recorded.pop(key, None)
+        with open(join(options().outdir,
+                       options().output + "_options.json"), 'w') as f:
+            json.dump(recorded, f, sort_keys=True)
+
+
+def record_main():
+    '''run_tipp.py, with the algorithm replaced by RecordingAlgorithm'''
+    exhaustive_tipp.TIPPExhaustiveAlgorithm = RecordingAlgorithm
+    exhaustive_tipp.main()
+
+
+def tipp_groups(parser):
+    return len([group for group in parser._action_groups
+                if group.title == "TIPP OPTIONS"])
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.saved = (sepp.config._options_singelton, sepp.config._parser,
+                      exhaustive_tipp.TIPPExhaustiveAlgorithm,
+                      exhaustive_tipp._tipp_parser)
+        exhaustive_tipp.TIPPExhaustiveAlgorithm = RecordingAlgorithm
+        exhaustive_tipp._tipp_parser = None
+        sepp.config._parser = None
+
+    def tearDown(self):
+        (sepp.config._options_singelton, sepp.config._parser,
+         exhaustive_tipp.TIPPExhaustiveAlgorithm,
+         exhaustive_tipp._tipp_parser) = self.saved
+        rmtree(self.dir)
+
+    def outputs(self, name):
+        with open(join(self.dir, name, "marker_options.json")) as f:
+            return json.load(f)
+
+    def run_in_process(self, names):
+        '''Runs in this process for every name, checking that the options,
+        parser and arguments of the caller are restored'''
+        caller = Namespace(cpu=3)
+        sepp.config._options_singelton = caller
+        parser = sepp.config._parser
+        argv = list(sys.argv)
+        for name in names:
+            os.mkdir(join(self.dir, name))
+            assert exhaustive_tipp.run(
+                ARGS + ["-d", join(self.dir, name)]) is None
+            assert sepp.config._options_singelton is caller
+            assert sepp.config._parser is parser
+            assert sys.argv == argv
+        # The TIPP options are added to a parser of their own once
+        assert tipp_groups(exhaustive_tipp._tipp_parser) == 1
+        assert self.outputs(names[0]) == self.outputs(names[-1])
+
+    def run_process(self, name):
+        '''Runs as a run_tipp.py process'''
+        os.mkdir(join(self.dir, name))
+        test_dir = dirname(abspath(__file__))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [dirname(dirname(test_dir)), test_dir,
+             os.environ.get("PYTHONPATH", "")]))
+        subprocess.check_call(
+            [sys.executable, "-c",
+             "import sys; from testExhaustiveTipp import record_main; "
+             "sys.argv = ['run_tipp.py'] + sys.argv[1:]; record_main()"] +
+            ARGS + ["-d", join(self.dir, name)], env=env)
+
+    def testRun(self):
+        self.run_in_process(["first", "second"])
+        # A run_tipp.py process parses the same options
+        self.run_process("process")
+        assert self.outputs("process") == self.outputs("first")
+
+    def testRunAfterAbundanceOptions(self):
+        # run_abundance.py extends the shared parser with its own options,
+        # some of them with the names of run_tipp.py options
+        parser = sepp.config.get_parser()
+        group = parser.add_argument_group("TIPP OPTIONS")
+        group.add_argument("-pt", "--placementThreshold", type=str,
+                           dest="placement_threshold", default="0.95")
+        group.add_argument("-D", "--dist", action='store_const',
+                           dest="dist", const=True, default=False)
+        self.run_in_process(["first", "second"])
+        # Its options are left as they were
+        assert tipp_groups(parser) == 1
+        assert parser._option_string_actions["-pt"].type is str
+        assert parser._option_string_actions["-D"].dest == "dist"
+        self.run_process("process")
+        assert self.outputs("process") == self.outputs("first")
+
+    def testMergeInput(self):
+        subsets = [("(A[0],B[1]);", [join(self.dir, "p0.json"),
+                                     join(self.dir, "p1.json")]),
+                   ("(C[2],D[3]);", []),
+                   ("(E[4],F[5]);", [join(self.dir, "p2.json")])]
+        os.mkdir(join(self.dir, "temp"))
+        (stdin_data, directory) = exhaustive_tipp.merge_input(
+            join(self.dir, "temp"), "(A,B,C,D,E,F);", subsets)
+        assert stdin_data is None
+        assert sorted(os.listdir(directory)) == [
+            exhaustive_tipp.MAIN_TREE,
+            "subset0.0.json", "subset0.0.labeled.tree",
+            "subset0.1.json", "subset0.1.labeled.tree",
+            "subset0.tree",
+            "subset2.0.json", "subset2.0.labeled.tree",
+            "subset2.tree"]
+        with open(join(directory, exhaustive_tipp.MAIN_TREE)) as f:
+            assert f.read() == "(A,B,C,D,E,F);\n"
+        # Every placement output sits next to the tree of its subset
+        assert os.readlink(join(directory, "subset0.1.json")) == \
+            join(self.dir, "p1.json")
+        assert os.readlink(join(directory, "subset2.0.labeled.tree")) == \
+            "subset2.tree"
+        with open(join(directory, "subset0.1.labeled.tree")) as f:
+            assert f.read() == "(A[0],B[1]);\n"
+
+        # The merger cannot read a directory whose path has json in it
+        os.mkdir(join(self.dir, "json"))
+        (stdin_data, directory) = exhaustive_tipp.merge_input(
+            join(self.dir, "json"), "(A,B,C,D,E,F);", subsets)
+        assert directory is None
+        assert os.listdir(join(self.dir, "json")) == []
+        assert stdin_data == "\n".join([
+            "(A,B,C,D,E,F);",
+            "(A[0],B[1]);", join(self.dir, "p0.json"),
+            "(A[0],B[1]);", join(self.dir, "p1.json"),
+            "(E[4],F[5]);", join(self.dir, "p2.json"), "", ""])
+
+
+if __name__ == "__main__":
+    unittest.main()
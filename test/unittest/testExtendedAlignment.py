@@ -0,0 +1,51 @@
+'''
+Created on Oct 17, 2026
+'''
+import os
+import tempfile
+import unittest
+from tipp.extended_alignment import INSERTION, merge_labels, \
+    write_extended_alignment, merge_extended_alignments
+
+
+class Alignment(dict):
+    def __init__(self, rows, col_labels):
+        dict.__init__(self, rows)
+        self.col_labels = col_labels
+
+
+class Test(unittest.TestCase):
+    def testMergeLabels(self):
+        (labels, mine, hers) = merge_labels([0, 1, -1, 3],
+                                            [0, 2, -1, -1, 3])
+        i = INSERTION
+        assert labels == [0, 1, i, 2, i, i, 3]
+        assert mine.tolist() == [0, 1, 2, 6]
+        assert hers.tolist() == [0, 3, 4, 5, 6]
+        # Runs of insertion columns that meet are merged
+        (labels, mine, hers) = merge_labels([0, -1, -1, 1], [0, -1, 1])
+        assert labels == [0, i, i, 1]
+        assert hers.tolist() == [0, 1, 3]
+
+    def testMerge(self):
+        directory = tempfile.mkdtemp()
+        paths = [os.path.join(directory, "a%d" % i) for i in range(3)]
+        write_extended_alignment(paths[0], Alignment(
+            [("b1", "AC-G"), ("f1", "ACtG")], [0, 1, -1, 3]))
+        write_extended_alignment(paths[1], Alignment(
+            [("b2", "AT--G"), ("f2", "-Tca-"), ("b1", "XXXXX")],
+            [0, 2, -1, -1, 3]))
+        write_extended_alignment(paths[2], Alignment([], []))
+
+        output = os.path.join(directory, "alignment.fasta")
+        masked = os.path.join(directory, "alignment_masked.fasta")
+        merge_extended_alignments(paths, output, masked, batch_size=1)
+        with open(output) as f:
+            assert f.read() == ">b1\nAC----G\n>f1\nACt---G\n" \
+                ">b2\nA--T--G\n>f2\n---Tca-\n"
+        with open(masked) as f:
+            assert f.read() == ">b1\nAC-G\n>f1\nAC-G\n>b2\nA-TG\n>f2\n--T-\n"
+
+
+if __name__ == "__main__":
+    unittest.main()
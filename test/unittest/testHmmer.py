@@ -0,0 +1,110 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+import os
+import stat
+import sys
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from tipp.hmmer import search_markers, read_tblout, \
+    write_search_fragments, merge_hits, write_bins
+from tipp.reads import ReadStream
+import numpy as np
+
+TBLOUT = '''\
+#                                                               --- full seque
+# target name        accession  query name           accession    E-value  sco
+#------------------- ---------- -------------------- ---------- --------- ----
+read1_rev            -          rpsB                 -    3.2e-41  140.1 ...
+read7                -          rpsB                 -    1.1e-05   25.0 ...
+#
+# Program:         hmmsearch
+# [ok]
+'''
+
+# Writes the --cpu value and the HMM name to the --tblout file; fails on
+# "bad.hmm"
+FAKE_HMMSEARCH = '''#!%s
+import sys
+args = sys.argv
+if args[-2].endswith("bad.hmm"):
+    sys.exit(1)
+with open(args[args.index("--tblout") + 1], 'w') as out:
+    out.write("%%s %%s\\n" %% (args[args.index("--cpu") + 1], args[-2]))
+''' % sys.executable
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.hmmsearch = join(self.dir, "hmmsearch")
+        with open(self.hmmsearch, 'w') as fp:
+            fp.write(FAKE_HMMSEARCH)
+        os.chmod(self.hmmsearch, stat.S_IRWXU)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testSearchMarkers(self):
+        hmms = dict(("g%d" % i, "g%d.hmm" % i) for i in range(5))
+        found = {}
+        for (gene, output) in search_markers(self.hmmsearch, "frags.fas",
+                                             hmms, self.dir, 12):
+            with open(output) as fp:
+                found[gene] = fp.read().split()
+        assert sorted(found) == sorted(hmms)
+        assert found["g3"] == ["2", "g3.hmm"]
+        found = dict(search_markers(self.hmmsearch, "frags.fas",
+                                    {"g0": "g0.hmm"}, self.dir, 12))
+        with open(found["g0"]) as fp:
+            assert fp.read().split()[0] == "12"
+
+    def testReadTblout(self):
+        path = join(self.dir, "hits.tblout")
+        with open(path, 'w') as fp:
+            fp.write(TBLOUT)
+        for block_size in (50, 1 << 20):
+            (names, evalues, bitscores) = read_tblout(path, block_size)
+            assert names.tolist() == [b"read1_rev", b"read7"]
+            assert evalues.tolist() == [3.2e-41, 1.1e-05]
+            assert bitscores.tolist() == [140.1, 25.0]
+        with open(path, 'w') as fp:
+            fp.write("# [ok]\n")
+        assert len(read_tblout(path)[0]) == 0
+
+    def testBinning(self):
+        reads = join(self.dir, "reads.fas")
+        with open(reads, 'w') as fp:
+            fp.write(">r1\nAACG\n>r2\nTTGa-\n>r3\nCCCC\n")
+        frags = join(self.dir, "frags.fas")
+        write_search_fragments(ReadStream(reads), frags)
+        assert list(ReadStream(frags)) == [
+            ("r1", "AACG"), ("r1_rev", "CGTT"), ("r2", "TTGa-"),
+            ("r2_rev", "-tCAA"), ("r3", "CCCC"), ("r3_rev", "GGGG")]
+
+        order = {"A": 0, "B": 1}
+        frag_scores = {}
+        # Merged in either order, the tie on r2 goes to A
+        merge_hits(frag_scores, "B", np.array([b"r2", b"r1_rev", b"r1"]),
+                   np.array([30.0, 20.0, 10.0]), order)
+        merge_hits(frag_scores, "A", np.array([b"r2_rev", b"r1"]),
+                   np.array([30.0, 15.0]), order)
+        assert frag_scores == {b"r1": [20.0, "B", "reverse"],
+                               b"r2": [30.0, "A", "reverse"]}
+
+        binned = write_bins(ReadStream(reads), frag_scores, self.dir)
+        assert binned["A"]["nfrags"] == binned["B"]["nfrags"] == 1
+        assert list(ReadStream(binned["A"]["file"])) == [("r2", "-tCAA")]
+        assert list(ReadStream(binned["B"]["file"])) == [("r1", "CGTT")]
+
+    def testSearchFailure(self):
+        hmms = {"g0": "g0.hmm", "g1": "bad.hmm"}
+        with self.assertRaises(RuntimeError):
+            list(search_markers(self.hmmsearch, "frags.fas", hmms, self.dir,
+                                2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from tipp.manifest import RunManifest
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.bin = join(self.dir, "A.frags.fas.fixed")
+        with open(self.bin, 'w') as fp:
+            fp.write(">r1\nACGT\n")
+        self.binned = {"A": {"file": self.bin, "nfrags": 1},
+                       "B": {"file": join(self.dir, "B"), "nfrags": 0}}
+        self.output = join(self.dir, "tipp_A_classification.txt")
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testBinning(self):
+        manifest = RunManifest(join(self.dir, "out"), "k1")
+        assert manifest.binning() is None
+        # The fragments are kept next to the manifest
+        kept = join(self.dir, "out", "binned", "A.frags.fas.fixed")
+        assert manifest.set_binning(self.binned, {"r1": 2}) == {
+            "A": {"file": kept, "nfrags": 1}}
+        os.remove(self.bin)
+        manifest = RunManifest(join(self.dir, "out"), "k1")
+        assert manifest.binning() == (
+            {"A": {"file": kept, "nfrags": 1}}, {"r1": 2})
+        assert RunManifest(join(self.dir, "out"), "k2").binning() is None
+        assert RunManifest(join(self.dir, "out"), "k1",
+                           resume=False).binning() is None
+        with open(kept, 'a') as fp:
+            fp.write(">r2\nACGT\n")
+        assert RunManifest(join(self.dir, "out"), "k1").binning() is None
+
+    def testMoveBinning(self):
+        manifest = RunManifest(join(self.dir, "out"), "k1")
+        binned = manifest.set_binning(self.binned, None, move=True)
+        assert not os.path.exists(self.bin)
+        assert os.path.exists(binned["A"]["file"])
+
+    def testMarkers(self):
+        manifest = RunManifest(self.dir, "k1")
+        manifest.set_binning(self.binned, None)
+        key = manifest.marker_key(self.bin, ["-A", "100"])
+        assert key != manifest.marker_key(self.bin, ["-A", "200"])
+        assert not manifest.done("A", key)
+        with open(self.output, 'w') as fp:
+            fp.write("r1,1,root,root,1\n")
+        manifest.set_done("A", key, [self.output, join(self.dir, "none")])
+
+        manifest = RunManifest(self.dir, "k1")
+        assert manifest.done("A", key)
+        assert not manifest.done("A", manifest.marker_key(self.bin, []))
+        with open(self.output, 'w') as fp:
+            fp.write("truncated")
+        assert not manifest.done("A", key)
+
+        # Binning again forgets the markers
+        manifest.set_done("A", key, [self.output])
+        manifest.set_binning(self.binned, None)
+        assert not RunManifest(self.dir, "k1").done("A", key)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+'''
+Created on Oct 17, 2026
+'''
+import json
+import unittest
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from testTaxonomy import write_taxonomy
+from tipp.assignment import FragmentAssignment
+from tipp.placement import EdgeLineages, PlacementClassifier, read_mapping, \
+    relabeling
+from tipp.taxonomy import Taxonomy
+
+TREE = "((A:0.1[0],B:0.2[1]):0.3[2],'C':0.4[3]);"
+PLACEMENT_TREE = "((A:0.1{5},B:0.2{6}):0.3{7},C:0.4{8});"
+FIELDS = ["edge_num", "likelihood", "like_weight_ratio", "distal_length",
+          "pendant_length"]
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.taxonomy_file = join(self.dir, "all_taxon.taxonomy")
+        write_taxonomy(self.taxonomy_file)
+        self.mapping_file = join(self.dir, "species.mapping")
+        with open(self.mapping_file, 'w') as f:
+            f.write("seqname,tax_id\nA,562\nB,561\nC,2759\n")
+        self.placements = join(self.dir, "placements.json")
+        with open(self.placements, 'w') as f:
+            json.dump({"tree": PLACEMENT_TREE, "fields": FIELDS,
+                       "placements": [
+                           {"p": [[5, -10, 0.8, 0.05, 0.1],
+                                  [6, -11, 0.2, 0.5, 0.1]],
+                            "n": ["r1_s0_750000"]},
+                           {"p": [[8, -10, 1.0, 0.1, 0.1]],
+                            "nm": [["r1_s1_250000", 1]]},
+                           {"p": [[7, -10, 1.0, 0.1, 0.1]],
+                            "n": ["r2_s0_1000000"]}]}, f)
+        self.assignment = FragmentAssignment(
+            ["r1", "r2"], [0, 0, 1], [0, 1, 0], [0.75, 0.25, 1.0],
+            ["s0", "s1"])
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def edge_taxa(self, push_down):
+        taxonomy = Taxonomy.from_csv(self.taxonomy_file)
+        lineages = EdgeLineages.build(TREE, taxonomy,
+                                      read_mapping(self.mapping_file),
+                                      push_down)
+        return dict((edge, taxonomy.tax_ids(lineages.lineages[row]))
+                    for (edge, row) in lineages.rows.items())
+
+    def testEdgeLineages(self):
+        assert relabeling(PLACEMENT_TREE, TREE) == {
+            "5": "0", "6": "1", "7": "2", "8": "3"}
+        assert self.edge_taxa(True) == {
+            "0": ["562", "561", "543", "1236", "1224", "1"],
+            "1": ["561", "543", "1236", "1224", "1", "NA"],
+            "2": ["561", "543", "1236", "1224", "1", "NA"],
+            "3": ["2759", "1", "NA", "NA", "NA", "NA"]}
+        # Pushed up, the edges of A and B take the taxon of their parent,
+        # and the merger leaves the others without one
+        assert self.edge_taxa(False) == {
+            "0": ["561", "543", "1236", "1224", "1"],
+            "1": ["561", "543", "1236", "1224", "1"]}
+
+    def classify(self, threshold, distribution=False):
+        classifier = PlacementClassifier(
+            TREE, self.taxonomy_file, self.mapping_file, True, threshold,
+            distribution)
+        return classifier.classify(
+            [(TREE, [self.placements])], self.assignment,
+            join(self.dir, "placement.json"),
+            join(self.dir, "classification.txt"))
+
+    def lines(self, table):
+        return [(table.names[f], table.tax_ids[t].decode(), p)
+                for (f, t, p) in zip(table.fragment.tolist(),
+                                     table.tax_id.tolist(),
+                                     table.probability.tolist())]
+
+    def testClassify(self):
+        table = self.classify(0.0)
+        assert self.lines(table) == [
+            ("r1", "1", 1.0), ("r1", "1224", 0.75), ("r1", "1236", 0.75),
+            ("r1", "543", 0.75), ("r1", "561", 0.75), ("r1", "562", 0.6),
+            ("r1", "2759", 0.25)] + [
+            ("r2", tax_id, 1.0) for tax_id in ["1", "1224", "1236", "543",
+                                               "561"]]
+        # r1 is classified at species, r2 at genus
+        assert table.classify(0.5).tolist() == [5, 4]
+        with open(join(self.dir, "classification.txt")) as f:
+            lines = f.read().splitlines()
+        assert lines[1] == "r1,1224,Proteobacteria,phylum,.7500"
+        assert lines[0] == "r1,1,root,root,1.0000"
+
+        with open(join(self.dir, "placement.json")) as f:
+            placements = json.load(f)
+        assert placements["fields"] == FIELDS
+        assert [p["n"] for p in placements["placements"]] == [["r1"], ["r2"]]
+        records = placements["placements"][0]["p"]
+        assert [record[0] for record in records] == [0, 1, 3]
+        for (record, expected) in zip(records, [
+                [0, -10, 0.6, 0.05, 0.1], [1, -11, 0.15, 0.2 * 0.99, 0.1],
+                [3, -10, 0.25, 0.1, 0.1]]):
+            self.assertEqual(len(record), len(expected))
+            for (value, expected_value) in zip(record, expected):
+                self.assertAlmostEqual(value, expected_value)
+
+        # Lines below the threshold are left out
+        assert [line for line in self.lines(self.classify(0.7))
+                if line[0] == "r1"] == [
+            ("r1", "1", 1.0), ("r1", "1224", 0.75), ("r1", "1236", 0.75),
+            ("r1", "543", 0.75), ("r1", "561", 0.75)]
+
+    def testDistribution(self):
+        # The placements of r1 add up to 0.7 or more with the first two
+        table = self.classify(0.7, distribution=True)
+        assert [line for line in self.lines(table) if line[0] == "r1"] == [
+            ("r1", "1", 1.0), ("r1", "1224", 0.7059),
+            ("r1", "1236", 0.7059), ("r1", "543", 0.7059),
+            ("r1", "561", 0.7059), ("r1", "562", 0.7059),
+            ("r1", "2759", 0.2941)]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+import gzip
+import struct
+import zlib
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from tipp.reads import ReadStream, FASTA, FASTQ, PLAIN, GZIP, BGZF, \
+    reverse_complement, dereplicate, TaggedReads
+
+READS = [("read1", "ACGTACGTTT"), ("read2", ""), ("read3", "GGGCCCAAAT"),
+         ("read4", "TTTTGGGGCCCCAAAA")]
+
+
+def write_bgzf(path, data, block=7):
+    with open(path, 'wb') as fp:
+        for i in range(0, len(data), block):
+            comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = comp.compress(data[i:i + block]) + comp.flush()
+            fp.write(b'\x1f\x8b\x08\x04' + b'\x00' * 4 + b'\x00\xff' +
+                     struct.pack('<HBBHH', 6, 66, 67, 2, len(cdata) + 25))
+            fp.write(cdata)
+            fp.write(struct.pack('<II', zlib.crc32(data[i:i + block]),
+                                 len(data[i:i + block])))
+        fp.write(b'\x1f\x8b\x08\x04' + b'\x00' * 4 + b'\x00\xff' +
+                 struct.pack('<HBBHH', 6, 66, 67, 2, 27) +
+                 b'\x03\x00' + b'\x00' * 8)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.expected = [(n, s) for (n, s) in READS if s]
+        self.fasta = "".join(
+            ">%s some description\n%s\n%s\n" % (n, s[:4], s[4:])
+            for (n, s) in READS).encode()
+        self.fastq = "".join(
+            "@%s some description\n%s\n+\n%s\n" % (n, s, "I" * len(s))
+            for (n, s) in READS).encode()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, name, data, compression=PLAIN):
+        path = join(self.dir, name)
+        if compression == GZIP:
+            with gzip.open(path, 'wb') as fp:
+                fp.write(data)
+        elif compression == BGZF:
+            write_bgzf(path, data)
+        else:
+            with open(path, 'wb') as fp:
+                fp.write(data)
+        return path
+
+    def testFormats(self):
+        for fmt, data in ((FASTA, self.fasta), (FASTQ, self.fastq)):
+            for compression in (PLAIN, GZIP, BGZF):
+                path = self.write("reads", data, compression)
+                for threads in (1, 4):
+                    for block_size in (5, 1 << 20):
+                        reads = ReadStream(path, threads, block_size)
+                        assert reads.format == fmt
+                        assert reads.compression == compression
+                        assert list(reads) == self.expected, \
+                            (fmt, compression, threads, block_size)
+
+    def testWriteFasta(self):
+        path = self.write("reads.fq.gz", self.fastq, GZIP)
+        out = join(self.dir, "out.fas")
+        with open(out, 'wb') as fp:
+            count = ReadStream(path).write_fasta(fp)
+        assert count == len(self.expected)
+        assert list(ReadStream(out)) == self.expected
+
+    def testNotReads(self):
+        path = self.write("notreads", b"hello\n")
+        self.assertRaises(ValueError, ReadStream, path)
+
+    def testNames(self):
+        # Headers that are not ASCII, or not even UTF-8, still decode
+        path = self.write("reads.fas", b">r\xc3\xa9ad1\nACGT\n"
+                                       b">read\xe92\nACGT\n")
+        assert [name for (name, _) in ReadStream(path)] == [
+            "r\xe9ad1", "read\xe92"]
+
+    def testCorruptBGZF(self):
+        path = self.write("reads.fas.gz", self.fasta, BGZF)
+        with open(path, 'r+b') as fp:
+            # The CRC32 of the first block, 8 bytes before its end
+            fp.seek(16)
+            fp.seek(struct.unpack('<H', fp.read(2))[0] + 1 - 8)
+            crc = fp.read(4)
+            fp.seek(-4, 1)
+            fp.write(bytes(255 - c for c in crc))
+        self.assertRaises(IOError, list, ReadStream(path, 4))
+
+    def testTaggedReads(self):
+        reads = TaggedReads([
+            (b"S0_", ReadStream(self.write("a.fas", self.fasta))),
+            (b"S1_", ReadStream(self.write("b.fq.gz", self.fastq, GZIP)))])
+        expected = [("S%d_%s" % (i, n), seq) for i in range(2)
+                    for (n, seq) in self.expected]
+        assert list(reads) == expected
+        assert not reads.is_plain_fasta()
+        out = join(self.dir, "out.fas")
+        with open(out, 'wb') as fp:
+            assert reads.write_fasta(fp) == len(expected)
+        assert list(ReadStream(out)) == expected
+
+    def testReverseComplement(self):
+        assert reverse_complement("AACGTn-") == "-nACGTT"
+        assert reverse_complement(b"AACGTn-") == b"-nACGTT"
+
+    def testDereplicate(self):
+        path = self.write("reads.fas", b">a\nACGTTT\n>b\nCCCC\n>c\nacgttt\n"
+                                       b">d\nAAACGT\n>e\nGGGG\n>f\nACGTTA\n")
+        (unique, counts) = dereplicate(ReadStream(path),
+                                       join(self.dir, "unique.fas"))
+        assert list(unique) == [("a", "ACGTTT"), ("b", "CCCC"),
+                                ("f", "ACGTTA")]
+        assert counts == {"a": 3, "b": 2}
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from tipp.refpkg import read_refpkg_map, compile_refpkg, load_index, \
+    taxonomy_index
+from testTaxonomy import write_taxonomy
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        os.mkdir(join(self.dir, "rpsB.refpkg"))
+        write_taxonomy(join(self.dir, "all_taxon.taxonomy"))
+        with open(join(self.dir, "rpsB.refpkg", "size.txt"), 'w') as fp:
+            fp.write("1234\n")
+        with open(join(self.dir, "file-map-for-tipp.txt"), 'w') as fp:
+            fp.write("taxonomy:taxonomy=all_taxon.taxonomy\n"
+                     "blast:database=blast/alignment.fasta.db\n"
+                     "rpsB:size=rpsB.refpkg/size.txt\n"
+                     "rpsB:hmm=rpsB.refpkg/sate.hmm\n")
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testCompile(self):
+        assert load_index(self.dir) is None
+        compile_refpkg(self.dir)
+        index = load_index(self.dir)
+        assert index.refpkg == read_refpkg_map(self.dir)
+        assert index.refpkg["rpsB"]["hmm"] == join(
+            self.dir, "rpsB.refpkg", "sate.hmm")
+        assert index.sizes == {"rpsB": 1234}
+        assert index.taxonomy.name(5) == "Escherichia coli"
+
+        # Changed sources invalidate the index
+        with open(join(self.dir, "rpsB.refpkg", "size.txt"), 'w') as fp:
+            fp.write("12345\n")
+        assert load_index(self.dir) is None
+        compile_refpkg(self.dir)
+        assert load_index(self.dir).sizes == {"rpsB": 12345}
+
+    def testTaxonomyIndex(self):
+        taxonomy_file = join(self.dir, "all_taxon.taxonomy")
+        assert taxonomy_index(taxonomy_file) is None
+        compile_refpkg(self.dir)
+        assert taxonomy_index(taxonomy_file).taxonomy.name(5) == \
+            "Escherichia coli"
+        # Another taxonomy is not the one of the reference package
+        write_taxonomy(join(self.dir, "rpsB.refpkg", "other.taxonomy"))
+        assert taxonomy_index(
+            join(self.dir, "rpsB.refpkg", "other.taxonomy")) is None
+
+
+if __name__ == "__main__":
+    unittest.main()
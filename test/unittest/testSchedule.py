@@ -0,0 +1,55 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+import threading
+import time
+from tipp.schedule import allocate_cores, longest_first, run_scheduled
+
+
+class Test(unittest.TestCase):
+    def testAllocateCores(self):
+        costs = {"small": 3 * 100, "large": 5000 * 1000, "mid": 200 * 1000}
+        limits = {"small": 3, "large": 5000, "mid": 200}
+        cores = allocate_cores(costs, limits, 64)
+        assert cores == {"small": 1, "large": 62, "mid": 2}
+        assert allocate_cores({"a": 10}, {"a": 4}, 64) == {"a": 4}
+        assert allocate_cores({"a": 0, "b": 0}, {"a": 4, "b": 4}, 8) == \
+            {"a": 1, "b": 1}
+
+    def testLongestFirst(self):
+        assert longest_first({"a": 1, "b": 5, "c": 1, "d": 9}) == \
+            ["d", "b", "a", "c"]
+
+    def testRunScheduled(self):
+        cores = {"a": 3, "b": 2, "c": 2, "d": 1}
+        lock = threading.Lock()
+        used = [0, 0]
+        started = []
+
+        def run(job, cpus):
+            with lock:
+                started.append(job)
+                used[0] += cpus
+                used[1] = max(used[1], used[0])
+            time.sleep(0.05)
+            with lock:
+                used[0] -= cpus
+
+        finished = list(run_scheduled(["a", "b", "c", "d"], cores, 4, run))
+        assert sorted(finished) == ["a", "b", "c", "d"]
+        assert used[1] <= 4
+        # d backfills next to a while b and c wait for cores
+        assert started[:2] == ["a", "d"]
+
+    def testRunScheduledFailure(self):
+        def run(job, cpus):
+            if job == "bad":
+                raise RuntimeError(job)
+
+        with self.assertRaises(RuntimeError):
+            list(run_scheduled(["ok", "bad"], {"ok": 1, "bad": 1}, 2, run))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+'''
+Created on Oct 17, 2026
+'''
+import unittest
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+import numpy as np
+from tipp.taxonomy import Taxonomy
+
+TAXONOMY = '''\
+"tax_id","parent_id","rank","tax_name","root","phylum","class","order",\
+"family","genus","species"
+"1","1","root","root","1","","","","","",""
+"1224","1","phylum","Proteobacteria","1","1224","","","","",""
+"1236","1224","class","Gammaproteobacteria","1","1224","1236","","","",""
+"543","1236","family","Enterobacteriaceae","1","1224","1236","","543","",""
+"561","543","genus","Escherichia","1","1224","1236","","543","561",""
+"562","561","species","Escherichia coli","1","1224","1236","","543","561",\
+"562"
+"2759","1","superkingdom","Eukaryota é","1","","","","","",""
+'''
+
+
+def write_taxonomy(path):
+    with open(path, 'w') as fp:
+        fp.write(TAXONOMY)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = join(self.dir, "all_taxon.taxonomy")
+        write_taxonomy(self.path)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def check(self, taxonomy):
+        assert len(taxonomy) == 7
+        assert taxonomy.index(np.array(["562", "1", "9", "2759"])).tolist() \
+            == [5, 0, -1, 6]
+        assert taxonomy.name(5) == "Escherichia coli"
+        assert taxonomy.name(6) == u"Eukaryota é"
+        assert taxonomy.ranks[taxonomy.rank[4]] == "genus"
+        assert taxonomy.parent[5] == 4 and taxonomy.parent[0] == 0
+        # species, genus, family, order, class, phylum
+        assert taxonomy.lineage[5].tolist() == [5, 4, 3, -1, 2, 1]
+        assert taxonomy.lineage[2].tolist() == [-1, -1, -1, -1, 2, 1]
+        assert (taxonomy.lineage[6] == -1).all()
+
+    def testLineages(self):
+        taxonomy = Taxonomy.from_csv(self.path)
+        taxa = taxonomy.index(np.array(["562", "1224", "9"]))
+        lineages = taxonomy.lineages(taxa)
+        assert lineages.shape == (3, 6)
+        assert (lineages[2] == -1).all()
+        assert taxonomy.tax_ids(lineages) == [
+            ["562", "561", "543", "NA", "1236", "1224"],
+            ["NA", "NA", "NA", "NA", "NA", "1224"],
+            ["NA"] * 6]
+        assert taxonomy.tax_ids(4) == "561"
+
+    def testFromCsv(self):
+        self.check(Taxonomy.from_csv(self.path))
+
+    def testSaveLoad(self):
+        Taxonomy.from_csv(self.path).save(join(self.dir, "index"))
+        taxonomy = Taxonomy.load(join(self.dir, "index"))
+        assert isinstance(taxonomy.lineage, np.memmap)
+        self.check(taxonomy)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import numpy as np
+'''
+Abundance profiles by grouped counting over integer coded lineages and
+classification tables, instead of per fragment dictionaries.
+
+Created on Oct 17, 2026
+'''
+
+# Clade of a fragment at a level where its lineage is undefined: either the
+# fragment is not classified that far up (unclassified), or it is classified
+# at a more specific level and its lineage skips this one (undefined, '')
+UNCLASSIFIED = -1
+UNDEFINED = -2
+_OFFSET = 2
+
+
+def lineage_clades(lineages):
+    '''
+    The clade of every fragment at every level, from a matrix of lineages
+    ordered from the most specific level (see Taxonomy.lineages): the taxon,
+    or UNCLASSIFIED where the lineage is undefined at this level and all the
+    more specific ones, else UNDEFINED.
+    '''
+    lineages = np.asarray(lineages)
+    defined = lineages >= 0
+    classified_below = np.zeros(defined.shape, dtype=bool)
+    classified_below[:, 1:] = np.logical_or.accumulate(defined, axis=1)[:, :-1]
+    return np.where(defined, lineages,
+                    np.where(classified_below, UNDEFINED, UNCLASSIFIED))
+
+
+def fragment_weights(names, weights):
+    '''weights[name] for an array of fragment names, 1 if missing'''
+    if not weights:
+        return np.ones(len(names))
+    return np.fromiter((weights.get(name, 1) for name in names),
+                       dtype=np.float64, count=len(names))
+
+
+class LevelCounts(object):
+    '''
+    Weighted number of fragments in every clade at every level of a taxonomy
+    of size taxa, counted sparsely: keys is the sorted array of the
+    (level, clade) pairs with fragments, as level * (size + 2) + clade + 2 so
+    that UNDEFINED and UNCLASSIFIED come first, and counts and fragments
+    their weights and numbers of fragments; total is the weight of all the
+    fragments counted.
+    '''
+    def __init__(self, size, levels):
+        self.width = size + _OFFSET
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0)
+        self.fragments = np.zeros(0, dtype=np.int64)
+        self.total = 0.0
+
+    def add(self, lineages, weights=None):
+        '''Counts fragments with the given lineages (see lineage_clades),
+        each counting its weight (1 if None)'''
+        clades = lineage_clades(lineages) + _OFFSET
+        (n, levels) = clades.shape
+        if weights is None:
+            weights = np.ones(n)
+        weights = np.asarray(weights, dtype=np.float64)
+        keys = (clades + np.arange(levels, dtype=np.int64) * self.width) \
+            .ravel()
+        (keys, inverse, fragments) = np.unique(
+            keys, return_inverse=True, return_counts=True)
+        counts = np.bincount(inverse.ravel(), np.repeat(weights, levels),
+                             minlength=len(keys))
+        (self.keys, inverse) = np.unique(
+            np.concatenate([self.keys, keys]), return_inverse=True)
+        inverse = inverse.ravel()
+        self.counts = np.bincount(
+            inverse, np.concatenate([self.counts, counts]),
+            minlength=len(self.keys))
+        self.fragments = np.bincount(
+            inverse, np.concatenate([self.fragments, fragments]),
+            minlength=len(self.keys)).astype(np.int64)
+        self.total += weights.sum()
+
+    def abundance(self, level):
+        '''(clades, abundances) of the clades with fragments at level'''
+        (start, end) = np.searchsorted(
+            self.keys, [level * self.width, (level + 1) * self.width])
+        return (self.keys[start:end] - level * self.width - _OFFSET,
+                self.counts[start:end] / self.total)
+
+
+class DistributionCounts(object):
+    '''
+    Placement probabilities of fragments summed over the tax ids (bytes) at
+    every level, clades[level][tax_id], the rest of every fragment's
+    probability in unclassified[level], and total the weight of all the
+    fragments counted.
+    '''
+    def __init__(self, levels):
+        self.levels = levels
+        self.clades = [{} for _ in range(levels)]
+        self.unclassified = np.zeros(levels)
+        self.total = 0.0
+
+    def add(self, table, weights=None, cutoff=0):
+        '''
+        Counts the fragments of a ClassificationTable, each run of lines of
+        the same fragment as one fragment counting weights[name] (1 if
+        missing). Only placements at the ranks of the levels with a
+        probability of at least cutoff count.
+        '''
+        rows = np.nonzero((table.rank >= 0) &
+                          (table.rank < self.levels))[0]
+        if len(rows) == 0:
+            return
+        fragment = table.fragment[rows]
+        start = np.ones(len(rows), dtype=bool)
+        start[1:] = fragment[1:] != fragment[:-1]
+        run = np.cumsum(start) - 1
+        run_weights = fragment_weights(
+            table.names[fragment[start]].tolist(), weights)
+
+        rank = table.rank[rows]
+        probability = table.probability[rows]
+        # Every fragment has to be placed at the least specific level
+        top = rank == self.levels - 1
+        assert np.all(np.bincount(run[top], probability[top],
+                                  minlength=len(run_weights)) != 0)
+
+        keep = probability >= cutoff
+        width = len(table.tax_ids)
+        keys = rank[keep].astype(np.int64) * width + table.tax_id[rows][keep]
+        counts = np.bincount(
+            keys, probability[keep] * run_weights[run[keep]],
+            minlength=self.levels * width).reshape(self.levels, width)
+        present = np.bincount(
+            keys, minlength=self.levels * width).reshape(self.levels, width)
+
+        total = run_weights.sum()
+        self.unclassified += total - counts.sum(axis=1)
+        self.total += total
+        for level in range(self.levels):
+            clades = self.clades[level]
+            for i in np.nonzero(present[level])[0].tolist():
+                tax_id = table.tax_ids[i]
+                clades[tax_id] = clades.get(tax_id, 0.0) + counts[level, i]
@@ -0,0 +1,175 @@
+import numpy as np
+'''
+Assignment of fragments to the alignment subsets of exhaustive TIPP, from
+the bit scores of their hmmsearch hits against every subset.
+
+Created on Oct 17, 2026
+'''
+
+# Bit scores are capped so that 2 ** score stays a finite double
+MAX_SCORE = 1022
+# Weights are fixed point, in millionths
+SCALE = 1000000
+
+
+def assign_fragments(fragment, subset, score, threshold):
+    '''
+    Assigns fragments to subsets given their hits, arrays of fragment and
+    subset indices and bit scores in the order the hits were found.
+
+    The hits of a fragment get probabilities proportional to 2 ** score.
+    Taking them by decreasing probability (ties in hit order), the fragment
+    goes to the first subsets whose probabilities add up to threshold,
+    though never to its last subset unless it is its only one, as the
+    original reduce over the cumulative probabilities did. The selected
+    probabilities are renormalized to add up to one.
+
+    Returns the assignments as arrays (fragment, subset, weight), grouped by
+    fragment in increasing order and by decreasing weight within a fragment.
+    '''
+    fragment = np.asarray(fragment, dtype=np.int64)
+    subset = np.asarray(subset, dtype=np.int64)
+    score = np.minimum(np.asarray(score, dtype=np.float64), MAX_SCORE)
+    if len(fragment) == 0:
+        return fragment, subset, np.zeros(0)
+
+    order = np.lexsort((np.arange(len(fragment)), -score, fragment))
+    (fragment, subset, score) = (fragment[order], subset[order],
+                                 score[order])
+    start = np.ones(len(fragment), dtype=bool)
+    start[1:] = fragment[1:] != fragment[:-1]
+    starts = np.nonzero(start)[0]
+    counts = np.diff(np.append(starts, len(fragment)))
+    segment = np.cumsum(start) - 1
+
+    # Softmax of the scores in base 2, shifted by the best score of every
+    # fragment (its first hit) so that nothing overflows or underflows
+    powers = np.exp2(score - score[starts][segment])
+    probability = powers / np.bincount(segment, powers)[segment]
+
+    # Cumulative probability within every fragment
+    cumulative = np.cumsum(probability)
+    cumulative -= np.append(0, cumulative[starts[1:] - 1])[segment]
+    rank = np.arange(len(fragment)) - starts[segment]
+
+    # Number of subsets: one more than the leading cumulative probabilities
+    # below threshold, counting all but the last hit, within [1, n - 1]
+    below = (cumulative * SCALE < int(SCALE * threshold)) & \
+        (rank < counts[segment] - 1)
+    selected = np.bincount(segment, below, minlength=len(starts)) + 1
+    selected = np.maximum(1, np.minimum(selected, counts - 1))
+
+    keep = rank < selected[segment]
+    weight = probability / np.bincount(
+        segment[keep], probability[keep], minlength=len(starts))[segment]
+    return fragment[keep], subset[keep], weight[keep]
+
+
+class FragmentAssignment(object):
+    '''
+    The assignment of fragments to subsets as a table of rows (fragment,
+    subset, weight), grouped by subset, where fragment indexes names, the
+    fragments of the shared fragment store, and subset indexes labels.
+
+    The external tools still see every assigned fragment under a copy name,
+    fragment_label_weight with the weight in millionths (or 1000000 unless
+    weighted); the copy names are made on demand and resolved back to rows
+    through the table.
+    '''
+    def __init__(self, names, fragment, subset, weight, labels,
+                 weighted=True):
+        order = np.argsort(subset, kind='stable')
+        self.names = list(names)
+        self.labels = list(labels)
+        self.fragment = np.asarray(fragment, dtype=np.int64)[order]
+        self.subset = np.asarray(subset, dtype=np.int64)[order]
+        self.weight = np.asarray(weight, dtype=np.float64)[order]
+        self.weighted = weighted
+        self.starts = np.searchsorted(self.subset,
+                                      np.arange(len(self.labels) + 1))
+        self._rows_by_name = None
+
+    def __len__(self):
+        return len(self.fragment)
+
+    def rows(self, subset):
+        '''Rows of a subset, in the order of its fragments'''
+        return np.arange(self.starts[subset], self.starts[subset + 1])
+
+    def postfixes(self, rows):
+        if self.weighted:
+            return (self.weight[rows] * SCALE).astype(np.int64).tolist()
+        return [SCALE] * len(rows)
+
+    def copy_names(self, rows):
+        return ["%s_%s_%d" % (self.names[fragment], self.labels[subset],
+                              postfix)
+                for (fragment, subset, postfix) in zip(
+                    self.fragment[rows].tolist(),
+                    self.subset[rows].tolist(), self.postfixes(rows))]
+
+    def resolve(self, copy_names):
+        '''Rows of copy names, -1 for names not in the table'''
+        if self._rows_by_name is None:
+            rows = np.arange(len(self))
+            self._rows_by_name = dict(zip(self.copy_names(rows),
+                                          rows.tolist()))
+        return np.array([self._rows_by_name.get(name, -1)
+                         for name in copy_names], dtype=np.int64)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_rows_by_name"] = None
+        return state
+
+
+class AssignedFragments(object):
+    '''
+    The fragments of some rows of a FragmentAssignment under their copy
+    names, with the sequences read from the shared fragment store (a dict
+    of fragment name -> sequence). Stands in for the MutableAlignment of
+    the fragments of a subproblem, so that no sequence is copied.
+    '''
+    def __init__(self, assignment, store, rows):
+        self.assignment = assignment
+        self.store = store
+        self.rows = np.asarray(rows, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def is_empty(self):
+        return len(self.rows) == 0
+
+    def keys(self):
+        return self.assignment.copy_names(self.rows)
+
+    get_sequence_names = keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        names = self.assignment.names
+        return zip(self.keys(),
+                   [self.store[names[fragment]] for fragment in
+                    self.assignment.fragment[self.rows].tolist()])
+
+    def __getitem__(self, copy_name):
+        row = self.assignment.resolve([copy_name])[0]
+        if row == -1 or row not in self.rows:
+            raise KeyError(copy_name)
+        return self.store[
+            self.assignment.names[self.assignment.fragment[row]]]
+
+    def divide_to_equal_chunks(self, chunks):
+        '''Consecutive chunks, sized as MutableAlignment does'''
+        size = len(self.rows) // chunks + 1
+        return [AssignedFragments(self.assignment, self.store,
+                                  self.rows[i * size:(i + 1) * size])
+                for i in range(chunks)]
+
+    def write_to_path(self, path):
+        with open(path, 'w') as f:
+            for (name, sequence) in self.items():
+                f.write(">%s\n%s\n" % (name, sequence))
@@ -0,0 +1,604 @@
+import os
+import queue
+import subprocess
+import threading
+from collections import deque
+import numpy as np
+from tipp.reads import ReadStream, reverse_complement, decode_name
+'''
+BLAST based binning of reads to marker genes.
+
+Created on Oct 17, 2026
+'''
+
+# Batches of reads buffered for each blastn shard
+SHARD_QUEUE = 16
+# Bytes of BLAST output parsed at a time
+CHUNK_SIZE = 1 << 24
+# Most bits of the Bloom filter of bin_external (64 MB)
+BLOOM_BITS = 1 << 29
+
+BLAST_OUTFMT = "6 qseqid sseqid pident length mismatch gapopen" \
+               " qstart qend qlen sstart send slen evalue bitscore"
+
+
+def blastn_command(blastn, database, query, output, threads):
+    '''Command line for blasting query against the marker database, a query
+    or output of "-" means stdin or stdout'''
+    return [blastn, "-db", database,
+            "-outfmt", BLAST_OUTFMT,
+            "-query", query,
+            "-out", output,
+            "-num_threads", "%d" % threads]
+
+
+def read_marker_map(input):
+    '''Reads the seq-to-marker map of the BLAST database into a dict of
+    sequence name -> marker'''
+    markers = {}
+    with open(input) as f:
+        for line in f:
+            results = line.strip().split('\t')
+            markers[results[0]] = results[1]
+    return markers
+
+
+def parse_blast_hit(line, marker_map):
+    '''Returns (qseqid, hit) for one line of BLAST tabular output'''
+    results = line.split('\t')
+
+    qseqid = results[0]
+    sseqid = results[1]
+    qstart = int(results[6])
+    qend = int(results[7])
+    hit = {"sseqid": sseqid,
+           "gene": marker_map[sseqid],
+           "qstart": qstart,
+           "qend": qend,
+           "qlen": int(results[8]),
+           "sstart": int(results[9]),
+           "send": int(results[10]),
+           "slen": int(results[11]),
+           "qcov": abs(qend - qstart) + 1}
+    return qseqid, hit
+
+
+def is_better_hit(hit, best, threshold):
+    '''The best hit is the first one with the largest query coverage'''
+    return hit["qcov"] >= threshold and \
+        (best is None or best["qcov"] < hit["qcov"])
+
+
+def trim_bounds(qstart, qend, qlen, sstart, send, slen, trim=True):
+    '''
+    Returns (start, end, trim_qstart, trim_qend): the slice of the read that
+    is kept and the 0-based start and 1-based end that are logged. A read is
+    trimmed on a side when it extends more than twice as far past the hit as
+    the marker does. Works on ints and on numpy arrays alike.
+    '''
+    if not trim:
+        return 0 * qlen, qlen, 0 * qlen, qlen
+    extra_qstart = qstart - 1
+    extra_qend = qlen - qend
+
+    forward = sstart < send
+    backward = sstart >= send
+    extra_sstart = forward * (sstart - 1) + backward * (slen - sstart)
+    extra_send = forward * (slen - send) + backward * (send - 1)
+
+    left = extra_qstart > 2 * extra_sstart
+    right = extra_qend > 2 * extra_send
+    keep_right = extra_qend <= 2 * extra_send
+    start = left * (qstart - 1)
+    # The right end is cut after the left one, hence relative to start
+    end = right * (start + qend) + keep_right * qlen
+    trim_qend = right * qend + keep_right * qlen
+    return start, end, start, trim_qend
+
+
+class BlastHitTable(object):
+    '''
+    Best BLAST hit of every query, stored column-wise: the query names in a
+    sorted fixed-width bytes array, subject names interned into a list and
+    coordinates in int32 arrays. The marker of each hit is an index into
+    genes.
+    '''
+    COLUMNS = ["qstart", "qend", "qlen", "sstart", "send", "slen"]
+
+    def __init__(self, marker_map):
+        self.marker_map = marker_map
+        self.genes = []
+        self.gene_index = {}
+        self.subjects = []
+        self.subject_index = {}
+        self.subject_marker = []
+        self.names = np.array([], dtype='S1')
+        self.subject = np.array([], dtype=np.int32)
+        self.qcov = np.array([], dtype=np.int32)
+        for column in self.COLUMNS:
+            setattr(self, column, np.array([], dtype=np.int32))
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def marker(self):
+        return np.array(self.subject_marker, dtype=np.uint16)[self.subject]
+
+    def _intern(self, sseqids):
+        (subjects, inverse) = np.unique(sseqids, return_inverse=True)
+        ids = np.empty(len(subjects), dtype=np.int32)
+        for (i, sseqid) in enumerate(subjects.tolist()):
+            name = decode_name(sseqid)
+            if name not in self.subject_index:
+                gene = self.marker_map[name]
+                if gene not in self.gene_index:
+                    self.gene_index[gene] = len(self.genes)
+                    self.genes.append(gene)
+                self.subject_index[name] = len(self.subjects)
+                self.subjects.append(name)
+                self.subject_marker.append(self.gene_index[gene])
+            ids[i] = self.subject_index[name]
+        return ids[inverse.reshape(-1)]
+
+    def _parse_chunk(self, data, offset, threshold):
+        '''Parses complete lines of BLAST output into columns and keeps
+        the best hit of every query in the chunk'''
+        tokens = data.split()
+        if len(tokens) % 14 != 0:
+            raise ValueError("Malformed BLAST tabular output")
+        columns = {"names": np.array(tokens[0::14]),
+                   "subject": self._intern(np.array(tokens[1::14]))}
+        # Coordinates are parsed by numpy in one go
+        coordinates = np.array(
+            [tokens[6 + i::14] for i in range(len(self.COLUMNS))]
+        ).astype(np.int32)
+        for (i, column) in enumerate(self.COLUMNS):
+            columns[column] = coordinates[i]
+        columns["qcov"] = np.abs(columns["qend"] - columns["qstart"]) + 1
+        columns["order"] = np.arange(offset, offset + len(tokens) // 14,
+                                     dtype=np.int64)
+        keep = columns["qcov"] >= threshold
+        return (_best_per_query(
+            dict((k, v[keep]) for (k, v) in columns.items())),
+            len(tokens) // 14)
+
+    def chunks(self, inputs, threshold, chunk_size=CHUNK_SIZE, offset=0):
+        '''Reads BLAST tabular output files in large chunks and yields the
+        best hits of each chunk as columns, with an "order" column that
+        keeps the position of every hit in the output'''
+        for input in inputs:
+            with open(input, 'rb') as f:
+                carry = b''
+                while True:
+                    block = f.read(chunk_size)
+                    data = carry + block
+                    if block:
+                        end = data.rfind(b'\n') + 1
+                        (data, carry) = (data[:end], data[end:])
+                    if data.strip():
+                        (part, lines) = self._parse_chunk(data, offset,
+                                                          threshold)
+                        offset += lines
+                        yield part
+                    if not block:
+                        break
+
+    def read(self, inputs, threshold, chunk_size=CHUNK_SIZE):
+        '''Fills the table from BLAST tabular output files'''
+        parts = [self.columns(np.arange(len(self), dtype=np.int64))]
+        parts.extend(self.chunks(inputs, threshold, chunk_size, len(self)))
+        self.set_columns(_best_per_query(_concatenate(parts)))
+        return self
+
+    def columns(self, order):
+        columns = {"names": self.names, "subject": self.subject,
+                   "qcov": self.qcov, "order": order}
+        for column in self.COLUMNS:
+            columns[column] = getattr(self, column)
+        return columns
+
+    def set_columns(self, columns):
+        '''Replaces the hits with the given columns, which must be sorted by
+        query name'''
+        for (k, v) in columns.items():
+            if k != "order":
+                setattr(self, k, v)
+
+    def lookup(self, names):
+        '''Rows of the given query names (a bytes array), -1 if a query has
+        no hit'''
+        if len(self) == 0:
+            return np.full(len(names), -1, dtype=np.int64)
+        rows = np.searchsorted(self.names, names)
+        rows[rows == len(self)] = 0
+        rows[self.names[rows] != names] = -1
+        return rows
+
+    def hit(self, row):
+        '''The hit in a row as a dict'''
+        hit = dict((column, int(getattr(self, column)[row]))
+                   for column in self.COLUMNS + ["qcov"])
+        hit["sseqid"] = self.subjects[self.subject[row]]
+        hit["gene"] = self.genes[self.subject_marker[self.subject[row]]]
+        return hit
+
+
+def _concatenate(parts):
+    return dict((k, np.concatenate([part[k] for part in parts]))
+                for k in parts[0])
+
+
+def _best_per_query(columns):
+    '''Keeps the first row with the largest qcov of every query, the
+    result is sorted by query name'''
+    if len(columns["names"]) == 0:
+        return columns
+    order = np.lexsort((columns["order"], -columns["qcov"],
+                        columns["names"]))
+    names = columns["names"][order]
+    first = np.ones(len(names), dtype=bool)
+    first[1:] = names[1:] != names[:-1]
+    return dict((k, v[order[first]]) for (k, v) in columns.items())
+
+
+class FragmentBinner(object):
+    '''
+    Writes reads to the per-marker fragment files, trimmed to the marker and
+    in the orientation of their best BLAST hit, and logs every binned read
+    to blast-binned.out. Reads are given as bytes.
+    '''
+    def __init__(self, genes, temp_dir, trim=True):
+        self.trim = trim
+        self.binned_fragments = {}
+        for gene in genes:
+            self.binned_fragments[gene] = {}
+            self.binned_fragments[gene]["file"] = temp_dir + '/' + gene \
+                + ".frags.fas.fixed"
+            self.binned_fragments[gene]["fptr"] = \
+                open(self.binned_fragments[gene]["file"], 'wb')
+            self.binned_fragments[gene]["nfrags"] = 0
+
+        self.log = open(temp_dir + "/blast-binned.out", 'w')
+        self.log.write("qseqid,sseqid,marker,trim_qstart,trim_qend,qlen\n")
+
+    def write(self, header, seq, gene, sseqid, trim_qstart, trim_qend, qlen,
+              reverse):
+        if reverse:
+            seq = reverse_complement(seq)
+        self.binned_fragments[gene]["fptr"].write(b'>%s\n%s\n' % (header,
+                                                                  seq))
+        self.binned_fragments[gene]["nfrags"] += 1
+        self.log.write("%s,%s,%s,%d,%d,%d\n" % (
+            decode_name(header), sseqid, gene, trim_qstart + 1, trim_qend,
+            qlen))
+
+    def add(self, header, seq, hit):
+        '''Bins one read given its best hit as a dict'''
+        (start, end, trim_qstart, trim_qend) = trim_bounds(
+            hit["qstart"], hit["qend"], hit["qlen"], hit["sstart"],
+            hit["send"], hit["slen"], self.trim)
+        self.write(header, seq[start:end], hit["gene"], hit["sseqid"],
+                   trim_qstart, trim_qend, hit["qlen"],
+                   hit["sstart"] > hit["send"])
+
+    def add_batch(self, batch, table):
+        '''Bins a batch of reads with their hits in a BlastHitTable, all
+        trimming coordinates are computed on arrays'''
+        rows = table.lookup(np.array([header for (header, _) in batch]))
+        found = np.nonzero(rows >= 0)[0]
+        rows = rows[found]
+        qlen = table.qlen[rows]
+        (start, end, trim_qstart, trim_qend) = trim_bounds(
+            table.qstart[rows], table.qend[rows], qlen, table.sstart[rows],
+            table.send[rows], table.slen[rows], self.trim)
+        reverse = table.sstart[rows] > table.send[rows]
+        subject = table.subject[rows]
+        marker = np.array(table.subject_marker, dtype=np.int64)[subject]
+        for (i, s, e, ts, te, ql, rev, sub, m) in zip(
+                found.tolist(), start.tolist(), end.tolist(),
+                trim_qstart.tolist(), trim_qend.tolist(), qlen.tolist(),
+                reverse.tolist(), subject.tolist(), marker.tolist()):
+            (header, seq) = batch[i]
+            self.write(header, seq[s:e], table.genes[m], table.subjects[sub],
+                       ts, te, ql, rev)
+
+    def close(self):
+        for gene in self.binned_fragments:
+            self.binned_fragments[gene]["fptr"].close()
+        self.log.close()
+        return self.binned_fragments
+
+
+def stream_blast(reads, cmd, marker_map, threshold, binner,
+                 raw_output=None):
+    '''
+    Runs blastn (cmd must read the query from stdin and write to stdout)
+    while a feeder thread pipes the reads into it, and bins every read as
+    soon as blastn has reported all of its hits.
+
+    blastn reports hits in query order, so a read is complete once hits for
+    a later read show up. Reads are kept in memory only between being sent
+    to blastn and being binned. If raw_output is given, the BLAST output is
+    copied into it as well.
+    '''
+    pending = deque()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            for batch in reads.batches():
+                # Queue the reads before blastn can possibly report on them
+                pending.extend(batch)
+                proc.stdin.write(b''.join(b'>%s\n%s\n' % r for r in batch))
+        except BrokenPipeError:
+            # blastn died, its exit code is reported below
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def flush(qseqid, hit):
+        name = qseqid.encode('latin-1')
+        while pending:
+            (header, seq) = pending.popleft()
+            if header == name:
+                binner.add(header, seq, hit)
+                return
+        raise RuntimeError("blastn reported hits for %s, which is not in"
+                           " the input (or is out of order)" % qseqid)
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    current = None
+    best = None
+    try:
+        for line in proc.stdout:
+            if raw_output is not None:
+                raw_output.write(line)
+            (qseqid, hit) = parse_blast_hit(line.decode('latin-1'),
+                                            marker_map)
+            if qseqid != current:
+                if best is not None:
+                    flush(current, best)
+                current = qseqid
+                best = None
+            if is_better_hit(hit, best, threshold):
+                best = hit
+        if best is not None:
+            flush(current, best)
+    except Exception:
+        proc.kill()
+        raise
+
+    feeder.join()
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError("blastn failed with exit code %d" %
+                           proc.returncode)
+    return binner
+
+
+def shard_threads(cpus, shards, threads=None):
+    '''Splits a budget of cpus between shards concurrent blastn processes,
+    returns the (shards, threads per shard) that fit in the budget'''
+    shards = max(1, min(shards, cpus))
+    budget = max(1, cpus // shards)
+    if threads is None or threads > budget:
+        threads = budget
+    return shards, max(1, threads)
+
+
+def blast_sharded(reads, blastn, database, outputs, threads):
+    '''
+    Blasts the reads with one blastn process per output file, all running
+    concurrently with the given number of threads each. Reads are sent to
+    a shard by the hash of their name, so all copies of a name end up in
+    the same shard and the shard outputs can be binned independently.
+    Returns the number of reads sent to blastn.
+    '''
+    shards = len(outputs)
+
+    def feed(proc, pipe):
+        alive = True
+        while True:
+            data = pipe.get()
+            if data is None:
+                break
+            if not alive:
+                continue
+            try:
+                proc.stdin.write(data)
+            except BrokenPipeError:
+                # Keep draining, the exit code is reported below
+                alive = False
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    procs = []
+    queues = []
+    feeders = []
+    count = 0
+    try:
+        for output in outputs:
+            cmd = blastn_command(blastn, database, "-", output, threads)
+            print(" ".join(cmd))
+            procs.append(subprocess.Popen(cmd, stdin=subprocess.PIPE))
+            queues.append(queue.Queue(SHARD_QUEUE))
+        feeders = [threading.Thread(target=feed, args=(proc, pipe))
+                   for (proc, pipe) in zip(procs, queues)]
+        for feeder in feeders:
+            feeder.daemon = True
+            feeder.start()
+
+        for batch in reads.batches():
+            parts = [[] for _ in range(shards)]
+            for record in batch:
+                parts[hash(record[0]) % shards].append(b'>%s\n%s\n' % record)
+            for (pipe, part) in zip(queues, parts):
+                if part:
+                    pipe.put(b''.join(part))
+            count += len(batch)
+    except BaseException:
+        # Stop every shard, so that none is left running or waits on input
+        for proc in procs:
+            proc.terminate()
+        raise
+    finally:
+        for pipe in queues:
+            pipe.put(None)
+        for feeder in feeders:
+            feeder.join()
+        for proc in procs:
+            proc.wait()
+
+    for proc in procs:
+        if proc.returncode != 0:
+            raise RuntimeError("blastn failed with exit code %d" %
+                               proc.returncode)
+    return count
+
+
+def hash_names(names):
+    '''64-bit FNV-1a hash of every name in a bytes array; the padding of
+    the array does not change the hash'''
+    names = np.ascontiguousarray(names)
+    hashes = np.full(len(names), 14695981039346656037, dtype=np.uint64)
+    if len(names) == 0 or names.itemsize == 0:
+        return hashes
+    codes = names.view(np.uint8).reshape(len(names), names.itemsize)
+    prime = np.uint64(1099511628211)
+    for j in range(names.itemsize):
+        code = codes[:, j].astype(np.uint64)
+        hashes = np.where(code != 0, (hashes ^ code) * prime, hashes)
+    return hashes
+
+
+class BloomFilter(object):
+    '''Approximate set of name hashes, used to drop reads that certainly
+    have no BLAST hit before they are written to disk. Sized for n names,
+    with at most max_bits bits; a filter too small for its names only lets
+    more reads through.'''
+    def __init__(self, n, bits_per_name=16, k=4, max_bits=BLOOM_BITS):
+        self.size = max(1024, min(n * bits_per_name, max_bits))
+        self.k = k
+        self.bits = np.zeros(self.size // 8 + 1, dtype=np.uint8)
+
+    def _positions(self, hashes):
+        step = (hashes >> np.uint64(32)) | np.uint64(1)
+        return [(hashes + np.uint64(i) * step) % np.uint64(self.size)
+                for i in range(self.k)]
+
+    def add(self, hashes):
+        for position in self._positions(hashes):
+            np.bitwise_or.at(self.bits, position >> np.uint64(3),
+                             np.left_shift(1, position & np.uint64(7))
+                             .astype(np.uint8))
+
+    def contains(self, hashes):
+        found = np.ones(len(hashes), dtype=bool)
+        for position in self._positions(hashes):
+            found &= (self.bits[position >> np.uint64(3)] >>
+                      (position & np.uint64(7)).astype(np.uint8)) & 1 == 1
+        return found
+
+
+def _append_columns(path, columns):
+    records = np.empty(len(columns["names"]),
+                       dtype=[(k, v.dtype) for (k, v) in columns.items()])
+    for (k, v) in columns.items():
+        records[k] = v
+    with open(path, 'ab') as f:
+        np.save(f, records)
+
+
+def _load_columns(path):
+    parts = []
+    if os.path.exists(path):
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            while f.tell() < size:
+                records = np.load(f)
+                parts.append(dict((k, records[k])
+                                  for k in records.dtype.names))
+    return parts
+
+
+def bin_external(reads, inputs, table, binner, work_dir, partitions,
+                 threshold, chunk_size=CHUNK_SIZE):
+    '''
+    Bins reads against BLAST outputs larger than memory, as a hash join
+    through disk:
+
+    1. BLAST hits, reduced to the best hit per query within every chunk,
+       are appended to one run file per partition (by hash of the query);
+    2. every partition is reduced to the best hit per query on its own;
+    3. reads are streamed once, and the ones whose name is in a Bloom
+       filter of the queries with a hit are written to their partition;
+    4. every partition of reads is binned with its own hits.
+
+    Peak memory is set by chunk_size, by the size of one partition and by
+    the Bloom filter, sized from the number of distinct queries with a hit
+    up to BLOOM_BITS bits.
+    table is an empty BlastHitTable, used to intern subjects and to hold
+    one partition at a time. Returns the binner.
+    '''
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    hit_runs = [os.path.join(work_dir, "hits.%d.npy" % p)
+                for p in range(partitions)]
+    best_hits = [os.path.join(work_dir, "best.%d.npy" % p)
+                 for p in range(partitions)]
+    read_runs = [os.path.join(work_dir, "reads.%d.fas" % p)
+                 for p in range(partitions)]
+
+    for part in table.chunks(inputs, threshold, chunk_size):
+        partition = hash_names(part["names"]) % np.uint64(partitions)
+        for p in range(partitions):
+            selected = partition == p
+            if selected.any():
+                _append_columns(hit_runs[p], dict(
+                    (k, v[selected]) for (k, v) in part.items()))
+
+    queries = 0
+    for p in range(partitions):
+        parts = _load_columns(hit_runs[p])
+        if parts:
+            best = _best_per_query(_concatenate(parts))
+            queries += len(best["names"])
+            _append_columns(best_hits[p], best)
+            os.remove(hit_runs[p])
+
+    bloom = BloomFilter(queries)
+    for p in range(partitions):
+        for part in _load_columns(best_hits[p]):
+            bloom.add(hash_names(part["names"]))
+
+    outputs = [open(path, 'wb') for path in read_runs]
+    for batch in reads.batches():
+        hashes = hash_names(np.array([header for (header, _) in batch]))
+        candidates = np.nonzero(bloom.contains(hashes))[0]
+        partition = (hashes[candidates] % np.uint64(partitions)).tolist()
+        for (i, p) in zip(candidates.tolist(), partition):
+            outputs[p].write(b'>%s\n%s\n' % batch[i])
+    for output in outputs:
+        output.close()
+
+    for p in range(partitions):
+        parts = _load_columns(best_hits[p])
+        if not parts or os.path.getsize(read_runs[p]) == 0:
+            continue
+        table.set_columns(parts[0])
+        for batch in ReadStream(read_runs[p]).batches():
+            binner.add_batch(batch, table)
+    for path in best_hits + read_runs:
+        if os.path.exists(path):
+            os.remove(path)
+    return binner
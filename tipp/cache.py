@@ -0,0 +1,188 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+'''
+Content-addressed cache of binning results.
+
+An entry holds the per-marker fragment files of one binning run, keyed by
+a digest of everything that determines them: the input reads, the
+reference package, the binner and its settings. Reruns with different
+placement settings reuse the entry instead of binning again.
+
+Created on Oct 17, 2026
+'''
+
+CACHE_VERSION = 1
+ENTRY = "entry.json"
+
+
+def file_digest(path, block_size=1 << 22):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stamp(path):
+    '''Identity of a file without reading it: its absolute path, size and
+    modification time'''
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def binning_key(input, refpkg_map, **settings):
+    '''Digest of the input reads (a path, or a list of paths), the contents
+    of the reference package map and the binning settings'''
+    if isinstance(input, str):
+        digest = file_digest(input)
+    else:
+        digest = [file_digest(path) for path in input]
+    description = {"version": CACHE_VERSION,
+                   "input": digest,
+                   "refpkg": file_digest(refpkg_map),
+                   "settings": settings}
+    return hashlib.blake2b(
+        json.dumps(description, sort_keys=True).encode(),
+        digest_size=20).hexdigest()
+
+
+class BinCache(object):
+    '''Binning cache in a directory, with one subdirectory per entry and
+    least recently used entries evicted beyond max_bytes'''
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if not os.access(path, os.W_OK):
+            raise PermissionError("%s is not writable" % path)
+
+    def key(self, input, refpkg_map, **settings):
+        return binning_key(input, refpkg_map, **settings)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        '''Returns the cached (binned_fragments, weights) or None'''
+        entry_file = os.path.join(self._entry_path(key), ENTRY)
+        if not os.path.exists(entry_file):
+            return None
+        with open(entry_file) as f:
+            entry = json.load(f)
+        binned_fragments = {}
+        for (gene, nfrags) in entry["genes"].items():
+            binned_fragments[gene] = {
+                "file": os.path.join(self._entry_path(key),
+                                     gene + ".frags.fas.fixed"),
+                "nfrags": nfrags}
+            if not os.path.exists(binned_fragments[gene]["file"]):
+                return None
+        # Mark as recently used
+        os.utime(entry_file, None)
+        return binned_fragments, entry["weights"]
+
+    def put(self, key, binned_fragments, weights=None, description=None):
+        '''Copies the binned fragment files into the cache, returns the
+        cached binned_fragments'''
+        staging = self._entry_path(key) + ".tmp-%d" % os.getpid()
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        genes = {}
+        for (gene, value) in binned_fragments.items():
+            if value["nfrags"] == 0:
+                continue
+            shutil.copyfile(value["file"], os.path.join(
+                staging, gene + ".frags.fas.fixed"))
+            genes[gene] = value["nfrags"]
+        with open(os.path.join(staging, ENTRY), 'w') as f:
+            json.dump({"genes": genes, "weights": weights,
+                       "description": description,
+                       "created": time.time()}, f)
+        if os.path.exists(self._entry_path(key)):
+            shutil.rmtree(staging)
+        else:
+            os.rename(staging, self._entry_path(key))
+        self.evict(keep=key)
+        return self.get(key)[0]
+
+    def entries(self):
+        '''(key, size in bytes, last used, description) of every entry, the
+        least recently used first'''
+        entries = []
+        for key in os.listdir(self.path):
+            entry_file = os.path.join(self._entry_path(key), ENTRY)
+            if not os.path.exists(entry_file):
+                continue
+            with open(entry_file) as f:
+                description = json.load(f)["description"]
+            size = sum(os.path.getsize(os.path.join(self._entry_path(key), n))
+                       for n in os.listdir(self._entry_path(key)))
+            entries.append((key, size, os.path.getmtime(entry_file),
+                            description))
+        entries.sort(key=lambda x: x[2])
+        return entries
+
+    def remove(self, key):
+        shutil.rmtree(self._entry_path(key), ignore_errors=True)
+
+    def evict(self, keep=None):
+        '''Removes least recently used entries until the cache fits in
+        max_bytes'''
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        for (key, size, _, _) in entries:
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                self.remove(key)
+                total -= size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Lists or purges the TIPP binning cache.')
+    parser.add_argument(
+        "command", choices=["list", "purge"],
+        help="list the entries, or purge them")
+    parser.add_argument(
+        "-c", "--cache",
+        dest="cache", metavar="DIR",
+        required=True,
+        type=str,
+        help="cache directory, as given to run_abundance.py --binCache")
+    parser.add_argument(
+        "--older-than",
+        dest="older_than", metavar="DAYS",
+        default=None,
+        type=float,
+        help="only purge entries not used for DAYS days")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cache = BinCache(args.cache, float("inf"))
+    now = time.time()
+    for (key, size, used, description) in cache.entries():
+        if args.command == "list":
+            print("%s\t%0.1f MB\t%s\t%s" % (
+                key, size / 1e6, time.strftime(
+                    "%Y-%m-%d %H:%M", time.localtime(used)),
+                json.dumps(description, sort_keys=True)))
+        elif args.older_than is None or \
+                now - used > args.older_than * 86400:
+            print("Removing %s" % key)
+            cache.remove(key)
+
+
+if __name__ == '__main__':
+    main()
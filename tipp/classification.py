@@ -0,0 +1,330 @@
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
+from tipp.abundance import fragment_weights
+from tipp.columnar import ColumnWriter, columns_path, \
+    write_taxonomy_dictionary
+'''
+Classification of the fragments of a TIPP classification file (the
+_classification.txt written by run_tipp.py) at placement thresholds.
+
+Created on Oct 17, 2026
+'''
+
+BLOCK_SIZE = 1 << 22
+# Fragments a ClassificationWriter holds in memory
+RUN_SIZE = 1 << 22
+
+HEADER = "fragment\tspecies\tgenus\tfamily\torder\tclass\tphylum\n"
+
+# From the most specific rank to the root, other ranks are ignored
+RANKS = ["species", "genus", "family", "order", "class", "phylum", "root"]
+ROOT = len(RANKS) - 1
+
+# fragment,tax_id,tax_name,...,rank,probability; a tax name may contain
+# commas, so the rank and probability are the last two fields
+_LINE = re.compile(rb"^([^,\n]*),([^,\n]*),[^\n]*,([^,\n]*),([^,\n]*?)\r?$",
+                   re.M)
+
+
+def _rank_codes(ranks):
+    (unique, inverse) = np.unique(ranks, return_inverse=True)
+    codes = np.array([RANKS.index(r) if r in RANKS else -1
+                      for r in unique.astype(str).tolist()], dtype=np.int8)
+    return codes[inverse] if len(unique) else np.array([], dtype=np.int8)
+
+
+class ClassificationTable(object):
+    '''
+    The lines of a classification file as arrays, in file order:
+    fragment (index into names), tax_id (index into tax_ids, the tax ids as
+    written), taxon (index into the taxonomy, -1 if not in it), rank (index
+    into RANKS, -1 for other ranks) and probability.
+    '''
+    def __init__(self, names, fragment, tax_ids, tax_id, taxon, rank,
+                 probability, root):
+        self.names = names
+        self.fragment = fragment
+        self.tax_ids = tax_ids
+        self.tax_id = tax_id
+        self.taxon = taxon
+        self.rank = rank
+        self.probability = probability
+        self.root = root
+
+    @classmethod
+    def read(cls, class_input, taxonomy, block_size=BLOCK_SIZE):
+        rows = []
+        rest = b''
+        with open(class_input, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                block = rest + block
+                end = block.rfind(b'\n') + 1
+                rest = block[end:]
+                rows.extend(_LINE.findall(block[:end]))
+        rows.extend(_LINE.findall(rest))
+        if rows:
+            table = np.array(rows)
+        else:
+            table = np.empty((0, 4), dtype='S1')
+
+        (names, fragment) = np.unique(table[:, 0], return_inverse=True)
+        (tax_ids, tax_id) = np.unique(table[:, 1], return_inverse=True)
+        tax_id = tax_id.astype(np.int64)
+        return cls(np.char.decode(names, 'utf-8'), fragment.astype(np.int64),
+                   tax_ids, tax_id,
+                   taxonomy.index(tax_ids).astype(np.int32)[tax_id],
+                   _rank_codes(table[:, 2]),
+                   table[:, 3].astype(np.float64),
+                   int(taxonomy.index(np.array([b'1']))[0]))
+
+    @classmethod
+    def from_lines(cls, names, fragment, taxa, probability, taxonomy):
+        '''A table of lines given as arrays of fragment (index into names),
+        taxon (index into the taxonomy) and probability'''
+        taxa = np.asarray(taxa, dtype=np.int64)
+        (tax_ids, tax_id) = np.unique(np.asarray(taxonomy.ids)[taxa],
+                                      return_inverse=True)
+        ranks = np.array(taxonomy.ranks + [''])[
+            np.asarray(taxonomy.rank)[taxa]]
+        return cls(np.asarray(names), np.asarray(fragment, dtype=np.int64),
+                   tax_ids, tax_id.astype(np.int64), taxa.astype(np.int32),
+                   _rank_codes(ranks),
+                   np.asarray(probability, dtype=np.float64),
+                   int(taxonomy.index(np.array([b'1']))[0]))
+
+    def with_taxonomy(self, taxonomy):
+        '''The table with its taxa indexing another taxonomy'''
+        return ClassificationTable(
+            self.names, self.fragment, self.tax_ids, self.tax_id,
+            taxonomy.index(self.tax_ids).astype(np.int32)[self.tax_id],
+            self.rank, self.probability,
+            int(taxonomy.index(np.array([b'1']))[0]))
+
+    def classify(self, threshold):
+        '''
+        Taxon of every fragment (aligned with names): the most specific rank
+        with a placement probability above threshold, and at that rank the
+        first placement with the highest probability. Fragments without any
+        are classified at the root.
+        '''
+        n = len(self.names)
+        qualifies = (self.rank >= 0) & (self.rank < ROOT) & \
+            (self.probability > threshold)
+        best_rank = np.full(n, ROOT, dtype=np.int8)
+        np.minimum.at(best_rank, self.fragment[qualifies],
+                      self.rank[qualifies])
+
+        candidates = np.nonzero(
+            (self.rank == best_rank[self.fragment]) & (self.rank < ROOT))[0]
+        order = np.lexsort((candidates, -self.probability[candidates],
+                            self.fragment[candidates]))
+        candidates = candidates[order]
+        fragments = self.fragment[candidates]
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = fragments[1:] != fragments[:-1]
+
+        taxa = np.full(n, self.root, dtype=np.int32)
+        taxa[fragments[first]] = self.taxon[candidates[first]]
+        return taxa
+
+    def split(self, groups, names=None):
+        '''
+        Splits the table by the group of every fragment (aligned with
+        names), keeping the order of lines and names; names, if given,
+        replaces the fragment names. Returns (group, table) pairs by
+        increasing group.
+        '''
+        names = self.names if names is None else np.asarray(names)
+        groups = np.asarray(groups)
+        by_name = np.argsort(groups, kind='stable')
+        by_row = np.argsort(groups[self.fragment], kind='stable')
+        (present, name_counts) = np.unique(groups, return_counts=True)
+        row_counts = np.bincount(
+            np.searchsorted(present, groups[self.fragment]),
+            minlength=len(present))
+        (name_start, row_start) = (0, 0)
+        tables = []
+        for (group, name_count, row_count) in zip(
+                present.tolist(), name_counts.tolist(), row_counts.tolist()):
+            fragments = by_name[name_start:name_start + name_count]
+            rows = by_row[row_start:row_start + row_count]
+            (name_start, row_start) = (name_start + name_count,
+                                       row_start + row_count)
+            tables.append((group, ClassificationTable(
+                names[fragments],
+                np.searchsorted(fragments, self.fragment[rows]),
+                self.tax_ids, self.tax_id[rows], self.taxon[rows],
+                self.rank[rows], self.probability[rows], self.root)))
+        return tables
+
+    def classifications(self, threshold):
+        '''classify as a dict of fragment name -> taxon'''
+        return dict(zip(self.names.tolist(),
+                        self.classify(threshold).tolist()))
+
+
+def write_lineages(f, names, taxa, taxonomy, lineages=None):
+    '''Writes the lineage of every fragment (names as str) to the open file
+    f, in the order given'''
+    if lineages is None:
+        lineages = taxonomy.lineages(taxa)
+    f.write(''.join("%s\n" % "\t".join([name] + lineage) for (name, lineage)
+                    in zip(names, taxonomy.tax_ids(lineages))))
+
+
+def write_classification_columns(columns, taxonomy):
+    '''Completes a columnar classification whose fragments and lineages
+    were appended to the ColumnWriter columns, and closes it'''
+    if "lineage" not in columns.header["columns"]:
+        columns.append_strings("fragment", [])
+        columns.append("lineage", np.empty((0, len(taxonomy.levels)),
+                                           dtype=np.int32))
+    write_taxonomy_dictionary(columns, taxonomy)
+    columns.close()
+
+
+def _encode(names):
+    names = np.asarray(names)
+    if names.dtype.kind == 'U':
+        names = np.char.encode(names, 'utf-8')
+    return names
+
+
+def _last_of_each(names):
+    '''Mask of the last of every run of equal names'''
+    last = np.ones(len(names), dtype=bool)
+    last[:-1] = names[:-1] != names[1:]
+    return last
+
+
+class ClassificationWriter(object):
+    '''
+    Writes a classification file sorted by fragment name (see write_lineages)
+    from fragments added in any order, holding at most run_size of them in
+    memory. Sorted runs spill to temp_dir and are merged when the writer is
+    closed. Of a fragment added more than once, the last classification is
+    kept, and with level set, fragments whose lineage is undefined at level
+    (see remove_unclassified_level) are left out. The fragments written are
+    also added to counts, a LevelCounts, each counting weights[name]. With
+    columnar set, the classification is also written as a columnar output
+    with the given metadata (see tipp.columnar).
+    '''
+    def __init__(self, output, taxonomy, temp_dir, run_size=RUN_SIZE,
+                 level=None, counts=None, weights=None, columnar=False,
+                 metadata=None):
+        self.output = output
+        self.taxonomy = taxonomy
+        self.temp_dir = tempfile.mkdtemp(dir=temp_dir)
+        self.run_size = run_size
+        self.level = level
+        self.counts = counts
+        self.weights = weights
+        self.columnar = columnar
+        self.metadata = metadata
+        self.buffered = []
+        self.size = 0
+        self.runs = []
+
+    def add(self, names, taxa):
+        '''Adds fragments (names as str or UTF-8 bytes) and their taxa'''
+        self.buffered.append((_encode(names),
+                              np.asarray(taxa, dtype=np.int32)))
+        self.size += len(taxa)
+        if self.size >= self.run_size:
+            self._spill()
+
+    def _sorted_buffer(self):
+        if not self.buffered:
+            return None
+        names = np.concatenate([names for (names, _) in self.buffered])
+        taxa = np.concatenate([taxa for (_, taxa) in self.buffered])
+        self.buffered = []
+        self.size = 0
+        order = np.argsort(names, kind='stable')
+        (names, taxa) = (names[order], taxa[order])
+        last = _last_of_each(names)
+        return (names[last], taxa[last])
+
+    def _spill(self):
+        run = self._sorted_buffer()
+        if run is None:
+            return
+        path = os.path.join(self.temp_dir, "run%d" % len(self.runs))
+        np.save(path + ".names.npy", run[0])
+        np.save(path + ".taxa.npy", run[1])
+        self.runs.append(
+            (np.load(path + ".names.npy", mmap_mode='r'),
+             np.load(path + ".taxa.npy", mmap_mode='r')))
+
+    def _merged(self):
+        '''
+        Batches of (names, taxa) of all the runs in order. Every run holds
+        distinct names, so a batch can take from every run everything up to
+        the least of the last names buffered from each.
+        '''
+        runs = self.runs
+        batch = max(1, self.run_size // max(1, len(runs)))
+        start = [0] * len(runs)
+        while any(start[i] < len(runs[i][0]) for i in range(len(runs))):
+            ends = [min(start[i] + batch, len(runs[i][0]))
+                    for i in range(len(runs))]
+            bounds = [runs[i][0][ends[i] - 1] for i in range(len(runs))
+                      if ends[i] < len(runs[i][0])]
+            taken = []
+            for i in range(len(runs)):
+                names = runs[i][0][start[i]:ends[i]]
+                if bounds:
+                    end = np.searchsorted(names, min(bounds), side='right')
+                else:
+                    end = len(names)
+                taken.append(
+                    (names[:end], runs[i][1][start[i]:start[i] + end]))
+                start[i] += end
+            names = np.concatenate([names for (names, _) in taken])
+            taxa = np.concatenate([taxa for (_, taxa) in taken])
+            order = np.argsort(names, kind='stable')
+            (names, taxa) = (names[order], taxa[order])
+            last = _last_of_each(names)
+            yield (names[last], taxa[last])
+
+    def close(self):
+        '''Writes the output, and returns the number of fragments in it'''
+        if self.runs:
+            self._spill()
+            batches = self._merged()
+        else:
+            run = self._sorted_buffer()
+            batches = [] if run is None else [run]
+        columns = None
+        if self.columnar:
+            columns = ColumnWriter(columns_path(self.output),
+                                   "classification", self.metadata)
+        written = 0
+        with open(self.output, 'w') as f:
+            f.write(HEADER)
+            for (names, taxa) in batches:
+                lineages = self.taxonomy.lineages(taxa)
+                if self.level is not None:
+                    keep = lineages[:, self.level - 1] != -1
+                    (names, taxa, lineages) = (
+                        names[keep], taxa[keep], lineages[keep])
+                names = np.char.decode(names, 'utf-8').tolist()
+                write_lineages(f, names, taxa, self.taxonomy, lineages)
+                if columns is not None:
+                    columns.append_strings("fragment", names)
+                    columns.append("lineage", lineages.astype(np.int32))
+                if self.counts is not None:
+                    self.counts.add(lineages,
+                                    fragment_weights(names, self.weights))
+                written += len(names)
+        if columns is not None:
+            write_classification_columns(columns, self.taxonomy)
+        self.runs = []
+        shutil.rmtree(self.temp_dir)
+        return written
@@ -0,0 +1,228 @@
+import json
+import os
+import shutil
+import numpy as np
+from tipp.abundance import UNCLASSIFIED, UNDEFINED
+'''
+Binary columnar outputs of an abundance profile, written next to the TSV
+outputs with --columnar.
+
+A columnar output is a directory <output>.columns holding header.json and
+one raw array per column. The header records the kind of output, the
+metadata of the sample it describes, and the dtype and shape of every
+column, so the columns can be memory-mapped without parsing anything.
+Strings are stored as two columns, <name>.offsets and <name>.bytes (UTF-8),
+the i-th string being bytes[offsets[i]:offsets[i + 1]].
+
+Taxa are integer codes into a dictionary, the string columns tax_ids and
+names. Abundances (kind "abundance" or "distribution") have the columns
+level (index into the levels of the metadata), taxon, and abundance
+(float32), where taxon is UNCLASSIFIED or UNDEFINED for the unclassified
+and '' rows of the TSVs. Classifications (kind "classification") have the
+string column fragment and the column lineage, the taxon of every fragment
+at every level (-1 for NA).
+
+Created on Oct 17, 2026
+'''
+
+SUFFIX = ".columns"
+HEADER = "header.json"
+COLUMNS_VERSION = 1
+
+
+def columns_path(output):
+    return output + SUFFIX
+
+
+class ColumnWriter(object):
+    '''
+    Writes a columnar output to path, in a staging directory renamed into
+    place on close. Columns are written whole or appended to in batches.
+    '''
+    def __init__(self, path, kind, metadata=None):
+        self.path = path
+        self.staging = path + ".tmp-%d" % os.getpid()
+        if os.path.exists(self.staging):
+            shutil.rmtree(self.staging)
+        os.makedirs(self.staging)
+        self.header = {"version": COLUMNS_VERSION, "kind": kind,
+                       "metadata": metadata or {}, "columns": {}}
+        self.files = {}
+        self.string_sizes = {}
+
+    def append(self, column, array):
+        '''Appends rows to column; every batch has the same dtype and row
+        shape'''
+        array = np.ascontiguousarray(array)
+        if array.dtype.byteorder == '>':
+            array = array.astype(array.dtype.newbyteorder('<'))
+        description = self.header["columns"].get(column)
+        if description is None:
+            description = {"dtype": array.dtype.str,
+                           "shape": [0] + list(array.shape[1:])}
+            self.header["columns"][column] = description
+            self.files[column] = open(os.path.join(self.staging, column),
+                                      'wb')
+        elif np.dtype(description["dtype"]) != array.dtype or \
+                description["shape"][1:] != list(array.shape[1:]):
+            raise ValueError("Rows of another type appended to %s" % column)
+        description["shape"][0] += len(array)
+        self.files[column].write(array.tobytes())
+
+    def write(self, column, array):
+        self.append(column, array)
+        self.files.pop(column).close()
+
+    def append_strings(self, column, strings):
+        '''Appends a list of str to the string column'''
+        encoded = [s.encode('utf-8') for s in strings]
+        size = self.string_sizes.get(column)
+        if size is None:
+            size = 0
+            self.append(column + ".offsets", np.zeros(1, dtype=np.int64))
+        lengths = np.fromiter((len(s) for s in encoded), dtype=np.int64,
+                              count=len(encoded))
+        offsets = size + np.cumsum(lengths)
+        self.append(column + ".offsets", offsets)
+        self.append(column + ".bytes",
+                    np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        self.string_sizes[column] = int(offsets[-1]) if len(offsets) \
+            else size
+
+    def write_strings(self, column, strings):
+        self.append_strings(column, strings)
+        for name in (column + ".offsets", column + ".bytes"):
+            self.files.pop(name).close()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.staging, HEADER), 'w') as f:
+            json.dump(self.header, f, indent=1, sort_keys=True)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.staging, self.path)
+
+
+class Columns(object):
+    '''A loaded columnar output: its header, metadata and columns'''
+    def __init__(self, path, header, columns):
+        self.path = path
+        self.header = header
+        self.kind = header["kind"]
+        self.metadata = header["metadata"]
+        self.columns = columns
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def string(self, column, i):
+        offsets = self.columns[column + ".offsets"]
+        return self.columns[column + ".bytes"][
+            offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+    def strings(self, column):
+        '''All the strings of a string column, as a list of str'''
+        offsets = self.columns[column + ".offsets"]
+        table = self.columns[column + ".bytes"].tobytes()
+        return [table[offsets[i]:offsets[i + 1]].decode('utf-8')
+                for i in range(len(offsets) - 1)]
+
+    def clade_keys(self, taxa):
+        '''Tax ids of an array of taxon codes, 'unclassified' and '' for
+        UNCLASSIFIED and UNDEFINED'''
+        tax_ids = np.array(self.strings("tax_ids") + ['unclassified', ''],
+                           dtype=str)
+        taxa = np.asarray(taxa, dtype=np.int64)
+        index = np.where(taxa == UNCLASSIFIED, len(tax_ids) - 2,
+                         np.where(taxa == UNDEFINED, len(tax_ids) - 1, taxa))
+        return tax_ids[index]
+
+
+def load_columns(path, mmap=True):
+    '''Loads the columnar output in path, memory-mapping its columns'''
+    with open(os.path.join(path, HEADER)) as f:
+        header = json.load(f)
+    if header["version"] != COLUMNS_VERSION:
+        raise ValueError("%s was written by another version of TIPP" % path)
+    columns = {}
+    for (column, description) in header["columns"].items():
+        dtype = np.dtype(description["dtype"])
+        shape = tuple(description["shape"])
+        file = os.path.join(path, column)
+        if mmap and int(np.prod(shape)) > 0:
+            columns[column] = np.memmap(file, dtype=dtype, mode='r',
+                                        shape=shape)
+        else:
+            columns[column] = np.fromfile(file, dtype=dtype).reshape(shape)
+    return Columns(path, header, columns)
+
+
+def write_dictionary(writer, taxonomy, taxa, labels=None):
+    '''Writes tax_ids and names of the taxa (indices into the taxonomy),
+    with labels for the taxa not in it'''
+    tax_ids = taxonomy.tax_ids(taxa)
+    if labels is None:
+        labels = tax_ids
+    writer.write_strings("tax_ids", tax_ids)
+    writer.write_strings("names", [
+        taxonomy.name(taxon) if taxon != -1 else label
+        for (taxon, label) in zip(np.asarray(taxa).tolist(), labels)])
+
+
+def write_taxonomy_dictionary(writer, taxonomy):
+    '''Writes tax_ids and names of all the taxa of the taxonomy, so that
+    taxon codes are indices into the taxonomy'''
+    ids = np.asarray(taxonomy.ids)
+    writer.write("tax_ids.offsets", np.concatenate(
+        [[0], np.cumsum(np.char.str_len(ids))]).astype(np.int64))
+    writer.write("tax_ids.bytes",
+                 np.frombuffer(b''.join(ids.tolist()), dtype=np.uint8))
+    writer.write("names.offsets",
+                 np.asarray(taxonomy.name_offsets, dtype=np.int64))
+    writer.write("names.bytes", np.asarray(taxonomy.name_table,
+                                           dtype=np.uint8))
+
+
+def write_abundance_columns(path, kind, levels, clades, abundances,
+                            tax_ids, names, metadata=None):
+    '''
+    Writes an abundance output: clades[level] are codes into the dictionary
+    of tax_ids and names, and abundances[level] their abundances
+    '''
+    writer = ColumnWriter(path, kind, dict(metadata or {}, levels=levels))
+    writer.write("level", np.concatenate(
+        [np.full(len(c), level, dtype=np.int8)
+         for (level, c) in enumerate(clades)]))
+    writer.write("taxon", np.concatenate(
+        [np.asarray(c, dtype=np.int32) for c in clades]))
+    writer.write("abundance", np.concatenate(
+        [np.asarray(a, dtype=np.float32) for a in abundances]))
+    writer.write_strings("tax_ids", tax_ids)
+    writer.write_strings("names", names)
+    writer.close()
+
+
+def abundance_matrix(outputs, level):
+    '''
+    Sample x clade matrix (float32) of the abundances at level (an index
+    into the levels of the headers) of the abundance outputs, loaded or
+    paths. Returns the clade keys of the columns (see Columns.clade_keys),
+    sorted, and the matrix.
+    '''
+    outputs = [load_columns(output) if isinstance(output, str) else output
+               for output in outputs]
+    keys = []
+    for columns in outputs:
+        rows = np.asarray(columns["level"]) == level
+        keys.append((columns.clade_keys(np.asarray(columns["taxon"])[rows]),
+                     np.asarray(columns["abundance"])[rows]))
+    clades = np.unique(np.concatenate(
+        [k for (k, _) in keys] + [np.array([], dtype=str)]))
+    matrix = np.zeros((len(outputs), len(clades)), dtype=np.float32)
+    for (sample, (k, abundance)) in enumerate(keys):
+        matrix[sample, np.searchsorted(clades, k)] = abundance
+    return clades.tolist(), matrix
@@ -2,13 +2,15 @@ from sepp.exhaustive import ExhaustiveAlgorithm, JoinAlignJobs
 from sepp.exhaustive import get_placement_job_name
 import sepp
 import os
+import re
 import stat
-import math
+import sys
+import tempfile
+import numpy as np
 from sepp.config import options
 import argparse
 import json
 from sepp.algorithm import AbstractAlgorithm
-from sepp.alignment import MutableAlignment, ExtendedAlignment
 from sepp.jobs import HMMBuildJob, HMMSearchJob, HMMAlignJob, PplacerJob,\
     ExternalSeppJob
 from sepp.problem import SeppProblem, RootProblem
@@ -16,12 +18,25 @@ from sepp.scheduler import JobPool, Join
 from sepp.tree import PhylogeneticTree
 from dendropy.datamodel.treemodel import Tree
 import dendropy
-import pickle
 from sepp import get_logger
-from functools import reduce
+from tipp.hmmer import read_tblout
+from tipp.columnar import columns_path
+from tipp.extended_alignment import write_extended_alignment, \
+    merge_extended_alignments
+from tipp.placement import PlacementClassifier
+from tipp.assignment import assign_fragments, FragmentAssignment, \
+    AssignedFragments
 
 _LOG = get_logger(__name__)
 
+# The main tree of a merge input directory
+MAIN_TREE = "main.tree"
+# Paths the json merger cannot read a merge input directory from
+MERGE_INPUT = re.compile("json|jplace")
+# The parser of run_tipp.py for runs in this process: sepp's options and the
+# TIPP options, apart from the parser of the caller
+_tipp_parser = None
+
 
 class TIPPJoinSearchJobs(Join):
     """
@@ -45,67 +60,67 @@ class TIPPJoinSearchJobs(Join):
         # checkpoining scenarios (join already done before!)
         if "fragments.distribution.done" in self.root_problem.annotations:
             return
-        bitscores = dict([(name, []) for name in list(
-            self.root_problem.fragments.keys())])
+        fragment_names = list(self.root_problem.fragments.keys())
+        fragment_index = np.array(fragment_names, dtype='S')
+        by_name = np.argsort(fragment_index, kind='stable')
+        sorted_names = fragment_index[by_name]
+
+        # Collect all the hits, in the order they were found, as arrays of
+        # fragment and subset indices and bit scores
+        subsets = []
+        subset_index = {}
+        (fragments, hit_subsets, scores) = ([], [], [])
         for fragment_chunk_problem in self.root_problem.iter_leaves():
             align_problem = fragment_chunk_problem.get_parent()
             assert isinstance(align_problem, SeppProblem)
             '''For each subproblem start with an empty set of fragments,
             and add to them as we encounter new best hits for that
             subproblem'''
-            if align_problem.fragments is None:
-                align_problem.fragments = MutableAlignment()
-            search_res = fragment_chunk_problem.get_job_result_by_name(
-                "hmmsearch")
-            for key in list(search_res.keys()):
-                ''' keep a list of all hits, and their bit scores'''
-                bitscores[key].append((search_res[key][1], align_problem))
-
-        for frag, tuplelist in bitscores.items():
-            ''' TODO: what to do with those that are not? For now, only output
-                warning message'''
-            # TODO:  Need to double check and fix the math
-            _LOG.warning("Fragment %s is not scored against any subset" %
-                         str(frag))
-            if len(tuplelist) == 0:
-                _LOG.warning("Fragment %s is not scored against any subset" %
-                             str(frag))
-                continue
-            ''' convert bit scores to probabilities '''
-            denum = sum(math.pow(2, min(x[0], 1022)) for x in tuplelist)
-            # _LOG.warning("Tuples: %s" %str(tuplelist))
-            tuplelist = [
-                ((math.pow(2, min(x[0], 1022)) / denum * 1000000), x[1])
-                for x in tuplelist]
-            ''' Sort subsets by their probability'''
-            tuplelist.sort(reverse=True, key=lambda x: x[0])
-            ''' Find enough subsets to reach the threshold '''
-            selected = tuplelist[
-                0: max(1, reduce(
-                    lambda x, y: (x[0], None)
-                    if x[1] is None else
-                    (y[0], x[1] + y[1]) if x[1] < int(
-                        1000000 * self.alignment_threshold) else
-                    (y[0], None),
-                    enumerate([x[0] for x in tuplelist]))[0])]
-
-            ''' Renormalize the selected list to add up to 1'''
-            renorm = 0
-            for (prob, align_problem) in selected:
-                renorm = renorm + prob / 1000000
-            renorm = 1 / renorm
-
-            _LOG.debug("Fragment %s assigned to %d subsets" %
-                       (frag, len(selected)))
-            ''' Rename the fragment and assign it to the respective subsets'''
-            for (prob, align_problem) in selected:
-                postfix = prob * renorm if \
-                    options().exhaustive.weight_placement_by_alignment.\
-                    lower() == "true" \
-                    else 1000000
-                frag_rename = "%s_%s_%d" % (frag, align_problem.label, postfix)
-                align_problem.fragments[frag_rename] = \
-                    self.root_problem.fragments[frag]
+            if id(align_problem) not in subset_index:
+                subset_index[id(align_problem)] = len(subsets)
+                subsets.append(align_problem)
+            (names, _, bitscores) = \
+                fragment_chunk_problem.get_job_result_by_name("hmmsearch")
+            position = np.minimum(np.searchsorted(sorted_names, names),
+                                  len(sorted_names) - 1)
+            unknown = sorted_names[position] != names
+            if np.any(unknown):
+                raise KeyError(names[unknown][0].decode())
+            fragments.append(by_name[position])
+            hit_subsets.append(np.full(len(names),
+                                       subset_index[id(align_problem)]))
+            scores.append(bitscores)
+
+        (fragment, subset, weight) = assign_fragments(
+            np.concatenate(fragments + [np.zeros(0, dtype=np.int64)]),
+            np.concatenate(hit_subsets + [np.zeros(0, dtype=np.int64)]),
+            np.concatenate(scores + [np.zeros(0)]),
+            self.alignment_threshold)
+
+        ''' TODO: what to do with those that are not? For now, only output
+            warning message'''
+        assigned = np.unique(fragment)
+        if len(assigned) < len(fragment_names):
+            _LOG.warning("%d of %d fragments are not scored against any"
+                         " subset" % (len(fragment_names) - len(assigned),
+                                      len(fragment_names)))
+        _LOG.info("Assigned %d fragments to %d subsets, %d of them to more"
+                  " than one" % (len(assigned), len(subsets),
+                                 np.count_nonzero(
+                                     np.bincount(fragment) > 1)))
+
+        ''' Every subproblem sees its fragments under their copy names,
+            fragment_label_weight, through a view of the assignment table
+            over the fragments of the root problem'''
+        assignment = FragmentAssignment(
+            fragment_names, fragment, subset, weight,
+            [align_problem.label for align_problem in subsets],
+            options().exhaustive.weight_placement_by_alignment.lower() ==
+            "true")
+        for (i, align_problem) in enumerate(subsets):
+            align_problem.fragments = AssignedFragments(
+                assignment, self.root_problem.fragments, assignment.rows(i))
+        self.root_problem.annotations["fragments.assignment"] = assignment
 
         self.root_problem.annotations["fragments.distribution.done"] = 1
 
@@ -208,9 +223,9 @@ class TIPPJoinAlignJobs(JoinAlignJobs):
             # fullExtendedAlignment)
 
             # TODO: Removed this, as it can cause unexpected lockups
-            output = open(pj.full_extended_alignment_file, 'wb')
-            pickle.dump(fullExtendedAlignment, output)
-            output.close()
+            write_extended_alignment(
+                columns_path(pj.full_extended_alignment_file),
+                fullExtendedAlignment)
 
             # Enqueue the placement job
             JobPool().enqueue_job(pj)
@@ -219,6 +234,81 @@ class TIPPJoinAlignJobs(JoinAlignJobs):
         return "join align jobs for tips of ", self.placement_problem
 
 
+class TIPPHMMSearchJob(HMMSearchJob):
+    """
+    An hmmsearch job that also writes the per-target table (--tblout), and
+    reads its results from that table as arrays of fragment names, E-values
+    and bit scores instead of parsing the report. The table is removed once
+    read.
+    """
+    def get_invocation(self):
+        invoc = HMMSearchJob.get_invocation(self)
+        invoc[1:1] = ["--tblout", self.tblout_file()]
+        return invoc
+
+    def tblout_file(self):
+        return self.outfile + ".tblout"
+
+    def read_results(self):
+        if self.fake_run:
+            # No hits, as HMMSearchJob
+            return read_tblout(os.devnull)
+        assert os.path.exists(self.tblout_file())
+        results = read_tblout(self.tblout_file())
+        os.remove(self.tblout_file())
+        return results
+
+
+def write_merge_input(directory, main_tree, subsets):
+    """
+    Writes the input of the json merger to a directory, as the merger reads
+    it: the main tree in MAIN_TREE, and for every placement output, a link
+    to it named <name>.json next to a link <name>.labeled.tree to the tree
+    of its subset, so that every subset tree is written once. subsets are
+    pairs of a subset tree and its placement outputs.
+
+    The merger finds the tree of a placement output by replacing json in its
+    path, so the path of directory must not match MERGE_INPUT.
+    """
+    with open(os.path.join(directory, MAIN_TREE), 'w') as f:
+        f.write("%s\n" % main_tree)
+    for (i, (tree, placements)) in enumerate(subsets):
+        if not placements:
+            continue
+        tree_file = "subset%d.tree" % i
+        with open(os.path.join(directory, tree_file), 'w') as f:
+            f.write("%s\n" % tree)
+        for (j, placement) in enumerate(placements):
+            name = os.path.join(directory, "subset%d.%d" % (i, j))
+            os.symlink(os.path.abspath(placement), name + ".json")
+            os.symlink(tree_file, name + ".labeled.tree")
+
+
+def merge_input_string(main_tree, subsets):
+    """The input of write_merge_input as the merger reads it from stdin"""
+    mergeinput = [main_tree]
+    for (tree, placements) in subsets:
+        mergeinput.extend("%s\n%s" % (tree, placement)
+                          for placement in placements)
+    mergeinput.append("")
+    mergeinput.append("")
+    return "\n".join(mergeinput)
+
+
+def merge_input(temp_dir, main_tree, subsets):
+    """
+    The input of the json merger, as (stdin data, input directory): written
+    to a new directory under temp_dir (see write_merge_input), or as stdin
+    data when the path of that directory matches MERGE_INPUT.
+    """
+    directory = tempfile.mkdtemp(prefix="merge_input.", dir=temp_dir)
+    if MERGE_INPUT.search(os.path.abspath(directory)):
+        os.rmdir(directory)
+        return merge_input_string(main_tree, subsets), None
+    write_merge_input(directory, main_tree, subsets)
+    return None, directory
+
+
 class TIPPMergeJsonJob(ExternalSeppJob):
     def __init__(self, **kwargs):
         self.job_type = 'jsonmerger'
@@ -247,6 +337,7 @@ class TIPPMergeJsonJob(ExternalSeppJob):
         self.placer = options().exhaustive.__dict__['placer'].lower()
         self.cutoff = 0
         self.push_down = False
+        self.input_directory = None
 
     def setup(self, in_string, output_file, **kwargs):
         self.stdindata = in_string
@@ -255,8 +346,10 @@ class TIPPMergeJsonJob(ExternalSeppJob):
 
     def setup_for_tipp(self, in_string, output_file, taxonomy, mapping,
                        threshold, classification_file, push_down,
-                       distribution=False, cutoff=0, **kwargs):
+                       distribution=False, cutoff=0, input_directory=None,
+                       **kwargs):
         self.stdindata = in_string
+        self.input_directory = input_directory
         self.out_file = output_file
         self.taxonomy = taxonomy.name
         self.mapping = mapping.name
@@ -268,7 +361,13 @@ class TIPPMergeJsonJob(ExternalSeppJob):
         self.cutoff = cutoff
 
     def get_invocation(self):
-        invoc = ["java", "-jar", self.path, "-", "-", self.out_file, "-r", "4"]
+        if self.input_directory is not None:
+            inputs = [self.input_directory,
+                      os.path.join(self.input_directory, MAIN_TREE)]
+        else:
+            inputs = ["-", "-"]
+        invoc = ["java", "-jar", self.path] + inputs + [
+            self.out_file, "-r", "4"]
         if self.taxonomy is not None:
             invoc.extend(["-t", self.taxonomy])
         if self.mapping is not None:
@@ -286,6 +385,9 @@ class TIPPMergeJsonJob(ExternalSeppJob):
         return invoc
 
     def characterize_input(self):
+        if self.input_directory is not None:
+            return "input:%s output:%s" % (self.input_directory,
+                                           self.out_file)
         return "input:pipe output:%s; Pipe:\n%s" % (
             self.out_file, self.stdindata)
 
@@ -312,49 +414,58 @@ class TIPPExhaustiveAlgorithm(ExhaustiveAlgorithm):
         self.alignment_threshold = self.options.alignment_threshold
         self.placer = self.options.exhaustive.placer.lower()
         self.push_down = True if self.options.push_down is True else False
+        self.classification = None
         _LOG.info("Will push fragments %s from their placement edge." % (
             "down" if self.push_down else "up"))
 
     def merge_results(self):
         assert isinstance(self.root_problem, RootProblem)
 
-        '''Generate single extended alignment'''
-        fullExtendedAlignment = ExtendedAlignment(
-            self.root_problem.fragments.keys())
-        # self.root_problem.get_children()[0].jobs[get_placement_job_name(0)]\
-        # .get_attribute("full_extended_alignment_object")
-        for pp in self.root_problem.get_children():
-            for i in range(0, self.root_problem.fragment_chunks):
-                align_input = open(
-                    pp.jobs[get_placement_job_name(i)]
-                    .full_extended_alignment_file, 'rb')
-                extended_alignment = pickle.load(align_input)
-                align_input.close()
-                fullExtendedAlignment.merge_in(
-                    extended_alignment, convert_to_string=True)
-        self.results = fullExtendedAlignment
-
-        mergeinput = []
-        '''Append main tree to merge input'''
-        mergeinput.append("%s;" % (
-            self.root_problem.subtree.compose_newick(labels=True)))
-        for pp in self.root_problem.get_children():
-            assert isinstance(pp, SeppProblem)
-            for i in range(0, self.root_problem.fragment_chunks):
-                if (pp.get_job_result_by_name(
-                       get_placement_job_name(i)) is None):
-                    continue
-                '''Append subset trees and json locations to merge input'''
-                mergeinput.append(
-                    "%s;\n%s" % (
-                        pp.subtree.compose_newick(labels=True),
-                        pp.get_job_result_by_name(get_placement_job_name(i))))
-        mergeinput.append("")
-        mergeinput.append("")
-        meregeinputstring = "\n".join(mergeinput)
-        merge_json_job = self.get_merge_job(meregeinputstring)
+        '''The single extended alignment is merged from the extended
+        alignments on disk when the results are written'''
+        self.results = [
+            columns_path(pp.jobs[get_placement_job_name(i)]
+                         .full_extended_alignment_file)
+            for pp in self.root_problem.get_children()
+            for i in range(0, self.root_problem.fragment_chunks)]
+
+        '''Write the main tree, subset trees and json locations to the
+        merge input'''
+        main_tree = "%s;" % (
+            self.root_problem.subtree.compose_newick(labels=True))
+        subsets = (
+            ("%s;" % pp.subtree.compose_newick(labels=True),
+             [pp.get_job_result_by_name(get_placement_job_name(i))
+              for i in range(0, self.root_problem.fragment_chunks)
+              if pp.get_job_result_by_name(
+                  get_placement_job_name(i)) is not None])
+            for pp in self.root_problem.get_children())
+        if self.options.classification_backend == "python":
+            '''Classify in this process instead of with the merger'''
+            classifier = PlacementClassifier(
+                main_tree, self.options.taxonomy_file.name,
+                self.options.taxonomy_name_mapping_file.name, self.push_down,
+                self.options.placement_threshold, self.options.distribution,
+                self.options.cutoff)
+            self.classification = classifier.classify(
+                subsets,
+                self.root_problem.annotations["fragments.assignment"],
+                self.get_output_filename("placement.json"),
+                self.get_output_filename("classification.txt"))
+            return
+        (stdin_data, input_directory) = merge_input(
+            options().tempdir, main_tree, subsets)
+        merge_json_job = self.get_merge_job(
+            stdin_data, input_directory=input_directory)
         merge_json_job.run()
 
+    def output_results(self):
+        ''' Merged json file is already saved in merge_results function,
+            the full extended alignment is merged here'''
+        merge_extended_alignments(
+            self.results, self.get_output_filename("alignment.fasta"),
+            self.get_output_filename("alignment_masked.fasta"))
+
     def check_options(self, supply=[]):
         if options().reference_pkg is not None:
             self.load_reference(
@@ -396,7 +507,7 @@ class TIPPExhaustiveAlgorithm(ExhaustiveAlgorithm):
                 alg_problem.add_job(bj.job_type, bj)
                 ''' create the search jobs'''
                 for fc_problem in alg_problem.get_children():
-                    sj = HMMSearchJob()
+                    sj = TIPPHMMSearchJob()
                     sj.partial_setup_for_subproblem(
                         fc_problem.fragments, fc_problem, self.elim,
                         self.filters)
@@ -455,7 +566,7 @@ class TIPPExhaustiveAlgorithm(ExhaustiveAlgorithm):
         # rooted according to the taxonomy.")
         return alignment, tree
 
-    def get_merge_job(self, meregeinputstring):
+    def get_merge_job(self, meregeinputstring, input_directory=None):
         merge_json_job = TIPPMergeJsonJob()
         merge_json_job.setup_for_tipp(
             meregeinputstring,
@@ -466,7 +577,8 @@ class TIPPExhaustiveAlgorithm(ExhaustiveAlgorithm):
             self.get_output_filename("classification.txt"),
             self.push_down,
             self.options.distribution,
-            self.options.cutoff)
+            self.options.cutoff,
+            input_directory=input_directory)
         return merge_json_job
 
     def get_alignment_decomposition_tree(self, p_tree):
@@ -573,11 +685,46 @@ def augment_parser():
              " distribution. "
              "This should be a number between 0 and 1 [default: 0.0]")
 
+    tippGroup.add_argument(
+        "-cb", "--classificationBackend", type=str,
+        dest="classification_backend", metavar="BACKEND",
+        choices=["java", "python"], default="java",
+        help="Classify the placements with the json merger (java) or in"
+             " this process (python) [default: java]")
+
 
 def main():
     augment_parser()
     TIPPExhaustiveAlgorithm().run()
 
 
+def run(args):
+    """
+    Runs TIPP in this process on run_tipp.py command line arguments, so that
+    a caller placing many small inputs (e.g. the markers of an abundance
+    profile) keeps its interpreter, imports and job pool across runs. The
+    caller's options and parser are restored afterwards. The runs parse
+    their arguments against a parser of their own, made once, so that the
+    TIPP options never replace the options of the caller.
+    Returns the classification as a ClassificationTable with the python
+    classification backend, None otherwise.
+    """
+    global _tipp_parser
+    saved = (sepp.config._options_singelton, sepp.config._parser, sys.argv)
+    sepp.config._options_singelton = None
+    sepp.config._parser = _tipp_parser
+    sys.argv = ["run_tipp.py"] + list(args)
+    try:
+        if _tipp_parser is None:
+            augment_parser()
+            _tipp_parser = sepp.config.get_parser()
+        algorithm = TIPPExhaustiveAlgorithm()
+        algorithm.run()
+        return algorithm.classification
+    finally:
+        (sepp.config._options_singelton, sepp.config._parser,
+         sys.argv) = saved
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,142 @@
+import numpy as np
+from tipp.columnar import ColumnWriter, load_columns
+'''
+Extended alignments on disk, and their merge into the full extended
+alignment without holding it in memory.
+
+An extended alignment is written as a columnar output (see tipp.columnar)
+of kind "extended_alignment" with the string column names, the column rows,
+one fixed width uint8 row per sequence, and the column labels, the label of
+every alignment column as in ExtendedAlignment.col_labels: the backbone
+column for original columns, negative for insertion columns.
+
+Created on Oct 17, 2026
+'''
+
+INSERTION = -1
+GAP = ord('-')
+# Rows merged at a time
+BATCH_SIZE = 1 << 12
+
+
+def _encode(sequence):
+    if isinstance(sequence, str):
+        return sequence.encode('ascii')
+    return bytes(sequence)
+
+
+def write_extended_alignment(path, alignment):
+    '''Writes an ExtendedAlignment (or any alignment with col_labels) to the
+    columnar output path'''
+    names = list(alignment.keys())
+    rows = [_encode(alignment[name]) for name in names]
+    width = len(rows[0]) if rows else 0
+    if any(len(row) != width for row in rows):
+        raise ValueError("Rows of an extended alignment differ in length")
+    writer = ColumnWriter(path, "extended_alignment")
+    writer.write_strings("names", names)
+    writer.write("rows", np.frombuffer(b''.join(rows), dtype=np.uint8)
+                 .reshape(len(rows), width))
+    writer.write("labels", np.asarray(
+        list(alignment.col_labels)[:width], dtype=np.int64))
+    writer.close()
+
+
+def merge_labels(mine, hers):
+    '''
+    Column layout of the merge of two extended alignments with column labels
+    mine and hers, as ExtendedAlignment.merge_in does it: original columns
+    with the same label are merged, the others are kept in label order, and
+    runs of insertion columns that meet are merged column by column.
+
+    Returns the merged labels (INSERTION for insertion columns), and the
+    positions of the columns of mine and of hers in them.
+    '''
+    (me, she) = (0, 0)
+    merged = []
+    my_columns = np.zeros(len(mine), dtype=np.int64)
+    her_columns = np.zeros(len(hers), dtype=np.int64)
+    while me < len(mine) or she < len(hers):
+        my_insertion = me < len(mine) and mine[me] < 0
+        her_insertion = she < len(hers) and hers[she] < 0
+        if her_insertion and my_insertion:
+            # Both have a run of insertion columns
+            my_columns[me] = her_columns[she] = len(merged)
+            merged.append(INSERTION)
+            (me, she) = (me + 1, she + 1)
+        elif her_insertion:
+            her_columns[she] = len(merged)
+            merged.append(INSERTION)
+            she += 1
+        elif my_insertion:
+            my_columns[me] = len(merged)
+            merged.append(INSERTION)
+            me += 1
+        elif she == len(hers) or (me < len(mine) and mine[me] < hers[she]):
+            # Mine is not in hers (it was all gaps there)
+            my_columns[me] = len(merged)
+            merged.append(mine[me])
+            me += 1
+        elif me == len(mine) or mine[me] > hers[she]:
+            her_columns[she] = len(merged)
+            merged.append(hers[she])
+            she += 1
+        else:
+            # A shared column
+            my_columns[me] = her_columns[she] = len(merged)
+            merged.append(mine[me])
+            (me, she) = (me + 1, she + 1)
+    return merged, my_columns, her_columns
+
+
+def merge_extended_alignments(paths, output, masked_output=None,
+                              batch_size=BATCH_SIZE):
+    '''
+    Merges the extended alignments written to paths, in order, as merging
+    each of them into an empty ExtendedAlignment would, and writes the
+    result to the FASTA file output, and without its insertion columns to
+    masked_output. Of a sequence in more than one alignment, the first row
+    is kept. The column layout is merged first from the labels alone, then
+    the memory-mapped rows are written batch by batch in their final
+    columns.
+    '''
+    alignments = [load_columns(path) for path in paths]
+    alignments = [a for a in alignments if a["rows"].shape[0] > 0]
+    labels = []
+    positions = []
+    for alignment in alignments:
+        (labels, mine, hers) = merge_labels(
+            labels, np.asarray(alignment["labels"]).tolist())
+        positions = [mine[p] for p in positions] + [hers]
+    labels = np.asarray(labels, dtype=np.int64)
+    original = np.nonzero(labels >= 0)[0]
+
+    seen = set()
+    masked = open(masked_output, 'wb') if masked_output else None
+    try:
+        with open(output, 'wb') as f:
+            for (alignment, columns) in zip(alignments, positions):
+                names = alignment.strings("names")
+                rows = alignment["rows"]
+                for start in range(0, len(names), batch_size):
+                    batch = [(i, name.encode('utf-8')) for (i, name) in
+                             enumerate(names[start:start + batch_size],
+                                       start) if name not in seen]
+                    seen.update(names[start:start + batch_size])
+                    if not batch:
+                        continue
+                    merged = np.full((len(batch), len(labels)), GAP,
+                                     dtype=np.uint8)
+                    merged[:, columns] = rows[[i for (i, _) in batch]]
+                    _write_fasta(f, [name for (_, name) in batch], merged)
+                    if masked is not None:
+                        _write_fasta(masked, [name for (_, name) in batch],
+                                     merged[:, original])
+    finally:
+        if masked is not None:
+            masked.close()
+
+
+def _write_fasta(f, names, rows):
+    f.write(b''.join(b">%s\n%s\n" % (name, row.tobytes())
+                     for (name, row) in zip(names, rows)))
@@ -0,0 +1,139 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from tipp.reads import reverse_complement
+'''
+HMMER based binning of reads to marker genes.
+
+Created on Oct 17, 2026
+'''
+
+BLOCK_SIZE = 1 << 22
+
+# Target name, then E-value and score of the full sequence (the fifth and
+# sixth columns) of the --tblout table; comment lines start with '#'
+_TBLOUT_ROW = re.compile(
+    rb"^([^#\s]\S*)[ \t]+\S+[ \t]+\S+[ \t]+\S+[ \t]+(\S+)[ \t]+(\S+)",
+    re.M)
+
+
+def hmmsearch_command(hmmsearch, hmm, fragments, output, cpus):
+    return [hmmsearch, "--noali", "-E", "10000",
+            "--cpu", "%d" % cpus,
+            "-o", os.devnull, "--tblout", output,
+            hmm, fragments]
+
+
+def _parse_tblout(data):
+    rows = _TBLOUT_ROW.findall(data)
+    if not rows:
+        return (np.array([], dtype='S1'), np.array([], dtype=np.float64),
+                np.array([], dtype=np.float64))
+    table = np.array(rows)
+    return (table[:, 0], table[:, 1].astype(np.float64),
+            table[:, 2].astype(np.float64))
+
+
+def read_tblout(path, block_size=BLOCK_SIZE):
+    '''
+    Reads the per-target table of hmmsearch (--tblout) into arrays of
+    fragment names (bytes), E-values and bit scores, in the order of the
+    table.
+    '''
+    parts = []
+    rest = b''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            parts.append(_parse_tblout(block[:end]))
+    parts.append(_parse_tblout(rest))
+    return tuple(np.concatenate([part[i] for part in parts])
+                 for i in range(3))
+
+
+def search_markers(hmmsearch, fragments, hmms, temp_dir, cpus):
+    '''
+    Searches the fragments against the HMM of every marker (a dict of
+    gene -> HMM file), running as many hmmsearch processes at once as fit
+    in cpus and splitting the cores between them. Yields (gene, --tblout
+    file) as the searches finish.
+    '''
+    jobs = max(1, min(len(hmms), cpus))
+    threads = max(1, cpus // jobs)
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = {}
+        for (gene, hmm) in hmms.items():
+            output = temp_dir + '/' + gene + ".tblout"
+            cmd = hmmsearch_command(hmmsearch, hmm, fragments, output,
+                                    threads)
+            print(" ".join(cmd))
+            futures[pool.submit(subprocess.call, cmd)] = (gene, output)
+        for future in as_completed(futures):
+            (gene, output) = futures[future]
+            if future.result() != 0:
+                raise RuntimeError("hmmsearch failed on marker %s" % gene)
+            yield gene, output
+
+
+def write_search_fragments(reads, path):
+    '''Writes every read and its reverse complement (named <read>_rev) as
+    FASTA to path, a batch at a time'''
+    with open(path, 'wb') as fp:
+        for batch in reads.batches():
+            fp.write(b''.join(
+                b'>%s\n%s\n>%s_rev\n%s\n' % (
+                    header, seq, header, reverse_complement(seq))
+                for (header, seq) in batch))
+
+
+def merge_hits(frag_scores, gene, names, bitscores, order):
+    '''
+    Merges the hits of one marker into frag_scores, the best
+    [bitscore, gene, direction] of every read keyed by its name (bytes).
+    Equal bitscores go to the marker that comes first in order (gene ->
+    rank), so the result does not depend on the order markers are merged.
+    '''
+    for (name, bitscore) in zip(names.tolist(), bitscores.tolist()):
+        direction = 'forward'
+        true_name = name
+        if name.endswith(b'_rev'):
+            true_name = name[:-4]
+            direction = 'reverse'
+        best = frag_scores.get(true_name)
+        if best is None or best[0] < bitscore or \
+                (best[0] == bitscore and order[gene] < order[best[1]]):
+            frag_scores[true_name] = [bitscore, gene, direction]
+
+
+def write_bins(reads, frag_scores, temp_dir):
+    '''
+    Writes every read with a hit to the fragment file of its best marker,
+    in the orientation of its best hit. Returns binned_fragments.
+    '''
+    binned_fragments = {}
+    files = {}
+    for batch in reads.batches():
+        for (header, seq) in batch:
+            if header not in frag_scores:
+                continue
+            (_, gene, direction) = frag_scores[header]
+            if gene not in files:
+                binned_fragments[gene] = {}
+                binned_fragments[gene]["file"] = temp_dir + '/' + gene \
+                    + ".frags.fas.fixed"
+                binned_fragments[gene]["nfrags"] = 0
+                files[gene] = open(binned_fragments[gene]["file"], 'wb')
+            if direction == 'reverse':
+                seq = reverse_complement(seq)
+            files[gene].write(b'>%s\n%s\n' % (header, seq))
+            binned_fragments[gene]["nfrags"] += 1
+    for fp in files.values():
+        fp.close()
+    return binned_fragments
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import shutil
+from tipp.cache import file_digest
+'''
+Run manifest of an abundance profile, kept in the output directory so that
+a restarted run can pick up where the last one stopped.
+
+The manifest records the binned fragments of the run, kept next to it in
+binned/, and every marker whose TIPP run finished, each with digests of its
+inputs and outputs. Nothing is reused unless its digests still match.
+
+Created on Oct 17, 2026
+'''
+
+MANIFEST = "manifest.json"
+BINNED = "binned"
+MANIFEST_VERSION = 1
+
+
+def settings_digest(*settings):
+    return hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(),
+                           digest_size=20).hexdigest()
+
+
+class RunManifest(object):
+    '''
+    Manifest of the run in output_directory for the binning described by
+    key. A manifest left by a run with another key is discarded, and so is
+    any earlier manifest unless resume is set.
+    '''
+    def __init__(self, output_directory, key, resume=True):
+        self.path = os.path.join(output_directory, MANIFEST)
+        self.key = key
+        self.entry = {"version": MANIFEST_VERSION, "key": key,
+                      "binning": None, "markers": {}}
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        if resume and os.path.exists(self.path):
+            with open(self.path) as f:
+                entry = json.load(f)
+            if entry.get("version") == MANIFEST_VERSION and \
+                    entry.get("key") == key:
+                self.entry = entry
+
+    def save(self):
+        staging = self.path + ".tmp-%d" % os.getpid()
+        with open(staging, 'w') as f:
+            json.dump(self.entry, f, indent=1, sort_keys=True)
+        os.replace(staging, self.path)
+
+    @staticmethod
+    def _intact(files):
+        return all(os.path.exists(path) and file_digest(path) == digest
+                   for (path, digest) in files.items())
+
+    def binning(self):
+        '''The recorded (binned_fragments, weights), or None if there is
+        none or its fragment files changed'''
+        binning = self.entry["binning"]
+        if binning is None:
+            return None
+        files = dict((value["file"], value["digest"])
+                     for value in binning["genes"].values())
+        if not self._intact(files):
+            return None
+        binned_fragments = dict(
+            (gene, {"file": value["file"], "nfrags": value["nfrags"]})
+            for (gene, value) in binning["genes"].items())
+        return binned_fragments, binning["weights"]
+
+    def set_binning(self, binned_fragments, weights, move=False):
+        '''Records the binning, with its fragment files copied (or moved
+        with move set) to binned/ next to the manifest, so that it outlives
+        the temporary files of the run. Returns the binned_fragments in
+        binned/'''
+        binned = os.path.join(os.path.dirname(self.path), BINNED)
+        if not os.path.exists(binned):
+            os.makedirs(binned)
+        genes = {}
+        kept = {}
+        for (gene, value) in binned_fragments.items():
+            if value["nfrags"] == 0:
+                continue
+            path = os.path.join(binned, gene + ".frags.fas.fixed")
+            if move:
+                shutil.move(value["file"], path)
+            else:
+                shutil.copyfile(value["file"], path)
+            genes[gene] = {"file": path, "nfrags": value["nfrags"],
+                           "digest": file_digest(path)}
+            kept[gene] = {"file": path, "nfrags": value["nfrags"]}
+        self.entry["binning"] = {"genes": genes, "weights": weights}
+        # Markers placed from other fragments have to run again
+        self.entry["markers"] = {}
+        self.save()
+        return kept
+
+    def marker_key(self, fragment_file, settings):
+        '''Digest of a marker's fragments and placement settings'''
+        return settings_digest(file_digest(fragment_file), settings)
+
+    def done(self, gene, key):
+        '''Whether gene finished with the inputs of key, and its outputs are
+        unchanged since'''
+        marker = self.entry["markers"].get(gene)
+        return marker is not None and marker["key"] == key and \
+            self._intact(marker["outputs"])
+
+    def set_done(self, gene, key, outputs):
+        '''Records gene as finished, with the digests of its existing
+        outputs'''
+        self.entry["markers"][gene] = {
+            "key": key,
+            "outputs": dict((path, file_digest(path)) for path in outputs
+                            if os.path.exists(path))}
+        self.save()
+
+    def forget(self, gene):
+        if self.entry["markers"].pop(gene, None) is not None:
+            self.save()
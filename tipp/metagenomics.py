@@ -1,12 +1,28 @@
-import gzip
 import os
+import shutil
+import subprocess
 import sys
 import tempfile
-import re
+import numpy as np
 import sepp
-from sepp.alignment import MutableAlignment
-from sepp.alignment import _write_fasta
 from sepp.config import options
+from tipp.reads import open_reads, dereplicate, reverse_complement, \
+    TaggedReads
+from tipp.cache import BinCache, file_digest, file_stamp
+from tipp.manifest import RunManifest, settings_digest
+from tipp.refpkg import MAP_FILE, read_refpkg_map, read_size, load_index
+from tipp.taxonomy import Taxonomy
+from tipp.classification import ClassificationTable, ClassificationWriter, \
+    HEADER, RUN_SIZE, write_lineages, write_classification_columns
+from tipp.columnar import ColumnWriter, columns_path, write_abundance_columns
+from tipp.abundance import LevelCounts, DistributionCounts, \
+    fragment_weights, UNCLASSIFIED, UNDEFINED
+from tipp.hmmer import search_markers, read_tblout, \
+    write_search_fragments, merge_hits, write_bins
+from tipp.exhaustive_tipp import run as run_tipp_in_process
+from tipp.schedule import allocate_cores, longest_first, run_scheduled
+from tipp.binning import FragmentBinner, BlastHitTable, blastn_command, \
+    read_marker_map, stream_blast, shard_threads, blast_sharded, bin_external
 '''
 Collection of functions for metagenomic pipeline for taxonomic classification
 Created on June 3, 2014
@@ -15,132 +31,241 @@ Created on June 3, 2014
 
 Edited on June 9, 2020 by ekmolloy and shahnidhi
 '''
-global character_map, taxon_map, level_map, key_map, refpkg
-character_map = {'A': 'T', 'a': 't', 'C': 'G', 'c': 'g', 'T': 'A',
-                 't': 'a', 'G': 'C', 'g': 'c', '-': '-'}
+global refpkg, refpkg_index
+refpkg_index = None
 global levels
 levels = ["species", "genus", "family", "order", "class", "phylum"]
 
 
-def to_fasta(input, temp_dir):
-    iszipped = False
-    try:
-        fp = gzip.open(input, 'r')
-        line = fp.readline().decode('utf-8')
-        iszipped = True
-    except OSError:
-        fp = open(input, 'r')
-        line = fp.readline()
-    fp.close()
-
-    if line[0] == '>':
-        if iszipped:
-            print("Input is gzip'ed FASTA file, "
-                  "creating a decompressed version")
-            fiter = fastagz_iter(input)
-        else:
-            print("Input is FASTA file, proceeding to run BLAST")
-            return input
-    elif line[0] == '@':
-        if iszipped:
-            print("Input is gzip'ed FASTQ file, "
-                  "creating a decompressed FASTA-formatted version")
-            fiter = fastqgz_iter(input)
-        else:
-            print("Input is FASTQ file, "
-                  "creating a FASTA-formatted version")
-            fiter = fastq_iter(input)
-
-    # Create a new input file
-    new_input = temp_dir + '/' + input.strip().split('/')[-1].split('.', 1)[0] + ".fasta"
-    with open(new_input, 'w') as fp:
-        for ff in fiter:
-            fp.write('>' + ff[0] + '\n')
-            fp.write(ff[1] + '\n')
-
-    return new_input
+def refpkg_map_path():
+    return os.path.join(options().__getattribute__('reference').path,
+                        options().genes, MAP_FILE)
 
 
 def load_reference_package():
-    global refpkg
-
-    refpkg = {}
+    global refpkg, refpkg_index
 
     path = os.path.join(options().__getattribute__('reference').path,
                         options().genes)
-    input = os.path.join(path, "file-map-for-tipp.txt")
 
-    refpkg["genes"] = []
-    with open(input) as f:
-        for line in f.readlines():
-            [key, val] = line.split('=')
-
-            [key1, key2] = key.strip().split(':')
-            val = os.path.join(path, val.strip())
-
-            try:
-                refpkg[key1][key2] = val
-            except KeyError:
-                refpkg[key1] = {}
-                refpkg[key1][key2] = val
-
-            if (key1 != "blast") and (key1 != "taxonomy"):
-                refpkg["genes"].append(key1)
-
-    refpkg["genes"] = set(refpkg["genes"])
-    refpkg["genes"] = list(refpkg["genes"])
-
-
-# TODO Fix parameter passing
-# TODO Make taxonomy loading a class
-def load_taxonomy(taxonomy_file, lower=True):
-    global taxon_map, level_map, key_map
-
-    f = open(taxonomy_file, 'r')
-
-    # First line is the keywords for the taxonomy, need to map the keyword to
-    # the positional index of each keyword
-    results = f.readline().lower().replace('"', '').strip().split(',')
-    key_map = dict([(results[i], i) for i in range(0, len(results))])
-
-    # Now fill up taxonomy, level maps keep track of what taxa exist at each
-    # level, taxon_map keep track of entire taxonomy
-    taxon_map = {}
-    level_map = {"species": {}, "genus": {}, "family": {}, "order": {},
-                 "class": {}, "phylum": {}}
-
-    for line in f:
-        results = line.replace('"', '').strip()
-        if (lower):
-            results.lower()
-        results = results.split(',')
-        # insert into taxon map
-        taxon_map[results[0]] = results
-
-        # insert into level map
-        for level in levels:
-            if (results[key_map[level]] == ''):
-                continue
-            else:
-                if (results[key_map[level]] not in level_map[level]):
-                    level_map[level][results[key_map[level]]] = {}
-                level_map[level][results[key_map[level]]][results[0]] = \
-                    results[0]
-    return (taxon_map, level_map, key_map)
+    # A compiled reference package (see run_compile_refpkg.py) is loaded
+    # from its index, without parsing the text files
+    refpkg_index = load_index(path)
+    if refpkg_index is not None:
+        refpkg = refpkg_index.refpkg
+    else:
+        refpkg = read_refpkg_map(path)
+
+
+def load_taxonomy(taxonomy_file):
+    '''The taxonomy in taxonomy_file, from the compiled index of the
+    reference package when it has one'''
+    if refpkg_index is not None and \
+            taxonomy_file == refpkg_index.refpkg["taxonomy"]["taxonomy"]:
+        return refpkg_index.taxonomy
+    return Taxonomy.from_csv(taxonomy_file)
+
+
+def bin_reads(input, temp_dir, dereplicate_reads=True, reads=None):
+    '''Bins the reads of input, or reads if given, to markers, returns
+    (binned_fragments, weights)'''
+    # FASTA/FASTQ input, plain or gzip'ed, is decoded on the fly
+    if reads is None:
+        reads = open_reads(input, options().cpu)
+    print("Reading %s" % reads)
+
+    # Identical reads are binned and placed once, and counted as many
+    # times as they occur in the abundance profile
+    weights = None
+    if options().dereplicate and dereplicate_reads:
+        (reads, weights) = dereplicate(reads,
+                                       temp_dir + "/dereplicated.fasta")
+        print("Collapsed %d duplicate reads" % (
+            sum(weights.values()) - len(weights)))
 
+    if (options().bin == "hmmer"):
+        binned_fragments = hmmer_to_markers(reads, temp_dir)
+    else:
+        binned_fragments = blast_to_markers(reads, temp_dir)
+    return binned_fragments, weights
 
-def build_profile(input, output_directory):
-    global taxon_map, level_map, key_map, levels, refpkg
 
-    temp_dir = tempfile.mkdtemp(dir=options().__getattribute__('tempdir'))
+def marker_size(gene):
+    '''Number of taxa in the reference of a marker'''
+    if refpkg_index is not None:
+        return refpkg_index.sizes[gene]
+    return read_size(refpkg[gene]["size"])
 
-    # New option to allow fastq files as input
-    input = to_fasta(input, temp_dir)
 
-    if (options().bin == "hmmer"):
-        binned_fragments = hmmer_to_markers(input, temp_dir)
+def subset_sizes(gene):
+    '''Alignment and placement subset sizes for a marker, or None if its
+    decomposition cannot be used'''
+    # Set placement subset size to equal the size of each marker
+    total_taxa = marker_size(gene)
+    default_subset_size = int(total_taxa * 0.10)
+
+    # Set alignment size and placement size
+    alignment_size = options().alignment_size
+    placement_size = options().placement_size
+
+    if alignment_size is None:
+        if placement_size is None:
+            alignment_size = default_subset_size
+        else:
+            alignment_size = placement_size
+
+    if placement_size is None:
+        # placement_size = max(default_subset_size, alignment_size)
+        placement_size = 10000  # Needs to be large
+
+    if alignment_size > total_taxa:
+        alignment_size = total_taxa
+
+    if placement_size > total_taxa:
+        placement_size = total_taxa
+
+    if alignment_size != placement_size:
+        if placement_size < total_taxa:
+            sys.exit("Alignment decomposition tree can be different from"
+                     " placement tree only if the placement subset size"
+                     " is set to the number of taxa")
+    if (refpkg[gene]["alignment-decomposition-tree"] ==
+            refpkg[gene]["placement-tree"]) or \
+            (placement_size == total_taxa):
+        pass
     else:
-        binned_fragments = blast_to_markers(input, temp_dir)
+        print("Alignment decomposition tree can be different from"
+              " placement tree only if the placement subset size"
+              " is set to the number of taxa"
+              " (note: marker %s has %d taxa)" % (gene, total_taxa))
+        return None
+    return alignment_size, placement_size
+
+
+def tipp_arguments(gene, fragment_file, cpus, alignment_size, placement_size,
+                   temp_dir, output_directory):
+    '''run_tipp.py arguments to place the fragments binned to a marker'''
+    args = ["-c", tipp_config_path,
+            "--cpu", "%d" % cpus,
+            "-m", options().molecule,
+            "-f", fragment_file,
+            "-t", refpkg[gene]["placement-tree"],
+            "-adt", refpkg[gene]["alignment-decomposition-tree"],
+            "-a", refpkg[gene]["alignment"],
+            "-r", refpkg[gene]["raxml-info-for-placement-tree"],
+            "-tx", refpkg["taxonomy"]["taxonomy"],
+            "-txm", refpkg[gene]["seq-to-taxid-map"],
+            "-at", "%0.2f" % options().alignment_threshold,
+            "-pt", "0.0",
+            "-A", "%d" % alignment_size,
+            "-P", "%d" % placement_size,
+            "-p", temp_dir + "/temp_file",
+            "-o", "tipp_" + gene,
+            "-d", output_directory + "/markers/"]
+
+    # Set extra arguments
+    if options().dist is True:
+        args.append("-D")
+    if options().max_chunk_size is not None:
+        args.extend(["-F", "%d" % options().max_chunk_size])
+    if options().cutoff != 0:
+        args.extend(["-C", "%f" % options().cutoff])
+    if options().classification_backend != "java":
+        args.extend(["-cb", options().classification_backend])
+    return args
+
+
+def marker_outputs(output_directory, gene):
+    '''Classification and placements written by TIPP for a marker'''
+    prefix = output_directory + "/markers/tipp_" + gene
+    return [prefix + "_classification.txt", prefix + "_placement.json"]
+
+
+def run_tipp(args):
+    '''Runs TIPP on one marker, in this process with --inProcess and with
+    run_tipp.py otherwise. Returns the ClassificationTable of an in process
+    run with the python classification backend, None otherwise'''
+    print("run_tipp.py " + " ".join(args))
+    if options().in_process:
+        try:
+            return run_tipp_in_process(args)
+        except (Exception, SystemExit) as e:
+            # Like a failed run_tipp.py, leaves the marker unclassified
+            print("TIPP failed: %s" % e)
+    else:
+        subprocess.call(["run_tipp.py"] + args)
+
+
+def place_reads(input, output_directory, temp_dir, dereplicate_reads=True,
+                reads=None):
+    '''
+    Bins the reads of input to the markers and runs TIPP on every marker
+    with fragments, writing their outputs to output_directory (see
+    marker_outputs). Returns (binned_fragments, weights, classified), where
+    classified holds the ClassificationTable of the markers classified in
+    this process (see run_tipp), or None if no profile can be built. Reads
+    are only dereplicated (see dereplicate) if dereplicate_reads is set as
+    well. With reads given, those are binned instead, and input is the list
+    of the files they are read from, which identifies them in the manifest
+    and the binning cache.
+    '''
+    global refpkg
+
+    settings = dict(bin=options().bin,
+                    blast_threshold=options().blast_threshold,
+                    no_trim=options().no_trim,
+                    dereplicate=options().dereplicate)
+
+    # A restarted run reuses the binning and the finished markers recorded
+    # in the manifest of the output directory. The inputs are told apart by
+    # their stamps, so that they are not read in full just for the key
+    blast_file = options().blast_file
+    stamp = file_stamp(input) if isinstance(input, str) \
+        else [file_stamp(path) for path in input]
+    manifest = RunManifest(
+        output_directory,
+        settings_digest(stamp, file_digest(refpkg_map_path()),
+                        settings, blast_file and file_stamp(blast_file)),
+        resume=not options().no_resume)
+
+    # Reuse the binning of an earlier run on the same input and settings
+    cache = None
+    if options().bin_cache is not None and options().bin_cache_size > 0 \
+            and options().blast_file is None:
+        try:
+            cache = BinCache(options().bin_cache,
+                             options().bin_cache_size * 1e9)
+        except OSError as e:
+            print("Warning: not caching the binning, %s" % e)
+
+    recorded = manifest.binning()
+    cached = None
+    if recorded is None and cache is not None:
+        key = cache.key(input, refpkg_map_path(), **settings)
+        cached = cache.get(key)
+
+    if recorded is not None:
+        print("Resuming with the binned fragments of %s" % manifest.path)
+        (binned_fragments, weights) = recorded
+    elif cached is not None:
+        print("Reusing binned fragments from %s" % cache.path)
+        (binned_fragments, weights) = cached
+    else:
+        (binned_fragments, weights) = bin_reads(input, temp_dir,
+                                                dereplicate_reads, reads)
+        if cache is not None:
+            binned_fragments = cache.put(
+                key, binned_fragments, weights,
+                {"input": os.path.abspath(input) if isinstance(input, str)
+                 else [os.path.abspath(path) for path in input],
+                 "bin": options().bin,
+                 "reference": refpkg_map_path()})
+            cached = binned_fragments
+    if recorded is None:
+        # The fragments of a new binning are moved out of the temporary
+        # directory, cached ones are copied
+        binned_fragments = manifest.set_binning(
+            binned_fragments, weights, move=cached is None)
 
     for gene in refpkg["genes"]:
         try:
@@ -167,229 +292,453 @@ def build_profile(input, output_directory):
             f.write("Unable to create an abundance profile, because"
                     " none of the input sequences mapped to the"
                     " marker gene(s).")
-        return
-
-    # Load up taxonomy for marker genes
-    (taxon_map, level_map, key_map) = \
-        load_taxonomy(refpkg["taxonomy"]["taxonomy"])
-
-    # Store all classifications here
-    classifications = {}
-    classification_files = []
-
-    # Run TIPP on each fragment
+        return None
+
+    # Markers share the cores in proportion to their expected placement
+    # work, fragments times reference taxa, and at most one per fragment.
+    # Markers that finished in an earlier run on the same fragments and
+    # settings are skipped
+    runs = {}
+    costs = {}
+    marker_keys = {}
     for gene in binned_fragments.keys():
-        # Set placement subset size to equal the size of each marker
-        with open(refpkg[gene]["size"], 'r') as f:
-            total_taxa = int(f.readline().strip())
-        default_subset_size = int(total_taxa * 0.10)
-
-        # Set alignment size and placement size
-        alignment_size = options().alignment_size
-        placement_size = options().placement_size
-
-        if alignment_size is None:
-            if placement_size is None:
-                alignment_size = default_subset_size
-            else:
-                alignment_size = placement_size
-
-        if placement_size is None:
-            # placement_size = max(default_subset_size, alignment_size)
-            placement_size = 10000  # Needs to be large
-
-        if alignment_size > total_taxa:
-            alignment_size = total_taxa
-
-        if placement_size > total_taxa:
-            placement_size = total_taxa
-
-        if alignment_size != placement_size:
-            if placement_size < total_taxa:
-                sys.exit("Alignment decomposition tree can be different from"
-                         " placement tree only if the placement subset size"
-                         " is set to the number of taxa")
-        if (refpkg[gene]["alignment-decomposition-tree"] ==
-                refpkg[gene]["placement-tree"]) or \
-                (placement_size == total_taxa):
-            pass
+        sizes = subset_sizes(gene)
+        if sizes is None:
+            return None
+        # Neither the cores nor the temporary files change the placements
+        marker_keys[gene] = manifest.marker_key(
+            binned_fragments[gene]["file"],
+            tipp_arguments(gene, None, 0, sizes[0], sizes[1], "",
+                           output_directory))
+        if manifest.done(gene, marker_keys[gene]):
+            print("Skipping %s, finished in an earlier run" % gene)
+            continue
+        runs[gene] = sizes
+        costs[gene] = binned_fragments[gene]["nfrags"] * marker_size(gene)
+    classified = {}
+    cores = allocate_cores(
+        costs,
+        dict((gene, binned_fragments[gene]["nfrags"]) for gene in runs),
+        options().cpu)
+
+    def run_marker(gene, cpus):
+        (alignment_size, placement_size) = runs[gene]
+        # A classification left by an unfinished run must not be mistaken
+        # for the result of this one
+        if os.path.exists(marker_outputs(output_directory, gene)[0]):
+            os.remove(marker_outputs(output_directory, gene)[0])
+        table = run_tipp(tipp_arguments(
+            gene, binned_fragments[gene]["file"], cpus, alignment_size,
+            placement_size, temp_dir, output_directory))
+        if table is not None:
+            classified[gene] = table
+
+    def finished(gene):
+        print("Finished TIPP on %s" % gene)
+        if os.path.exists(marker_outputs(output_directory, gene)[0]):
+            manifest.set_done(gene, marker_keys[gene],
+                              marker_outputs(output_directory, gene))
         else:
-            print("Alignment decomposition tree can be different from"
-                  " placement tree only if the placement subset size"
-                  " is set to the number of taxa"
-                  " (note: marker %s has %d taxa)" % (gene, total_taxa))
-            return
+            manifest.forget(gene)
+
+    # Run TIPP on each marker, the largest ones first. In process runs share
+    # the sepp options, so they go one after another with all their cores
+    if options().in_process:
+        for gene in longest_first(costs):
+            run_marker(gene, min(options().cpu,
+                                 binned_fragments[gene]["nfrags"]))
+            finished(gene)
+    else:
+        for gene in run_scheduled(longest_first(costs), cores, options().cpu,
+                                  run_marker):
+            finished(gene)
+    return binned_fragments, weights, classified
 
-        # Set number of CPUS
-        cpus = options().cpu
-        if binned_fragments[gene]["nfrags"] < cpus:
-            cpus = binned_fragments[gene]["nfrags"]
-
-        # Set extra arguments
-        extra = ''
-        if options().dist is True:
-            extra = "-D"
-        if options().max_chunk_size is not None:
-            extra = extra + "-F %d" % options().max_chunk_size
-        if options().cutoff != 0:
-            extra = extra + " -C %f" % options().cutoff
-
-        cmd = "run_tipp.py " \
-            + " -c " + tipp_config_path \
-            + " --cpu " + str("%d" % cpus) \
-            + " -m " + options().molecule \
-            + " -f " + binned_fragments[gene]["file"] \
-            + " -t " + refpkg[gene]["placement-tree"] \
-            + " -adt " + refpkg[gene]["alignment-decomposition-tree"] \
-            + " -a " + refpkg[gene]["alignment"] \
-            + " -r " + refpkg[gene]["raxml-info-for-placement-tree"] \
-            + " -tx " + refpkg["taxonomy"]["taxonomy"] \
-            + " -txm " + refpkg[gene]["seq-to-taxid-map"] \
-            + " -at " + str("%0.2f" % options().alignment_threshold) \
-            + " -pt 0.0" \
-            + " -A " + str("%d" % alignment_size) \
-            + " -P " + str("%d" % placement_size) \
-            + " -p " + temp_dir + "/temp_file" \
-            + " -o tipp_" + gene \
-            + " -d " + output_directory + "/markers/ " \
-            + extra
-
-        print(cmd)
-        os.system(cmd)
-
-        tipp_output = output_directory + "/markers/tipp_" + gene \
-            + "_classification.txt"
+
+def marker_classifications(binned_fragments, output_directory, taxonomy,
+                           classified=None):
+    '''The ClassificationTable of every marker that TIPP classified, as
+    (gene, table) pairs, from classified (see place_reads) or else read
+    from its classification'''
+    for gene in binned_fragments.keys():
+        if classified and gene in classified:
+            yield gene, classified.pop(gene).with_taxonomy(taxonomy)
+            continue
+        tipp_output = marker_outputs(output_directory, gene)[0]
 
         if (not os.path.exists(tipp_output)):
             continue
 
-        classification_files.append(tipp_output)
+        yield gene, ClassificationTable.read(tipp_output, taxonomy)
+
+
+class SampleProfile(object):
+    '''
+    The classification and abundance profiles of a sample, written to
+    output_directory from the classification tables of its markers. Every
+    placement threshold has its own profile; with several, each goes to a
+    threshold_<t> directory. The pooled classifications are sorted on disk
+    (see ClassificationWriter) holding at most run_size fragments, and the
+    abundances are counted as they are written. The writers and counters of
+    a profile are only made once the sample has classified fragments, or
+    when it is closed.
+    '''
+    def __init__(self, output_directory, taxonomy, temp_dir, thresholds,
+                 weights=None, metadata=None, run_size=RUN_SIZE):
+        self.output_directory = output_directory
+        self.taxonomy = taxonomy
+        self.temp_dir = temp_dir
+        self.thresholds = thresholds
+        self.weights = weights
+        self.metadata = metadata or {}
+        self.run_size = run_size
+        self.profiles = None
+        self.distribution = None
+
+    def _profile(self, threshold):
+        profile_directory = self.output_directory
+        if len(self.thresholds) > 1:
+            profile_directory = self.output_directory + "/threshold_" + \
+                str("%0.2f" % threshold)
+        if not os.path.exists(profile_directory + "/markers"):
+            os.makedirs(profile_directory + "/markers")
+        counts = LevelCounts(len(self.taxonomy), len(self.taxonomy.levels))
+        metadata = dict(self.metadata, placement_threshold=threshold)
+        writer = ClassificationWriter(
+            profile_directory + "/markers/all.classification", self.taxonomy,
+            self.temp_dir, self.run_size, level=len(self.taxonomy.levels),
+            counts=counts, weights=self.weights, columnar=options().columnar,
+            metadata=metadata)
+        return (profile_directory, writer, counts, metadata)
+
+    def _open(self):
+        if self.profiles is not None:
+            return
+        if not os.path.exists(self.output_directory + "/markers"):
+            os.makedirs(self.output_directory + "/markers")
+        self.profiles = dict((threshold, self._profile(threshold))
+                             for threshold in self.thresholds)
+        if (options().dist is True):
+            self.distribution = DistributionCounts(len(self.taxonomy.levels))
+
+    def add(self, gene, table):
+        '''Adds the classification of a marker, applying every placement
+        threshold to it. Its fragment names are already sorted'''
+        self._open()
+        names = table.names.tolist()
+        for (threshold, profile) in self.profiles.items():
+            taxa = table.classify(threshold)
+            with open(self.output_directory + "/markers/tipp_" + gene +
+                      "_classification_" + str("%0.2f" % threshold) +
+                      ".txt", 'w') as f:
+                f.write(HEADER)
+                write_lineages(f, names, taxa, self.taxonomy)
+
+            # Pool classification
+            profile[1].add(table.names, taxa)
+        if self.distribution is not None:
+            self.distribution.add(table, self.weights, options().cutoff)
+
+    def close(self):
+        '''Writes the profiles, returns the LevelCounts of every
+        threshold'''
+        self._open()
+        counts = {}
+        for (threshold, profile) in self.profiles.items():
+            (profile_directory, writer, counts[threshold], metadata) = profile
+            writer.close()
+            write_level_abundance(counts[threshold], profile_directory,
+                                  self.taxonomy, columnar=options().columnar,
+                                  metadata=metadata)
+        if self.distribution is not None:
+            write_distribution(self.distribution, self.output_directory,
+                               self.taxonomy, options().columnar,
+                               self.metadata)
+        self.profiles = None
+        return counts
+
 
-        gene_classification = generate_classification(
-            tipp_output,
-            options().placement_threshold)
+def build_profile(input, output_directory):
+    temp_dir = tempfile.mkdtemp(dir=options().__getattribute__('tempdir'))
 
-        # Apply placement threshold to classification data
-        gene_classification_output = output_directory \
-            + "/markers/tipp_" + gene + "_classification_" \
-            + str("%0.2f" % options().placement_threshold) + ".txt"
+    placed = place_reads(input, output_directory, temp_dir)
+    if placed is None:
+        return
+    (binned_fragments, weights, classified) = placed
 
-        gene_classification = generate_classification(
-            tipp_output,
-            options().placement_threshold)
+    # Load up taxonomy for marker genes
+    taxonomy = load_taxonomy(refpkg["taxonomy"]["taxonomy"])
 
-        write_classification(
-            gene_classification,
-            gene_classification_output)
+    # Describes the sample in the columnar outputs
+    profile = SampleProfile(
+        output_directory, taxonomy, temp_dir, placement_thresholds(),
+        weights, {"sample": options().output,
+                  "input": os.path.abspath(input),
+                  "reference": refpkg_map_path()})
+    for (gene, table) in marker_classifications(
+            binned_fragments, output_directory, taxonomy, classified):
+        profile.add(gene, table)
+    profile.close()
 
-        # Pool classification
-        classifications.update(gene_classification)
 
-    remove_unclassified_level(classifications)
-    write_classification(
-        classifications,
-        output_directory + "/markers/all.classification")
-    write_abundance(classifications, output_directory)
+def read_samples(samples_file):
+    '''
+    The samples of a batch, (sample, reads) pairs from a file of lines
+    sample<TAB>reads. A line with only reads names the sample after the
+    file. Paths are relative to the samples file, and lines starting with
+    # are skipped.
+    '''
+    samples = []
+    with open(samples_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) == 1:
+                name = os.path.basename(fields[0])
+                for extension in (".gz", ".fastq", ".fq", ".fasta", ".fas",
+                                  ".fa", ".fna"):
+                    if name.endswith(extension):
+                        name = name[:-len(extension)]
+                fields = [name, fields[0]]
+            (sample, reads) = (fields[0].strip(), fields[-1].strip())
+            if not sample or any(c.isspace() or c == os.sep
+                                 for c in sample):
+                raise ValueError("Invalid sample name %r in %s" %
+                                 (sample, samples_file))
+            samples.append((sample, os.path.join(
+                os.path.dirname(os.path.abspath(samples_file)), reads)))
+    if len(set(sample for (sample, _) in samples)) != len(samples):
+        raise ValueError("Duplicate sample names in %s" % samples_file)
+    return samples
+
+
+def sample_tag(index):
+    '''Prefix of the names of the reads of sample index in a batch'''
+    return b"S%d_" % index
+
+
+def untag_names(names):
+    '''Sample indices and names without their tag of an array of tagged
+    fragment names (see sample_tag)'''
+    parts = np.char.partition(np.asarray(names, dtype=str), '_')
+    return (np.char.lstrip(parts[:, 0], 'S').astype(np.int64),
+            parts[:, 2])
+
+
+def pool_samples(samples, temp_dir):
+    '''
+    The reads of all samples as one stream, every read name tagged with its
+    sample (see sample_tag), and the weights of every sample (see
+    dereplicate). Reads are dereplicated within every sample, into
+    temp_dir; otherwise they are read straight from the sample files.
+    '''
+    streams = []
+    weights = []
+    for (index, (sample, path)) in enumerate(samples):
+        reads = open_reads(path, options().cpu)
+        print("Reading %s for sample %s" % (reads, sample))
+        sample_weights = None
+        if options().dereplicate:
+            (reads, sample_weights) = dereplicate(
+                reads, temp_dir + "/dereplicated.%d.fasta" % index)
+        streams.append((sample_tag(index), reads))
+        weights.append(sample_weights)
+    return TaggedReads(streams), weights
+
+
+def build_batch_profile(samples, output_directory):
+    '''
+    Profiles a batch of samples, (sample, reads) pairs, in one run: the
+    reads of all samples are binned together, every marker is placed once
+    for all of them, and the classifications are split back by sample.
+    Every sample gets its profiles in output_directory/<sample>, and every
+    threshold a sample x taxon matrix of each level (see
+    write_abundance_matrix).
+    '''
+    temp_dir = tempfile.mkdtemp(dir=options().__getattribute__('tempdir'))
+    try:
+        profile_batch(samples, output_directory, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
-    if (options().dist is True):
-        distribution(classification_files, output_directory)
 
+def profile_batch(samples, output_directory, temp_dir):
+    '''build_batch_profile, with its temporary files in temp_dir'''
+    (pooled, sample_weights) = pool_samples(samples, temp_dir)
+    placed = place_reads([path for (_, path) in samples], output_directory,
+                         temp_dir, dereplicate_reads=False, reads=pooled)
+    if placed is None:
+        return
+    (binned_fragments, _, classified) = placed
+
+    taxonomy = load_taxonomy(refpkg["taxonomy"]["taxonomy"])
+
+    # All the samples share the memory of one profile
+    thresholds = placement_thresholds()
+    run_size = max(1 << 16, RUN_SIZE // len(samples))
+    profiles = [SampleProfile(
+        os.path.join(output_directory, sample), taxonomy, temp_dir,
+        thresholds, sample_weights[index],
+        {"sample": sample, "input": os.path.abspath(path),
+         "reference": refpkg_map_path()}, run_size)
+        for (index, (sample, path)) in enumerate(samples)]
+    for (gene, table) in marker_classifications(
+            binned_fragments, output_directory, taxonomy, classified):
+        (indices, names) = untag_names(table.names)
+        for (index, sample_table) in table.split(indices, names):
+            profiles[index].add(gene, sample_table)
+
+    counts = [profile.close() for profile in profiles]
+    for threshold in thresholds:
+        matrix_directory = output_directory
+        if len(thresholds) > 1:
+            matrix_directory = output_directory + "/threshold_" + \
+                str("%0.2f" % threshold)
+            if not os.path.exists(matrix_directory):
+                os.makedirs(matrix_directory)
+        write_abundance_matrix(
+            [sample for (sample, _) in samples],
+            [sample_counts[threshold] for sample_counts in counts],
+            matrix_directory, taxonomy)
+
+
+def write_abundance_matrix(samples, counts, output_dir, taxonomy):
+    '''
+    Writes the abundances of every level of the samples, from their
+    LevelCounts, as a matrix with a row per sample and a column per taxon,
+    labelled as in the abundance profiles
+    '''
+    for (level, level_name) in enumerate(taxonomy.levels):
+        profiles = [sample_counts.abundance(level)
+                    for sample_counts in counts]
+        clades = np.unique(np.concatenate(
+            [sample_clades for (sample_clades, _) in profiles] +
+            [np.array([], dtype=np.int64)]))
+        matrix = np.zeros((len(samples), len(clades)))
+        for (row, (sample_clades, abundances)) in enumerate(profiles):
+            matrix[row, np.searchsorted(clades, sample_clades)] = abundances
+
+        labels = []
+        for clade in clades.tolist():
+            if clade == UNCLASSIFIED:
+                labels.append('unclassified')
+            elif clade == UNDEFINED:
+                labels.append('')
+            else:
+                labels.append(taxonomy.name(clade))
+        with open(output_dir + "/abundance_matrix.%s.csv" % level_name,
+                  'w') as f:
+            f.write('\t'.join(['sample'] + labels) + '\n')
+            for (sample, row) in zip(samples, matrix.tolist()):
+                f.write('\t'.join([sample] + ['%0.4f' % value
+                                              for value in row]) + '\n')
 
-def distribution(classification_files, output_dir):
-    global taxon_map, level_map, key_map, levels, level_names
 
-    distribution = {"species": {}, "genus": {}, "family": {}, "order": {},
-                    "class": {}, "phylum": {}}
-    total_frags = 0
+def distribution(classification_files, output_dir, taxonomy, weights=None,
+                 cutoff=0, columnar=False, metadata=None):
+    '''
+    weights maps fragment names to the number of reads they stand for
+    (1 if missing), see dereplicate. Placements with a probability below
+    cutoff are left out. With columnar set, the distribution is also written
+    as a columnar output with the given metadata (see tipp.columnar).
+    '''
+    counts = DistributionCounts(len(taxonomy.levels))
     for class_input in classification_files:
-        class_in = open(class_input, 'r')
-        frag_info = {"species": {'unclassified': 1},
-                     "genus": {'unclassified': 1},
-                     "family": {'unclassified': 1},
-                     "order": {'unclassified': 1},
-                     "class": {'unclassified': 1},
-                     "phylum": {'unclassified': 1}}
-        old_name = ""
-        for line in class_in:
-            results = line.strip().split(',')
-            if (len(results) > 5):
-                results = [results[0], results[1], results[2],
-                           results[-2], results[-1]]
-            (name, id, rank, probability) = (
-                results[0], results[1], results[3], float(results[4]))
-            if (rank not in distribution):
-                continue
-            if (old_name == ""):
-                old_name = name
-            if (name != old_name):
-                total_frags += 1
-                assert frag_info['phylum']['unclassified'] != 1
-                for clade, cladeval in frag_info.items():
-                    for clade_name, cnc in cladeval.items():
-                        if clade_name not in distribution[clade]:
-                            distribution[clade][clade_name] = 0
-                        distribution[clade][clade_name] += cnc
-                frag_info = {"species": {'unclassified': 1},
-                             "genus": {'unclassified': 1},
-                             "family": {'unclassified': 1},
-                             "order": {'unclassified': 1},
-                             "class": {'unclassified': 1},
-                             "phylum": {'unclassified': 1}}
-                old_name = name
-            if (id not in frag_info[rank]):
-                frag_info[rank][id] = 0
-            frag_info[rank][id] += probability
-            frag_info[rank]['unclassified'] -= probability
-        total_frags += 1
-        assert frag_info['phylum']['unclassified'] != 1
-        for clade, cladeval in frag_info.items():
-            for clade_name, cnc in cladeval.items():
-                if (clade_name not in distribution[clade]):
-                    distribution[clade][clade_name] = 0
-                distribution[clade][clade_name] += cnc
-
-    level_names = {1: 'species', 2: 'genus', 3: 'family', 4: 'order',
-                   5: 'class', 6: 'phylum'}
-    for level in level_names:
-        f = open(output_dir + "/abundance.distribution.%s.csv" %
-                 level_names[level], 'w')
+        counts.add(ClassificationTable.read(class_input, taxonomy), weights,
+                   cutoff)
+    return write_distribution(counts, output_dir, taxonomy, columnar,
+                              metadata)
+
+
+def write_distribution(counts, output_dir, taxonomy, columnar=False,
+                       metadata=None):
+    '''Writes the distribution profile of every level from a
+    DistributionCounts, and returns it'''
+    if columnar:
+        tax_ids = sorted(set(tax_id for clades in counts.clades
+                             for tax_id in clades))
+        codes = dict((tax_id, i) for (i, tax_id) in enumerate(tax_ids))
+        taxa = taxonomy.index(np.array(tax_ids, dtype='S')).tolist()
+        clades = []
+        abundances = []
+        for level in range(len(taxonomy.levels)):
+            keys = sorted(counts.clades[level])
+            values = [counts.clades[level][key] for key in keys]
+            keys = [codes[key] for key in keys]
+            if counts.total:
+                keys.append(UNCLASSIFIED)
+                values.append(counts.unclassified[level])
+            clades.append(keys)
+            abundances.append(np.array(values) / (counts.total or 1))
+        tax_ids = [tax_id.decode() for tax_id in tax_ids]
+        write_abundance_columns(
+            columns_path(output_dir + "/abundance.distribution"),
+            "distribution", taxonomy.levels, clades, abundances, tax_ids,
+            [taxonomy.name(taxon) if taxon != -1 else tax_id
+             for (taxon, tax_id) in zip(taxa, tax_ids)],
+            dict(metadata or {}, total=counts.total))
+
+    distribution = {}
+    for (level, level_name) in enumerate(taxonomy.levels):
+        clades = dict((tax_id.decode(), value) for (tax_id, value) in
+                      counts.clades[level].items())
+        if counts.total:
+            clades['unclassified'] = counts.unclassified[level]
+        distribution[level_name] = clades
+
+        f = open(output_dir + "/abundance.distribution.%s.csv" % level_name,
+                 'w')
         f.write('taxa\tabundance\n')
         lines = []
-        for clade, value in distribution[level_names[level]].items():
-            name = clade
-            if (name != 'unclassified'):
-                name = taxon_map[clade][key_map['tax_name']]
-            lines.append('%s\t%0.4f\n' % (name, float(value) / total_frags))
+        names = list(clades.keys())
+        taxa = taxonomy.index(np.array(names, dtype='S'))
+        for (name, taxon) in zip(names, taxa.tolist()):
+            value = clades[name]
+            if (name != 'unclassified' and taxon != -1):
+                name = taxonomy.name(taxon)
+            lines.append('%s\t%0.4f\n' % (name, value / counts.total))
         lines.sort()
         f.write(''.join(lines))
         f.close()
     return distribution
 
 
-def remove_unclassified_level(classifications, level=6):
-    global taxon_map, level_map, key_map, levels
-
+def remove_unclassified_level(classifications, taxonomy, level=6):
     frags = list(classifications.keys())
-    for frag in frags:
-        if classifications[frag][level] == 'NA':
+    lineages = taxonomy.lineages(
+        [classifications[frag] for frag in frags])
+    for (frag, clade) in zip(frags, lineages[:, level - 1].tolist()):
+        if clade == -1:
             del classifications[frag]
 
 
-def write_classification(class_input, output):
+def write_classification(class_input, output, taxonomy, columnar=False,
+                         metadata=None):
     '''
-    Writes a classification file
+    Writes a classification file, the lineage of every fragment, and with
+    columnar set also as a columnar output with the given metadata (see
+    tipp.columnar)
     '''
-    class_out = open(output, 'w')
-    class_out.write("fragment\tspecies\tgenus\tfamily\torder\tclass\tphylum\n")
     keys = list(class_input.keys())
     keys.sort()
-    for frag in keys:
-        class_out.write("%s\n" % "\t".join(class_input[frag]))
-    class_out.close()
-
-
-def write_abundance(classifications, output_dir, labels=True,
-                    remove_unclassified=True):
+    taxa = [class_input[frag] for frag in keys]
+    lineages = taxonomy.lineages(taxa)
+    with open(output, 'w') as class_out:
+        class_out.write(HEADER)
+        write_lineages(class_out, keys, taxa, taxonomy, lineages)
+    if columnar:
+        columns = ColumnWriter(columns_path(output), "classification",
+                               metadata)
+        columns.append_strings("fragment", keys)
+        columns.append("lineage", lineages.astype(np.int32))
+        write_classification_columns(columns, taxonomy)
+
+
+def write_abundance(classifications, output_dir, taxonomy, labels=True,
+                    remove_unclassified=True, weights=None, columnar=False,
+                    metadata=None):
     """
     Note from Nam: Fix problem with NA being unclassified
 
@@ -397,421 +746,149 @@ def write_abundance(classifications, output_dir, labels=True,
     whether the NA is because it is unclassified or if the lineage doesn't
     have any label defined at that level. This was earlier artificially
     inflating the unclassified counts at that level
+
+    Each fragment counts as weights[fragment] reads (1 if missing). The NA
+    of a fragment not classified at a level or any more specific one counts
+    as unclassified there, any other NA as '' (see tipp.abundance). With
+    columnar set, the profile is also written as a columnar output with the
+    given metadata (see tipp.columnar).
     """
-    global taxon_map, level_map, key_map, levels
-
-    level_abundance = {
-        1: {'total': 0}, 2: {'total': 0}, 3: {'total': 0}, 4: {'total': 0},
-        5: {'total': 0}, 6: {'total': 0}}
-
-    level_names = {1: 'species', 2: 'genus', 3: 'family', 4: 'order',
-                   5: 'class', 6: 'phylum'}
-    for lineage in classifications.values():
-        # insert into level map
-        havenot_classified_at_lower_level = True
-        for level in range(1, 7):
-            if (lineage[level] == 'NA'):
-                if havenot_classified_at_lower_level:
-                    if ('unclassified' not in level_abundance[level]):
-                        level_abundance[level]['unclassified'] = 0
-                    level_abundance[level]['unclassified'] += 1
-                else:
-                    if ('' not in level_abundance[level]):
-                        level_abundance[level][''] = 0
-                    level_abundance[level][''] += 1
-                level_abundance[level]['total'] += 1
-                # continue
-            else:
-                havenot_classified_at_lower_level = False
-                if (lineage[level] not in level_abundance[level]):
-                    level_abundance[level][lineage[level]] = 0
-                level_abundance[level][lineage[level]] += 1
-                level_abundance[level]['total'] += 1
-    for level in level_names:
-        f = open(output_dir + "/abundance.%s.csv" % level_names[level], 'w')
+    frags = list(classifications.keys())
+    counts = LevelCounts(len(taxonomy), len(taxonomy.levels))
+    counts.add(taxonomy.lineages([classifications[frag] for frag in frags]),
+               fragment_weights(frags, weights))
+    write_level_abundance(counts, output_dir, taxonomy, labels, columnar,
+                          metadata)
+
+
+def write_level_abundance(counts, output_dir, taxonomy, labels=True,
+                          columnar=False, metadata=None):
+    '''Writes the abundance profile of every level from a LevelCounts'''
+    if columnar:
+        profile = [counts.abundance(level)
+                   for level in range(len(taxonomy.levels))]
+        taxa = np.unique(np.concatenate(
+            [clades[clades >= 0] for (clades, _) in profile]))
+        write_abundance_columns(
+            columns_path(output_dir + "/abundance"), "abundance",
+            taxonomy.levels,
+            [np.where(clades >= 0, np.searchsorted(taxa, clades), clades)
+             for (clades, _) in profile],
+            [abundances for (_, abundances) in profile],
+            taxonomy.tax_ids(taxa),
+            [taxonomy.name(taxon) for taxon in taxa.tolist()],
+            dict(metadata or {}, total=counts.total))
+    for (level, level_name) in enumerate(taxonomy.levels):
+        f = open(output_dir + "/abundance.%s.csv" % level_name, 'w')
         f.write('taxa\tabundance\n')
         lines = []
-        for clade in level_abundance[level]:
-            if clade == 'total':
-                continue
-            name = clade
-            if labels and name != 'unclassified' and name != "":
-                name = taxon_map[clade][key_map['tax_name']]
-            lines.append('%s\t%0.4f\n' % (
-                name, float(level_abundance[level][clade]) / level_abundance[
-                    level]['total']))
+        (clades, abundances) = counts.abundance(level)
+        for (clade, abundance) in zip(clades.tolist(), abundances.tolist()):
+            if clade == UNCLASSIFIED:
+                name = 'unclassified'
+            elif clade == UNDEFINED:
+                name = ''
+            else:
+                name = taxonomy.name(clade) if labels \
+                    else taxonomy.tax_ids(clade)
+            lines.append('%s\t%0.4f\n' % (name, abundance))
         lines.sort()
         f.write(''.join(lines))
         f.close()
 
 
-def generate_classification(class_input, threshold):
-    global taxon_map, level_map, key_map, levels
-
-    class_in = open(class_input, 'r')
-    level_map_hierarchy = {"species": 0, "genus": 1, "family": 2, "order": 3,
-                           "class": 4, "phylum": 5, "root": 6}
-
-    # Need to keep track of last line so we can determine when we switch to
-    # new classification
-    old_name = ""
-    old_probability = 1
-    old_id = ""
-    old_rank = ""
-
-    # keep track of all fragment names
-    names = {}
-    classification = {}
-    for line in class_in:
-        results = line.strip().split(',')
-        if (len(results) > 5):
-            results = [results[0], results[1], results[2],
-                       results[-2], results[-1]]
-        (name, id, rank, probability) = (
-            results[0], results[1], results[3], float(results[4]))
-        names[name] = name
-        if (name != old_name):
-            # when we switch to new fragment, output last classification for
-            # old fragment
-            if (old_name != ""):
-                lineage = taxon_map[old_id]
-                output_line = [old_name]
-                for level in levels:
-                    clade = lineage[key_map[level]]
-                    if (clade == ""):
-                        clade = "NA"
-                    output_line.append(clade)
-                classification[old_name] = output_line
-            old_name = name
-            old_rank = "root"
-            old_probability = 1
-            old_id = '1'
-
-        # Switch to new rank if the new probability is higher than threshold
-        # and our rank is more specific than our original rank
-        if (
-            rank in level_map_hierarchy and
-            (level_map_hierarchy[old_rank] > level_map_hierarchy[rank]) and
-            (probability > threshold)
-           ):
-            old_rank = rank
-            old_probability = probability
-            old_id = id
-        # Switch to new rank if the new rank matches old rank but has higher
-        # probability
-        elif (
-              rank in level_map_hierarchy and
-              (level_map_hierarchy[old_rank] == level_map_hierarchy[rank]) and
-              (probability > old_probability)
-             ):
-            old_rank = rank
-            old_probability = probability
-            old_id = id
-
-    if old_id in taxon_map:
-        lineage = taxon_map[old_id]
-        output_line = [old_name]
-        for level in levels:
-            clade = lineage[key_map[level]]
-            if (clade == ""):
-                clade = "NA"
-            output_line.append(clade)
-        classification[name] = output_line
-    return classification
-
-
-def hmmer_to_markers(input, temp_dir):
-    global refpkg
-
-    fragments = MutableAlignment()
-    fragments.read_filepath(input)
+def generate_classification(class_input, threshold, taxonomy):
+    '''
+    Classifies every fragment of a TIPP classification file at the most
+    specific rank with a probability above threshold. Returns fragment name
+    -> taxon index in taxonomy (-1 if the taxon is not in it).
+    '''
+    return ClassificationTable.read(class_input, taxonomy).classifications(
+        threshold)
 
-    reverse = dict([(name+'_rev', reverse_sequence(seq))
-                    for (name, seq) in fragments.items()])
-    all_frags = MutableAlignment()
-    all_frags.set_alignment(fragments)
-    all_frags.set_alignment(reverse)
-    frag_file = temp_dir + "/frags.fas"
-    _write_fasta(all_frags, frag_file)
 
-    # Now bin the fragments
-    frag_scores = dict([(name, [-10000, 'NA', 'NA'])
-                        for name in fragments.keys()])
+def placement_thresholds():
+    '''The placement thresholds of --placementThreshold, a comma separated
+    list'''
+    return [float(t) for t in str(options().placement_threshold).split(',')]
 
-    for gene in refpkg["genes"]:
-        # Now run HMMER search
-        hmmer_output = temp_dir + '/' + gene + ".out"
-        hmmer_search(frag_file, refpkg[gene]["hmm"], hmmer_output)
-        results = read_hmmsearch_results(hmmer_output)
-
-        # Now select best direction for each frag
-        for name, value in results.items():
-            bitscore = value[1]
-            direction = 'forward'
-            true_name = name
-            if (name.find('_rev') != -1):
-                true_name = true_name.replace('_rev', '')
-                direction = 'reverse'
-            if frag_scores[true_name][0] < bitscore:
-                frag_scores[true_name] = [bitscore, gene, direction]
 
-    # Now bin the fragments
-    genes = dict([])
-    for name, val in frag_scores.items():
-        if (val[1] not in genes):
-            genes[val[1]] = {}
-        if (val[2] == 'forward'):
-            genes[val[1]][name] = fragments[name]
-        else:
-            genes[val[1]][name] = reverse_sequence(fragments[name])
-
-    genes.pop("NA", None)
-
-    for gene, seq in genes.items():
-        gene_file = temp_dir + '/' + gene + ".frags.fas.fixed"
-        _write_fasta(seq, gene_file)
-
-    binned_fragments = {}
-    for gene, seq in genes.items():
-        binned_fragments[gene] = {}
-        binned_fragments[gene]["file"] = temp_dir + '/' + gene \
-            + ".frags.fas.fixed"
-        binned_fragments[gene]["nfrags"] = len(seq.keys())
-
-    return binned_fragments
-
-
-def fasta_iter(fasta_name):
-	## Sometimes fasta sequences can be blank, so we check for '>' before using .strip() in assigning nextheader
-    with open(fasta_name, 'r') as fp:
-        xline = fp.readline()
-        if xline[0] != '>':
-            raise("Unable to read %s" % fasta_name)
-        nextheader = xline.strip()
-        nextseq = []
-
-        for line in fp:
-            xline = line
-            if xline[0] == '>':
-                header = nextheader[1:].split(' ')[0]
-                seq = "".join(nextseq)
-                nextheader = xline.strip()
-                nextseq = []
-                if len(seq) == 0:
-                	pass
-                else:
-                	yield header, seq
-            else:
-                nextseq.append(xline.strip())
-
-        header = nextheader[1:].split(' ')[0]
-        seq = "".join(nextseq)
-        if len(seq) == 0:
-        	pass
-        else:
-        	yield header, seq
-
-
-def fastagz_iter(fasta_name):
-    with gzip.open(fasta_name, 'r') as fp:
-        xline = fp.readline().decode('utf-8')
-        if xline[0] != '>':
-            raise("Unable to read %s" % fasta_name)
-        nextheader = xline.strip()
-        nextseq = []
-
-        for line in fp:
-            xline = line.decode('utf-8')
-            if xline[0] == '>':
-                header = nextheader[1:].split(' ')[0]
-                seq = "".join(nextseq)
-                nextheader = xline.strip()
-                nextseq = []
-                if len(seq) == 0:
-                	pass
-                else:
-                	yield header, seq
-            else:
-                nextseq.append(xline.strip())
-
-        header = nextheader[1:].split(' ')[0]
-        seq = "".join(nextseq)
-        if len(seq) == 0:
-        	pass
-        else:
-        	yield header, seq
+def hmmer_to_markers(reads, temp_dir):
+    global refpkg
 
+    frag_file = temp_dir + "/frags.fas"
+    write_search_fragments(reads, frag_file)
+
+    # Searches on all markers run at once and are merged as they finish;
+    # ties go to the marker that comes first in the reference package
+    frag_scores = {}
+    order = dict((gene, i) for (i, gene) in enumerate(refpkg["genes"]))
+    hmms = dict((gene, refpkg[gene]["hmm"]) for gene in refpkg["genes"])
+    for (gene, hmmer_output) in search_markers(
+            options().__getattribute__('hmmsearch').path, frag_file, hmms,
+            temp_dir, options().cpu):
+        (names, _, bitscores) = read_tblout(hmmer_output)
+        merge_hits(frag_scores, gene, names, bitscores, order)
 
-def fastq_iter(fastq_name):
-    """
-    Function from Nidhi Shah:
-    https://github.com/shahnidhi/tipp2_scripts/blob/master/get_marker_assignment.py
-    """
-    with open(fastq_name, 'r') as fp:
-        for i, line in enumerate(fp):
-            xline = line.strip()
-            if i % 4 == 0:
-                # First line is name
-                header = xline[1:].split(' ')[0]
-            elif i % 4 == 1:
-                # Second line is sequence
-                seq = xline
-            elif i % 4 == 2:
-                # Third line is '+'
-                continue
-            else:
-                # Fourth line is quality
-                if header == "" or len(seq) == 0:
-                	pass
-                else:
-                	yield header, seq
-
-
-def fastqgz_iter(fastq_name):
-    with gzip.open(fastq_name, 'r') as fp:
-        for i, line in enumerate(fp):
-            xline = line.decode('utf-8').strip()
-            if i % 4 == 0:
-                # First line is name
-                header = xline[1:].split(' ')[0]
-            elif i % 4 == 1:
-                # Second line is sequence
-                seq = xline
-            elif i % 4 == 2:
-                # Third line is '+'
-                continue
-            else:
-                # Fourth line is quality
-                if header == "" or len(seq) == 0:
-                	pass
-                else:
-                	yield header, seq
+    # Now bin the fragments
+    return write_bins(reads, frag_scores, temp_dir)
 
 
-def blast_to_markers(input, temp_dir):
+def blast_to_markers(reads, temp_dir):
     """
     Function based on:
     https://github.com/shahnidhi/tipp2_scripts/blob/master/get_marker_assignment.py
     """
     global refpkg
 
-    # Handle input
-    with open(input, 'r') as fp:
-        line = fp.readline()
-    if line[0] != '>':
-        sys.exit("%s is not a FASTA file; please reformat for BLAST." % input)
-    if len(line.split(" ")) > 1:
-        sys.exit("%s contains spaces; please reformat for BLAST." % input)
+    binner = FragmentBinner(refpkg["genes"], temp_dir, not options().no_trim)
 
     # First blast sequences against all markers
     blast_results = temp_dir + "/blast.out"
-    if (options().blast_file is None):
+    if (options().blast_file is None) and options().stream_binning:
+        print("Blasting and binning fragments against marker dataset\n")
+        marker_map = read_marker_map(refpkg["blast"]["seq-to-marker-map"])
+        cmd = blastn_command(options().__getattribute__('blast').path,
+                             refpkg["blast"]["database"], "-", "-",
+                             options().cpu)
+        print(" ".join(cmd))
+        with open(blast_results, 'wb') as raw_output:
+            stream_blast(reads, cmd, marker_map,
+                         options().blast_threshold, binner, raw_output)
+        return binner.close()
+    elif (options().blast_file is None):
         print("Blasting fragments against marker dataset\n")
-        blast_fragments(input, blast_results)
+        (shards, threads) = shard_threads(options().cpu,
+                                          options().blast_shards,
+                                          options().blast_threads)
+        if shards > 1:
+            blast_results = ["%s/blast.%d.out" % (temp_dir, i)
+                             for i in range(shards)]
+            blast_sharded(reads, options().__getattribute__('blast').path,
+                          refpkg["blast"]["database"], blast_results,
+                          threads)
+        else:
+            blast_fragments(reads, blast_results, threads)
+            blast_results = [blast_results]
     else:
-        blast_results = options().blast_file
+        blast_results = [options().blast_file]
+
+    if options().bin_partitions > 0:
+        print("Binning fragments in %d partitions\n" %
+              options().bin_partitions)
+        marker_map = read_marker_map(refpkg["blast"]["seq-to-marker-map"])
+        bin_external(reads, blast_results, BlastHitTable(marker_map), binner,
+                     temp_dir + "/partitions", options().bin_partitions,
+                     options().blast_threshold)
+        return binner.close()
 
     # Next bin the blast hits to the best gene
     hitinfo = bin_blast_results(blast_results)
 
-    binned_fragments = {}
-    for gene in refpkg["genes"]:
-        binned_fragments[gene] = {}
-        binned_fragments[gene]["file"] = temp_dir + '/' + gene \
-            + ".frags.fas.fixed"
-        binned_fragments[gene]["fptr"] = \
-            open(binned_fragments[gene]["file"], 'w')
-        binned_fragments[gene]["nfrags"] = 0
-
-    f = open(temp_dir + "/blast-binned.out", 'w')
-    f.write("qseqid,sseqid,marker,trim_qstart,trim_qend,qlen\n")
-
-    # if input.lower().endswith((".fastq", ".fq")):
-    #     fiter = fastq_iter(input)
-    # elif input.lower().endswith((".fasta", ".fas", ".fa", ".fna")):
-    fiter = fasta_iter(input)
-
-    for ff in fiter:
-        header = ff[0]
-        seq = ff[1]
-
-        found = True
-        try:
-            gene = hitinfo[header]["gene"]
-        except KeyError:
-            found = False
-
-        if found:
-            sseqid = hitinfo[header]["sseqid"]
-            qstart = hitinfo[header]["qstart"]
-            qend = hitinfo[header]["qend"]
-            qlen = hitinfo[header]["qlen"]
-            sstart = hitinfo[header]["sstart"]
-            send = hitinfo[header]["send"]
-            slen = hitinfo[header]["slen"]
-
-            trim_qstart = 0
-            trim_qend = qlen
-            if not options().no_trim:
-                extra_qstart = qstart - 1
-                extra_qend = qlen - qend
-
-                if sstart < send:
-                    extra_sstart = sstart - 1
-                    extra_send = slen - send
-                else:
-                    extra_sstart = slen - sstart
-                    extra_send = send - 1
-
-                if extra_qstart > 2 * extra_sstart:
-                    trim_qstart = qstart - 1
-                    seq = seq[trim_qstart:]
-
-                if extra_qend > 2 * extra_send:
-                    trim_qend = qend
-                    seq = seq[:trim_qend]
-
-            if sstart > send:
-                seq = reverse_sequence(seq)
-
-            binned_fragments[gene]["fptr"].write('>' + header + '\n')
-            binned_fragments[gene]["fptr"].write(seq + '\n')
-            binned_fragments[gene]["nfrags"] += 1
-            f.write(header + ',' + sseqid + ',' + gene + ','
-                    + str(trim_qstart + 1) + ',' + str(trim_qend) + ','
-                    + str(qlen) + '\n')
+    for batch in reads.batches():
+        binner.add_batch(batch, hitinfo)
 
-    for gene in refpkg["genes"]:
-        binned_fragments[gene]["fptr"].close()
-    f.close()
-
-    return binned_fragments
-
-
-def read_hmmsearch_results(input):
-    # Group 1 (e-value) 2 (bitscore) and 9 (taxon name) contain the
-    # relevant information, other ones can be ignored unless we plan to do
-    # something later
-    pattern = re.compile(
-        r"([^\s]+)\s+([^\s]+)\s+([^\s]+)\s+([^\s]+)\s+([^\s]+)\s+([^\s]+)"
-        r"\s+([^\s]+)\s+([^\s]+)\s+([^\s]+)")
-    start_reading = False
-    infile = open(input)
-    results = {}
-    for line in infile:
-        line = line.strip()
-        if (not start_reading and line.startswith("E-value") is True):
-            start_reading = True
-        elif (start_reading and line == ""):
-            start_reading = False
-            break
-        elif (start_reading):
-            matches = pattern.search(line)
-            if (matches is not None and matches.group(0).find("--") == -1):
-                results[matches.group(9).strip()] = (
-                    float(matches.group(1).strip()),
-                    float(matches.group(2).strip()))
-    return results
+    return binner.close()
 
 
 def read_mapping(input, header=False, delimiter='\t'):
@@ -827,94 +904,46 @@ def read_mapping(input, header=False, delimiter='\t'):
     return d
 
 
-def bin_blast_results(input):
+def bin_blast_results(inputs):
+    '''Best hit of every read over one or more BLAST outputs, as a
+    BlastHitTable'''
     global refpkg
 
     # Map the blast results to the markers
-    gene_mapping = read_mapping(refpkg["blast"]["seq-to-marker-map"])
-
-    hitinfo = {}
+    marker_map = read_marker_map(refpkg["blast"]["seq-to-marker-map"])
 
-    with open(input) as f:
-        # BLAST output contains reads sorted in ascending order by bitscore
-        for line in f:
-            results = line.split('\t')
-
-            qseqid = results[0]
-            sseqid = results[1]
-            # pident = float(results[2])
-            # length = int(results[3])
-            # mismatch = int(results[4])
-            # gapopen = int(results[5])
-            qstart = int(results[6])
-            qend = int(results[7])
-            qlen = int(results[8])
-            sstart = int(results[9])
-            send = int(results[10])
-            slen = int(results[11])
-            # evalue = float(results[12])
-            # bitscore = float(results[13].strip())
-            qcov = abs(qend - qstart) + 1
-
-            update = False
-            if qcov >= options().blast_threshold:
-                try:
-                    if hitinfo[qseqid]["qcov"] < qcov:
-                        update = True
-                except KeyError:
-                    hitinfo[qseqid] = {}
-                    update = True
-
-            if update:
-                hitinfo[qseqid]["sseqid"] = sseqid
-                hitinfo[qseqid]["gene"] = gene_mapping[sseqid][1]
-                hitinfo[qseqid]["qstart"] = qstart
-                hitinfo[qseqid]["qend"] = qend
-                hitinfo[qseqid]["qlen"] = qlen
-                hitinfo[qseqid]["sstart"] = sstart
-                hitinfo[qseqid]["send"] = send
-                hitinfo[qseqid]["slen"] = slen
-                hitinfo[qseqid]["qcov"] = qcov
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    return BlastHitTable(marker_map).read(inputs, options().blast_threshold)
 
-    return hitinfo
 
-
-def hmmer_search(input, hmmer, output):
-    cmd = options().__getattribute__('hmmsearch').path \
-              + " --noali -E 10000 " \
-              + " --cpu " + str("%d" % options().cpu) \
-              + " -o " + output \
-              + " " + hmmer \
-              + " " + input
-
-    print(cmd)
-    os.system(cmd)
-
-
-def blast_fragments(input, output):
+def blast_fragments(reads, output, threads=None):
     '''Blast the fragments against all marker genes+16S sequences, return
-    output'''
+    output, with threads blastn threads (options().cpu if None). Plain FASTA
+    input is handed to blastn as is, anything else is decoded and piped
+    into its stdin.'''
     global refpkg
 
     blastn = options().__getattribute__('blast').path
 
-    cmd = blastn + " -db " + refpkg["blast"]["database"] \
-                 + " -outfmt \"6" \
-                 + " qseqid sseqid pident length mismatch gapopen" \
-                 + " qstart qend qlen sstart send slen evalue bitscore\"" \
-                 + " -query " + input \
-                 + " -out " + output \
-                 + " -num_threads " + str("%d" % options().cpu)
+    query = reads.path if reads.is_plain_fasta() else "-"
+    cmd = blastn_command(blastn, refpkg["blast"]["database"], query, output,
+                         threads or options().cpu)
 
-    print(cmd)
-    os.system(cmd)
+    print(" ".join(cmd))
+    if query != "-":
+        subprocess.call(cmd)
+        return
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        reads.write_fasta(proc.stdin)
+    finally:
+        proc.stdin.close()
+        proc.wait()
 
 
 def reverse_sequence(sequence):
-    global character_map
-
-    #  Reverse complement the sequence
-    return "".join([character_map.get(a, a) for a in sequence[::-1]])
+    return reverse_complement(sequence)
 
 
 def augment_parser():
@@ -949,12 +978,14 @@ def augment_parser():
              "This should be a number between 0 and 1 [default: 0.0]")
 
     tippGroup.add_argument(
-        "-pt", "--placementThreshold", type=float,
+        "-pt", "--placementThreshold", type=str,
         dest="placement_threshold", metavar="N",
-        default=0.95,
+        default="0.95",
         help="Enough placements are selected to reach a commulative "
              "probability of N."
-             "This should be a number between 0 and 1 [default: 0.95]")
+             "This should be a number between 0 and 1, or a comma separated"
+             " list of them to profile at each (written to threshold_N/)"
+             " [default: 0.95]")
 
     tippGroup.add_argument(
         "-g", "--gene", type=str,
@@ -974,12 +1005,105 @@ def augment_parser():
         default=False,
         help="Trim query sequence if it extends outside marker (BLAST only). ")
 
+    tippGroup.add_argument(
+        "-sb", "--streamBinning",
+        dest="stream_binning", action='store_true',
+        default=False,
+        help="Pipe the reads into blastn and bin them while BLAST is still "
+             "running, instead of going through a BLAST output file "
+             "(BLAST only). ")
+
+    tippGroup.add_argument(
+        "-bs", "--blastShards", type=int,
+        dest="blast_shards", metavar="N",
+        default=1,
+        help="Split the reads between N concurrent blastn processes "
+             "(BLAST only) [default: 1]")
+
+    tippGroup.add_argument(
+        "-bth", "--blastThreads", type=int,
+        dest="blast_threads", metavar="N",
+        default=None,
+        help="Threads for each blastn process; the shards never use more "
+             "than --cpu threads in total [default: cpu / shards]")
+
+    tippGroup.add_argument(
+        "-bp", "--binPartitions", type=int,
+        dest="bin_partitions", metavar="N",
+        default=0,
+        help="Bin with bounded memory by splitting the BLAST hits and the "
+             "reads into N partitions on disk; 0 bins in memory (BLAST "
+             "only) [default: 0]")
+
     tippGroup.add_argument(
         "-bin", "--bin_using", type=str,
         dest="bin", metavar="N",
         default="blast",
         help="Use blast or hmmer for binning [default: blast]")
 
+    tippGroup.add_argument(
+        "-dr", "--dereplicate",
+        dest="dereplicate", action='store_true',
+        default=False,
+        help="Bin and place identical reads (or reverse complements) once, "
+             "and weight them by their number of copies in the abundance "
+             "profile. ")
+
+    tippGroup.add_argument(
+        "-bc", "--binCache", type=str,
+        dest="bin_cache", metavar="DIR",
+        default=None,
+        help="Directory of a binning cache, to reuse the binning of earlier"
+             " runs on the same input and settings [default: no cache]")
+
+    tippGroup.add_argument(
+        "-bcs", "--binCacheSize", type=float,
+        dest="bin_cache_size", metavar="GB",
+        default=100,
+        help="Size of the binning cache in GB, least recently used results"
+             " are evicted beyond it; 0 disables the cache [default: 100]")
+
+    tippGroup.add_argument(
+        "-ip", "--inProcess",
+        dest="in_process", action='store_true',
+        default=False,
+        help="Run TIPP on each marker inside this process, instead of"
+             " starting run_tipp.py for every marker. ")
+
+    tippGroup.add_argument(
+        "-cb", "--classificationBackend", type=str,
+        dest="classification_backend", metavar="BACKEND",
+        choices=["java", "python"], default="java",
+        help="Classify the placements of every marker with the json merger"
+             " (java) or in the TIPP process (python); with --inProcess, the"
+             " python classifications are profiled without reading them"
+             " back [default: java]")
+
+    tippGroup.add_argument(
+        "-nr", "--noResume",
+        dest="no_resume", action='store_true',
+        default=False,
+        help="Start over instead of resuming the run recorded in the"
+             " manifest of the output directory. ")
+
+    tippGroup.add_argument(
+        "-sm", "--samples", type=str,
+        dest="samples", metavar="FILE",
+        default=None,
+        help="Profile a batch of samples listed in FILE, one sample<TAB>reads"
+             " per line, instead of the fragment file. Samples are binned"
+             " and placed together, and get their profiles in"
+             " <outdir>/<sample>, next to sample x taxon abundance"
+             " matrices. ")
+
+    tippGroup.add_argument(
+        "-co", "--columnar",
+        dest="columnar", action='store_true',
+        default=False,
+        help="Also write the classification and abundance profiles in a"
+             " binary columnar format, in .columns directories next to"
+             " them. ")
+
     tippGroup.add_argument(
         "-D", "--dist",
         dest="dist", action='store_true',
@@ -1006,12 +1130,17 @@ def main():
 
     # sepp.config._options_singelton = sepp.config._parse_options()
 
-    input = options().fragment_file.name
-
     output_directory = options().outdir
 
     load_reference_package()
 
+    if options().samples is not None:
+        build_batch_profile(read_samples(options().samples),
+                            output_directory)
+        return
+
+    input = options().fragment_file.name
+
     build_profile(input, output_directory)
 
 
@@ -0,0 +1,425 @@
+import hashlib
+import json
+import re
+from collections import deque
+import numpy as np
+from tipp.assignment import SCALE
+from tipp.classification import ClassificationTable
+from tipp.refpkg import taxonomy_index
+from tipp.taxonomy import Taxonomy
+'''
+Classification of placements in this process, as an alternative to the json
+merger (tippJsonMerger.jar): the placements of the pplacer outputs of every
+placement subset are relabeled to the edges of the main tree, and every
+fragment is classified from a table of the taxonomic lineage of every edge,
+computed once per tree.
+
+The trees are read as the merger reads them, and fragments are classified
+as it does, pushed down or up from their placement edges.
+
+Created on Oct 17, 2026
+'''
+
+# Tokens of a newick tree: (, ) with its label, ; and leaves
+_TOKEN = re.compile(r"([(])|([)][^,;)]*)|([;])|([^,);(]*)")
+_EDGE = re.compile(r".*[\[{]([0-9]*)[\]}]")
+_NAME = re.compile(r"'*([^:']*)'*(?::.*)*")
+_EDGE_LENGTH = re.compile(r":([^\[]*)\[([^\]]*)\]")
+
+# Fields of a pplacer placement record the merger reads by position
+LWR = 2
+DISTAL_LENGTH = 3
+
+
+def _edge(token):
+    match = _EDGE.match(token)
+    return match.group(1) if match else "?"
+
+
+def walk_tree(tree):
+    '''
+    The events of a newick tree, as ("open", None, None) for the nodes
+    opened, ("leaf", name, edge) for the leaves and ("close", None, edge)
+    for the nodes closed, where edge is the label of the edge above. The
+    root is neither opened nor closed.
+    '''
+    tokens = (match.group() for match in _TOKEN.finditer(tree))
+    tokens = (token for token in tokens if token)
+    if next(tokens, None) != "(":
+        raise ValueError("The tree does not start with a (")
+    depth = 0
+    for token in tokens:
+        if token == "(":
+            depth += 1
+            yield ("open", None, None)
+        elif token.startswith(")"):
+            if depth > 0:
+                depth -= 1
+                yield ("close", None, _edge(token))
+        elif token != ";":
+            yield ("leaf", _NAME.sub(r"\1", token), _edge(token))
+
+
+def tree_clusters(tree):
+    '''The label of the edge above every cluster of leaves of a tree, as a
+    dict of frozenset of leaf names -> edge label'''
+    clusters = {}
+    stack = []
+    for (event, name, edge) in walk_tree(tree):
+        if event == "open":
+            stack.append(set())
+        elif event == "leaf":
+            if stack:
+                stack[-1].add(name)
+            clusters[frozenset([name])] = edge
+        else:
+            cluster = stack.pop()
+            clusters[frozenset(cluster)] = edge
+            if stack:
+                stack[-1].update(cluster)
+    return clusters
+
+
+def relabeling(placement_tree, subset_tree):
+    '''Edges of the tree of a pplacer output -> the labels of the same
+    edges in the labeled subset tree, None for edges not in it'''
+    labels = tree_clusters(subset_tree)
+    return dict((edge, labels.get(cluster)) for (cluster, edge) in
+                tree_clusters(placement_tree).items())
+
+
+def read_mapping(mapping_file):
+    '''Sequence name -> tax id of a taxonomy name mapping file'''
+    with open(mapping_file) as f:
+        f.readline()
+        return dict(line.rstrip('\r\n').split(',')[:2] for line in f
+                    if ',' in line)
+
+
+class EdgeLineages(object):
+    '''
+    The taxonomic lineage of every edge of a labeled tree: rows maps edge
+    labels to rows of lineages, a matrix of the taxa (indices into the
+    taxonomy) from the taxon of the edge up to the root, padded with -1.
+    Edges without a taxon have no row. lengths maps edge labels to edge
+    lengths.
+    '''
+    def __init__(self, rows, lineages, lengths):
+        self.rows = rows
+        self.lineages = lineages
+        self.lengths = lengths
+
+    def row(self, edge):
+        return self.rows.get(str(edge), -1)
+
+    @classmethod
+    def build(cls, tree, taxonomy, mapping, push_down=True):
+        '''
+        From a tree, a Taxonomy and a mapping of leaf names to tax ids.
+        Pushed down, an edge gets the lowest common ancestor of the taxa
+        of the leaves below it. Pushed up, as the merger does, edges wait
+        in a queue, leaves at its front and nodes at its back; every node
+        closed gives its taxon to all the edges waiting and takes the one at
+        the front out.
+        '''
+        tree = tree.replace("'", "")
+        parent = np.asarray(taxonomy.parent)
+
+        def ancestors(taxon):
+            # The root may be its own parent
+            path = []
+            while taxon != -1 and (not path or taxon != path[-1]):
+                path.append(taxon)
+                taxon = int(parent[taxon])
+            return path
+
+        def lca(taxa):
+            taxa = [taxon for taxon in taxa if taxon != -1]
+            if not taxa:
+                return -1
+            common = ancestors(taxa[0])
+            for taxon in taxa[1:]:
+                above = set(ancestors(taxon))
+                common = [t for t in common if t in above]
+                if not common:
+                    return -1
+            return common[0]
+
+        tax_ids = dict((name, int(taxon)) for (name, taxon) in zip(
+            mapping.keys(), taxonomy.index(np.array(
+                [t.encode() for t in mapping.values()] or [b''],
+                dtype='S'))))
+        edge_taxa = {}
+        stack = []
+        waiting = deque()
+        (closed, entered, last) = (0, {}, -1)
+        for (event, name, edge) in walk_tree(tree):
+            if event == "open":
+                stack.append([])
+                continue
+            if event == "leaf":
+                taxon = tax_ids.get(name, -1)
+            else:
+                taxon = lca(stack.pop())
+            if stack:
+                stack[-1].append(taxon)
+            if push_down:
+                edge_taxa[edge] = taxon
+            elif event == "leaf":
+                waiting.appendleft(edge)
+                entered[edge] = closed
+            else:
+                # The edges waiting all take this taxon, their last one
+                # unless they wait for another node
+                closed += 1
+                last = taxon
+                edge_taxa[waiting.popleft()] = taxon
+                waiting.append(edge)
+                entered[edge] = closed
+        for edge in waiting:
+            if entered[edge] < closed:
+                edge_taxa[edge] = last
+
+        edges = [edge for (edge, taxon) in edge_taxa.items() if taxon != -1]
+        paths = [ancestors(edge_taxa[edge]) for edge in edges]
+        lineages = np.full((len(paths), max([len(p) for p in paths] + [1])),
+                           -1, dtype=np.int32)
+        for (i, path) in enumerate(paths):
+            lineages[i, :len(path)] = path
+        lengths = dict((label, float(length)) for (length, label) in
+                       _EDGE_LENGTH.findall(tree))
+        return cls(dict((edge, i) for (i, edge) in enumerate(edges)),
+                   lineages, lengths)
+
+
+_TAXONOMIES = {}
+_EDGE_LINEAGES = {}
+
+
+def edge_lineages(tree, taxonomy_file, mapping_file, push_down=True):
+    '''The Taxonomy in taxonomy_file, from the compiled index of its
+    reference package when it has one, and the EdgeLineages of a tree, each
+    loaded once per process'''
+    if taxonomy_file not in _TAXONOMIES:
+        index = taxonomy_index(taxonomy_file)
+        _TAXONOMIES[taxonomy_file] = index.taxonomy if index is not None \
+            else Taxonomy.from_csv(taxonomy_file)
+    taxonomy = _TAXONOMIES[taxonomy_file]
+    key = (hashlib.sha1(tree.encode()).hexdigest(), taxonomy_file,
+           mapping_file, push_down)
+    if key not in _EDGE_LINEAGES:
+        _EDGE_LINEAGES[key] = EdgeLineages.build(
+            tree, taxonomy, read_mapping(mapping_file), push_down)
+    return taxonomy, _EDGE_LINEAGES[key]
+
+
+class Placements(object):
+    '''
+    The placements of fragments on the edges of the main tree, from the
+    pplacer outputs of the placement subsets: fragment (index into names),
+    row (of the edge in an EdgeLineages, -1 for edges without a taxon) and
+    lwr, the like weight ratio times the weight of the assignment of the
+    fragment copy placed. records are the placement records relabeled,
+    and fields the fields of the records.
+    '''
+    def __init__(self, names):
+        self.names = names
+        self.fragment = []
+        self.row = []
+        self.lwr = []
+        self.records = []
+        self.fields = None
+
+    @classmethod
+    def read(cls, subsets, assignment, lineages):
+        '''
+        From subsets, pairs of a labeled subset tree and the pplacer outputs
+        placing on it, where fragment copies are found in assignment, a
+        FragmentAssignment
+        '''
+        placements = cls(assignment.names)
+        for (subset_tree, outputs) in subsets:
+            labels = {}
+            for output in outputs:
+                with open(output) as f:
+                    data = json.load(f)
+                if data["tree"] not in labels:
+                    labels[data["tree"]] = relabeling(data["tree"],
+                                                      subset_tree)
+                placements.add(data, labels[data["tree"]], assignment,
+                               lineages)
+        placements.fragment = np.array(placements.fragment, dtype=np.int64)
+        placements.row = np.array(placements.row, dtype=np.int64)
+        placements.lwr = np.array(placements.lwr, dtype=np.float64)
+        return placements
+
+    def add(self, data, labels, assignment, lineages):
+        fields = data["fields"]
+        edge_field = fields.index("edge_num")
+        self.fields = fields
+        copies = []
+        for placement in data["placements"]:
+            names = placement["n"] if "n" in placement else \
+                [nm[0] for nm in placement["nm"]]
+            copies.extend((name, placement["p"]) for name in names)
+        rows = assignment.resolve([name for (name, _) in copies])
+        if np.any(rows == -1):
+            raise KeyError(copies[int(np.argmax(rows == -1))][0])
+        priors = np.asarray(assignment.postfixes(rows)) / float(SCALE)
+        fragments = assignment.fragment[rows].tolist()
+        for ((_, records), fragment, prior) in zip(copies, fragments,
+                                                   priors.tolist()):
+            for record in records:
+                label = labels.get(str(record[edge_field]))
+                if label is None:
+                    raise ValueError("Edge %s is not in the subset tree" %
+                                     record[edge_field])
+                record = list(record)
+                record[edge_field] = int(label)
+                if record[DISTAL_LENGTH] > lineages.lengths[label]:
+                    record[DISTAL_LENGTH] = lineages.lengths[label] * 0.99
+                record[LWR] = prior * record[LWR]
+                self.fragment.append(fragment)
+                self.row.append(lineages.row(label))
+                self.lwr.append(record[LWR])
+                self.records.append(record)
+
+
+def classify_placements(placements, lineages, threshold, distribution=False,
+                        cutoff=0):
+    '''
+    Classifies the fragments of Placements as the merger does. The like
+    weight ratios of a fragment are normalized to add up to one, and each
+    adds to the taxa of the lineage of its edge. Lines are kept for the
+    taxa with a probability of at least threshold. With distribution, the
+    placements of a fragment are first taken by decreasing like weight
+    ratio (ties last placement first) while they add up to less than
+    threshold and exceed cutoff, the lines are kept for all the taxa.
+
+    Returns the lines as arrays (fragment, taxon, probability), by
+    fragment and taxon, and the placements kept with their normalized
+    probabilities, as arrays (index into the placements, probability) in
+    the order the merger writes them.
+    '''
+    (fragment, lwr) = (placements.fragment, placements.lwr)
+    n = len(placements.names)
+    total = np.bincount(fragment, lwr, minlength=n)
+    kept = np.arange(len(lwr))
+    if distribution and len(lwr):
+        kept = np.lexsort((-kept, -lwr, fragment))
+        (sorted_fragment, sorted_lwr) = (fragment[kept], lwr[kept])
+        start = np.ones(len(kept), dtype=bool)
+        start[1:] = sorted_fragment[1:] != sorted_fragment[:-1]
+        segment = np.cumsum(start) - 1
+        cumulative = np.cumsum(sorted_lwr)
+        before = cumulative - sorted_lwr - np.append(
+            0, cumulative[np.nonzero(start)[0][1:] - 1])[segment]
+        kept = kept[(before < threshold) & (sorted_lwr > cutoff)]
+        total = total * np.bincount(fragment[kept], lwr[kept], minlength=n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probability = lwr[kept] / total[fragment[kept]]
+
+    # Every placement adds its probability to the taxa of its lineage, in
+    # the order of the placements
+    rows = placements.row[kept]
+    mapped = np.nonzero(rows != -1)[0]
+    taxa = lineages.lineages[rows[mapped]]
+    line_fragment = np.repeat(fragment[kept][mapped], taxa.shape[1])
+    line_probability = np.repeat(probability[mapped], taxa.shape[1])
+    line_taxon = taxa.ravel().astype(np.int64)
+    present = line_taxon != -1
+    scale = max(1, int(lineages.lineages.max(initial=-1)) + 1)
+    (keys, inverse) = np.unique(
+        line_fragment[present] * scale + line_taxon[present],
+        return_inverse=True)
+    sums = np.bincount(inverse, line_probability[present],
+                       minlength=len(keys))
+    lines = (keys // scale, keys % scale, sums)
+    if not distribution:
+        keep = sums >= threshold
+        lines = tuple(array[keep] for array in lines)
+    return lines, (kept, probability)
+
+
+def format_probability(probability):
+    '''A probability as the merger writes it, 0.5 as .5000'''
+    text = "%.4f" % probability
+    return text[1:] if text.startswith("0") else text
+
+
+class PlacementClassifier(object):
+    '''
+    Classifies the placements of a run of TIPP in this process: reads them
+    with Placements.read, writes the merged placements and classification
+    the merger would, and returns the classification as a
+    ClassificationTable.
+    '''
+    def __init__(self, main_tree, taxonomy_file, mapping_file,
+                 push_down=True, threshold=0.95, distribution=False,
+                 cutoff=0):
+        self.main_tree = main_tree.replace("'", "")
+        (self.taxonomy, self.lineages) = edge_lineages(
+            main_tree, taxonomy_file, mapping_file, push_down)
+        self.threshold = threshold
+        self.distribution = distribution
+        self.cutoff = cutoff
+
+    def classify(self, subsets, assignment, placement_file=None,
+                 classification_file=None):
+        placements = Placements.read(subsets, assignment, self.lineages)
+        ((fragment, taxon, probability), kept) = classify_placements(
+            placements, self.lineages, self.threshold, self.distribution,
+            self.cutoff)
+        texts = [format_probability(p) for p in probability.tolist()]
+
+        # Fragments by name, and the lines of each by taxon
+        names = np.asarray(placements.names)
+        present = np.unique(fragment)
+        by_name = np.argsort(names[present], kind='stable')
+        position = np.empty(len(names), dtype=np.int64)
+        position[present[by_name]] = np.arange(len(present))
+        order = np.lexsort((taxon, position[fragment]))
+        table = ClassificationTable.from_lines(
+            names[present[by_name]], position[fragment][order],
+            taxon[order], np.array(texts, dtype=np.float64)[order]
+            if texts else np.zeros(0), self.taxonomy)
+
+        if classification_file is not None:
+            self.write_classification(classification_file, table,
+                                      [texts[i] for i in order.tolist()])
+        if placement_file is not None:
+            self.write_placements(placement_file, placements, *kept)
+        return table
+
+    def write_classification(self, classification_file, table, texts):
+        ids = self.taxonomy.tax_ids(table.taxon)
+        ranks = self.taxonomy.ranks
+        with open(classification_file, 'w') as f:
+            for (fragment, taxon, tax_id, text) in zip(
+                    table.fragment.tolist(), table.taxon.tolist(), ids,
+                    texts):
+                f.write("%s,%s,%s,%s,%s\n" % (
+                    table.names[fragment], tax_id, self.taxonomy.name(taxon),
+                    ranks[self.taxonomy.rank[taxon]], text))
+
+    def write_placements(self, placement_file, placements, kept,
+                         probability):
+        fragments = placements.fragment.tolist()
+        merged = {}
+        for (i, p) in zip(kept.tolist(), probability.tolist()):
+            record = list(placements.records[i])
+            record[LWR] = p
+            merged.setdefault(fragments[i], []).append(record)
+        with open(placement_file, 'w') as f:
+            json.dump({
+                "tree": self.main_tree,
+                "placements": [
+                    {"p": merged.get(fragment, []),
+                     "n": [placements.names[fragment]]}
+                    for fragment in sorted(
+                        set(fragments),
+                        key=lambda fragment: placements.names[fragment])],
+                "metadata": {"invocation":
+                             "SEPP-generated json file (sepp 2)."},
+                "version": 1,
+                "fields": placements.fields}, f, indent=1)
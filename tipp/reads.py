@@ -0,0 +1,331 @@
+import gzip
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+'''
+Streaming decoders for the read files given to the metagenomic pipeline.
+
+Reads are decoded straight from the (possibly compressed) input into
+(header, sequence) records, so that the binners never need a decompressed
+copy of the input on disk. Parsing works on large byte blocks rather than
+on individual lines, and gzip/BGZF input can be decompressed on several
+threads.
+'''
+
+BLOCK_SIZE = 1 << 22
+BGZF_BATCH = 64
+
+FASTA = "fasta"
+FASTQ = "fastq"
+
+PLAIN = "plain"
+GZIP = "gzip"
+BGZF = "bgzf"
+
+
+def sniff(path):
+    '''Returns (format, compression) of a read file'''
+    with open(path, 'rb') as fp:
+        magic = fp.read(18)
+    if magic[:2] == b'\x1f\x8b':
+        compression = GZIP
+        # BGZF is a gzip file whose extra field carries a 'BC' subfield
+        if len(magic) >= 18 and magic[3] & 4 and magic[12:14] == b'BC':
+            compression = BGZF
+        with gzip.open(path, 'rb') as fp:
+            first = fp.read(1)
+    else:
+        compression = PLAIN
+        first = magic[:1]
+
+    if first == b'>':
+        return FASTA, compression
+    elif first == b'@':
+        return FASTQ, compression
+    raise ValueError("%s is neither a FASTA nor a FASTQ file" % path)
+
+
+def _read_plain(path, block_size):
+    with open(path, 'rb') as fp:
+        while True:
+            block = fp.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+def _read_gzip(path, block_size):
+    '''Decompresses a (possibly multi-member) gzip file with zlib'''
+    with open(path, 'rb') as fp:
+        decomp = zlib.decompressobj(31)
+        while True:
+            raw = fp.read(block_size)
+            if not raw:
+                break
+            while raw:
+                block = decomp.decompress(raw)
+                if block:
+                    yield block
+                if decomp.eof:
+                    # Concatenated gzip members: restart on the leftover data
+                    raw = decomp.unused_data
+                    decomp = zlib.decompressobj(31)
+                else:
+                    raw = b''
+        block = decomp.flush()
+        if block:
+            yield block
+
+
+def _read_pigz(path, threads, block_size):
+    '''Decompresses a gzip file with an external pigz process'''
+    proc = subprocess.Popen(
+        [shutil.which("pigz"), "-dc", "-p", str(threads), path],
+        stdout=subprocess.PIPE, bufsize=block_size)
+    try:
+        while True:
+            block = proc.stdout.read(block_size)
+            if not block:
+                break
+            yield block
+    finally:
+        proc.stdout.close()
+        status = proc.wait()
+    if status != 0:
+        raise IOError("pigz failed to decompress %s" % path)
+
+
+def decode_name(name):
+    '''A read name as str: UTF-8, as the rest of the pipeline reads names
+    back from text files, or else latin-1, so that no header fails to
+    decode'''
+    try:
+        return name.decode('utf-8')
+    except UnicodeDecodeError:
+        return name.decode('latin-1')
+
+
+def _bgzf_blocks(fp):
+    '''Splits a BGZF file into its blocks, raw deflate payloads followed by
+    the CRC32 and ISIZE of their data'''
+    while True:
+        header = fp.read(12)
+        if not header:
+            return
+        if len(header) < 12 or header[:2] != b'\x1f\x8b':
+            raise IOError("Truncated or corrupt BGZF block")
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = fp.read(xlen)
+        bsize = None
+        pos = 0
+        while pos + 4 <= xlen:
+            slen = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+            if extra[pos:pos + 2] == b'BC':
+                bsize = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+            pos += 4 + slen
+        if bsize is None:
+            raise IOError("BGZF block without a BC subfield")
+        # bsize is the total block size minus one
+        payload = fp.read(bsize + 1 - 12 - xlen)
+        if len(payload) != bsize + 1 - 12 - xlen:
+            raise IOError("Truncated or corrupt BGZF block")
+        yield payload
+
+
+def _inflate(block):
+    data = zlib.decompress(block[:-8], -15)
+    (crc, isize) = struct.unpack('<II', block[-8:])
+    if zlib.crc32(data) != crc or len(data) & 0xffffffff != isize:
+        raise IOError("BGZF block fails its CRC32/ISIZE check")
+    return data
+
+
+def _read_bgzf(path, threads):
+    '''Decompresses independent BGZF blocks on a pool of threads (zlib
+    releases the GIL while inflating), checking the CRC32 and size of
+    every block'''
+    with open(path, 'rb') as fp, ThreadPoolExecutor(threads) as pool:
+        batch = []
+        for payload in _bgzf_blocks(fp):
+            batch.append(payload)
+            if len(batch) == BGZF_BATCH * threads:
+                yield b''.join(pool.map(_inflate, batch))
+                batch = []
+        if batch:
+            yield b''.join(pool.map(_inflate, batch))
+
+
+def _header(line):
+    # The name is the first space-separated word after the '@'
+    return line.strip()[1:].split(b' ', 1)[0]
+
+
+def _parse_fasta(blocks):
+    carry = b''
+    for block in blocks:
+        data = carry + block
+        # Only records followed by the start of another one are complete
+        end = data.rfind(b'\n>')
+        if end == -1:
+            carry = data
+            continue
+        carry = data[end + 1:]
+        yield _fasta_records(data[:end])
+    if carry.strip():
+        yield _fasta_records(carry)
+
+
+def _fasta_records(data):
+    records = []
+    # Every block starts at a '>', which split() leaves on the first record
+    for chunk in data[1:].split(b'\n>'):
+        header, _, seq = chunk.partition(b'\n')
+        seq = seq.replace(b'\n', b'').replace(b'\r', b'').replace(b' ', b'')
+        # Sometimes FASTA sequences can be blank, these are skipped
+        if seq:
+            records.append((header.strip().split(b' ', 1)[0], seq))
+    return records
+
+
+def _parse_fastq(blocks):
+    carry = b''
+    for block in blocks:
+        lines = (carry + block).split(b'\n')
+        # Keep the incomplete last line and any incomplete record
+        keep = (len(lines) - 1) % 4 + 1
+        carry = b'\n'.join(lines[-keep:])
+        yield _fastq_records(lines[:-keep])
+    lines = carry.split(b'\n')
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if lines:
+        if len(lines) % 4 != 0:
+            lines = lines[:len(lines) - len(lines) % 4]
+        yield _fastq_records(lines)
+
+
+def _fastq_records(lines):
+    return [(_header(header), seq.strip())
+            for header, seq in zip(lines[0::4], lines[1::4])
+            if seq.strip() and _header(header)]
+
+
+class ReadStream(object):
+    '''
+    A re-iterable stream of the reads in a FASTA/FASTQ file, plain, gzip'ed
+    or BGZF-compressed. Iterating yields (header, sequence) string pairs;
+    batches() yields lists of (header, sequence) byte pairs, which is
+    what the binners use to avoid per-read decoding.
+    '''
+    def __init__(self, path, threads=1, block_size=BLOCK_SIZE):
+        self.path = path
+        self.threads = max(1, threads)
+        self.block_size = block_size
+        (self.format, self.compression) = sniff(path)
+
+    def is_plain_fasta(self):
+        return self.format == FASTA and self.compression == PLAIN
+
+    def blocks(self):
+        '''Decompressed content of the file in large blocks'''
+        if self.compression == BGZF and self.threads > 1:
+            return _read_bgzf(self.path, self.threads)
+        elif self.compression != PLAIN:
+            if self.threads > 1 and shutil.which("pigz") is not None:
+                return _read_pigz(self.path, self.threads, self.block_size)
+            return _read_gzip(self.path, self.block_size)
+        return _read_plain(self.path, self.block_size)
+
+    def batches(self):
+        parse = _parse_fasta if self.format == FASTA else _parse_fastq
+        for batch in parse(self.blocks()):
+            if batch:
+                yield batch
+
+    def __iter__(self):
+        for batch in self.batches():
+            for (header, seq) in batch:
+                yield decode_name(header), seq.decode('latin-1')
+
+    def write_fasta(self, fp):
+        '''Writes the reads as FASTA to a binary file object (e.g. the stdin
+        of a process), returns the number of reads written'''
+        count = 0
+        for batch in self.batches():
+            fp.write(b''.join(b'>%s\n%s\n' % record for record in batch))
+            count += len(batch)
+        return count
+
+    def __str__(self):
+        return "%s (%s, %s)" % (
+            os.path.basename(self.path), self.format, self.compression)
+
+
+class TaggedReads(ReadStream):
+    '''
+    The reads of several streams as one, in order, the name of every read
+    prefixed with the tag (bytes) of its stream, from (tag, stream) pairs.
+    Nothing is written to disk.
+    '''
+    def __init__(self, streams):
+        self.streams = streams
+
+    def is_plain_fasta(self):
+        return False
+
+    def batches(self):
+        for (tag, stream) in self.streams:
+            for batch in stream.batches():
+                yield [(tag + header, seq) for (header, seq) in batch]
+
+    def __str__(self):
+        return ", ".join("%s%s" % (tag.decode('latin-1'), stream)
+                         for (tag, stream) in self.streams)
+
+
+def open_reads(path, threads=1):
+    return ReadStream(path, threads)
+
+
+_COMPLEMENT = str.maketrans('ACGTacgt', 'TGCAtgca')
+_BYTES_COMPLEMENT = bytes.maketrans(b'ACGTacgt', b'TGCAtgca')
+
+
+def reverse_complement(sequence):
+    '''Reverse complement of a DNA sequence (str or bytes), other
+    characters are kept'''
+    if isinstance(sequence, bytes):
+        return sequence.translate(_BYTES_COMPLEMENT)[::-1]
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+def dereplicate(reads, output):
+    '''
+    Collapses identical reads, and reads identical to the reverse
+    complement of another one, into the first one seen. The unique reads
+    are written to output as FASTA. Returns the stream of unique reads and
+    a dict of representative name -> number of reads it stands for (only
+    for representatives of more than one read).
+    '''
+    seen = {}
+    counts = {}
+    with open(output, 'wb') as fp:
+        for batch in reads.batches():
+            unique = []
+            for (header, seq) in batch:
+                upper = seq.upper()
+                canonical = min(upper, reverse_complement(upper))
+                key = hashlib.blake2b(canonical, digest_size=16).digest()
+                representative = seen.get(key)
+                if representative is None:
+                    seen[key] = header
+                    unique.append(b'>%s\n%s\n' % (header, seq))
+                else:
+                    counts[representative] = counts.get(representative, 1) + 1
+            fp.write(b''.join(unique))
+    return ReadStream(output), dict(
+        (decode_name(name), count) for (name, count) in counts.items())
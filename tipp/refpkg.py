@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import shutil
+from tipp.taxonomy import Taxonomy
+'''
+Reference package of the abundance profiler, and its compiled index.
+
+A reference package is a directory (e.g. markers-v3) whose
+file-map-for-tipp.txt lists, for every marker, the files of its reference
+(gene:key=path). Compiling it writes an index under tipp-index/: the gene
+table with the marker sizes, and the taxonomy as memory-mappable integer
+arrays (see tipp.taxonomy). Runs then start without parsing any of the text
+files, and concurrent runs share the mapped arrays.
+
+Created on Oct 17, 2026
+'''
+
+MAP_FILE = "file-map-for-tipp.txt"
+INDEX = "tipp-index"
+INDEX_VERSION = 1
+
+
+def read_refpkg_map(path, map_file=MAP_FILE):
+    '''The reference package as refpkg[gene][key] = file, plus the list
+    of marker genes in refpkg["genes"]'''
+    refpkg = {}
+    refpkg["genes"] = []
+    with open(os.path.join(path, map_file)) as f:
+        for line in f.readlines():
+            [key, val] = line.split('=')
+
+            [key1, key2] = key.strip().split(':')
+            val = os.path.join(path, val.strip())
+
+            try:
+                refpkg[key1][key2] = val
+            except KeyError:
+                refpkg[key1] = {}
+                refpkg[key1][key2] = val
+
+            if (key1 != "blast") and (key1 != "taxonomy"):
+                refpkg["genes"].append(key1)
+
+    refpkg["genes"] = set(refpkg["genes"])
+    refpkg["genes"] = list(refpkg["genes"])
+    return refpkg
+
+
+def read_size(size_file):
+    with open(size_file, 'r') as f:
+        return int(f.readline().strip())
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+class RefpkgIndex(object):
+    '''A compiled reference package: refpkg as read_refpkg_map returns it,
+    sizes (gene -> number of taxa) and the taxonomy'''
+    def __init__(self, refpkg, sizes, taxonomy):
+        self.refpkg = refpkg
+        self.sizes = sizes
+        self.taxonomy = taxonomy
+
+
+def relative_refpkg(refpkg, path):
+    relative = {"genes": refpkg["genes"]}
+    for (key, files) in refpkg.items():
+        if key != "genes":
+            relative[key] = dict((k, os.path.relpath(v, path))
+                                 for (k, v) in files.items())
+    return relative
+
+
+def compile_refpkg(path, map_file=MAP_FILE):
+    '''Writes the index of the reference package in path'''
+    refpkg = read_refpkg_map(path, map_file)
+    index_dir = os.path.join(path, INDEX)
+    staging = index_dir + ".tmp-%d" % os.getpid()
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    Taxonomy.from_csv(refpkg["taxonomy"]["taxonomy"]).save(
+        os.path.join(staging, "taxonomy"))
+
+    sources = [os.path.join(path, map_file), refpkg["taxonomy"]["taxonomy"]]
+    sizes = {}
+    for gene in refpkg["genes"]:
+        sizes[gene] = read_size(refpkg[gene]["size"])
+        sources.append(refpkg[gene]["size"])
+    with open(os.path.join(staging, "index.json"), 'w') as f:
+        json.dump({"version": INDEX_VERSION,
+                   "map_file": map_file,
+                   "refpkg": relative_refpkg(refpkg, path),
+                   "sizes": sizes,
+                   "sources": dict((os.path.relpath(source, path),
+                                    _stamp(source)) for source in sources)},
+                  f, indent=1, sort_keys=True)
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    os.rename(staging, index_dir)
+    return index_dir
+
+
+def load_index(path, map_file=MAP_FILE):
+    '''
+    The compiled index of the reference package in path, or None if it has
+    not been compiled, or any of the files it was compiled from changed
+    since.
+    '''
+    index_file = os.path.join(path, INDEX, "index.json")
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file) as f:
+        index = json.load(f)
+    if index["version"] != INDEX_VERSION or index["map_file"] != map_file:
+        return None
+    for (source, stamp) in index["sources"].items():
+        source = os.path.join(path, source)
+        if not os.path.exists(source) or _stamp(source) != stamp:
+            return None
+    refpkg = {"genes": index["refpkg"]["genes"]}
+    for (key, files) in index["refpkg"].items():
+        if key != "genes":
+            refpkg[key] = dict((k, os.path.join(path, v))
+                               for (k, v) in files.items())
+    return RefpkgIndex(refpkg, index["sizes"],
+                       Taxonomy.load(os.path.join(path, INDEX, "taxonomy")))
+
+
+def taxonomy_index(taxonomy_file, map_file=MAP_FILE):
+    '''
+    The compiled index of the reference package whose taxonomy is
+    taxonomy_file, found in the directories above it, or None if there is
+    no valid one (see load_index).
+    '''
+    path = os.path.dirname(os.path.abspath(taxonomy_file))
+    while True:
+        if os.path.exists(os.path.join(path, INDEX, "index.json")):
+            index = load_index(path, map_file)
+            if index is not None and os.path.samefile(
+                    index.refpkg["taxonomy"]["taxonomy"], taxonomy_file):
+                return index
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compiles the index of a TIPP reference package, so that'
+                    ' runs load it without parsing its text files.')
+    parser.add_argument(
+        "reference",
+        help="reference package directory, e.g. $REFERENCE/markers-v3")
+    parser.add_argument(
+        "-m", "--map",
+        dest="map_file", metavar="FILE",
+        default=MAP_FILE,
+        help="file map of the package [default: %(default)s]")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print("Wrote %s" % compile_refpkg(args.reference, args.map_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+'''
+Scheduling of the per-marker TIPP runs of an abundance profile under one
+core budget.
+
+Created on Oct 17, 2026
+'''
+
+
+def allocate_cores(costs, limits, cpus):
+    '''
+    Cores for each job (dicts keyed by job), in proportion to its share of
+    the total cost, at least one and at most its limit and cpus.
+    '''
+    total = float(sum(costs.values())) or 1.0
+    cores = {}
+    for (key, cost) in costs.items():
+        share = int(round(cpus * cost / total))
+        cores[key] = max(1, min(share, limits[key], cpus))
+    return cores
+
+
+def longest_first(costs):
+    '''Jobs ordered by decreasing cost, ties in their given order'''
+    order = dict((key, i) for (i, key) in enumerate(costs))
+    return sorted(costs, key=lambda key: (-costs[key], order[key]))
+
+
+def run_scheduled(jobs, cores, cpus, run):
+    '''
+    Runs run(job, cores[job]) for the jobs, never using more than cpus
+    cores at once. Jobs start in the given order as cores free up, and a
+    later job that fits starts ahead of one that has to wait for cores.
+    Yields the jobs as they finish.
+    '''
+    pending = list(jobs)
+    running = {}
+    free = cpus
+    with ThreadPoolExecutor(max(1, len(pending))) as pool:
+        while pending or running:
+            for job in list(pending):
+                if cores[job] <= free or not running:
+                    pending.remove(job)
+                    free -= cores[job]
+                    running[pool.submit(run, job, cores[job])] = job
+            (done, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                free += cores[job]
+                future.result()
+                yield job
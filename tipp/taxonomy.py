@@ -0,0 +1,155 @@
+import json
+import os
+import numpy as np
+'''
+Integer coded taxonomy.
+
+Every taxon is an index into a set of arrays, in the order of the taxonomy
+file. The arrays can be saved to a directory and memory-mapped back, so
+that concurrent runs share one copy.
+
+Created on Oct 17, 2026
+'''
+
+LEVELS = ["species", "genus", "family", "order", "class", "phylum"]
+TAXONOMY_VERSION = 1
+
+
+class Taxonomy(object):
+    '''
+    ids          tax ids (bytes), in file order
+    parent       index of the parent taxon, -1 if not in the taxonomy
+    rank         index into ranks
+    lineage      index of the ancestor at each of levels, -1 if undefined
+    name_offsets, name_table
+                 the name of taxon i is
+                 name_table[name_offsets[i]:name_offsets[i + 1]] (UTF-8)
+    by_id, sorted_ids
+                 permutation sorting ids and the sorted ids, for lookups
+    '''
+    ARRAYS = ["ids", "parent", "rank", "lineage", "name_offsets",
+              "name_table", "by_id", "sorted_ids"]
+
+    def __init__(self, ids, parent, rank, lineage, name_offsets, name_table,
+                 by_id, sorted_ids, ranks, levels=LEVELS):
+        self.ids = ids
+        self.parent = parent
+        self.rank = rank
+        self.lineage = lineage
+        self.name_offsets = name_offsets
+        self.name_table = name_table
+        self.by_id = by_id
+        self.sorted_ids = sorted_ids
+        self.ranks = list(ranks)
+        self.levels = list(levels)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_csv(cls, taxonomy_file, levels=LEVELS):
+        '''
+        Reads a TIPP taxonomy, a comma separated file with a header line and
+        the fields tax_id, parent_id, rank, tax_name, followed by the tax id
+        of the ancestor at every rank.
+        '''
+        with open(taxonomy_file, 'r') as f:
+            header = f.readline().lower().replace('"', '').strip().split(',')
+            key_map = dict([(header[i], i) for i in range(0, len(header))])
+            rows = [line.replace('"', '').strip().split(',') for line in f]
+        rows = [row for row in rows if row != ['']]
+
+        def column(key):
+            return np.array([row[key_map[key]].encode() for row in rows],
+                            dtype='S')
+
+        ids = column("tax_id")
+        by_id = np.argsort(ids, kind='stable').astype(np.int64)
+        taxonomy = cls(ids, None, None, None, None, None, by_id, ids[by_id],
+                       [], levels)
+
+        taxonomy.parent = taxonomy.index(column("parent_id")).astype(
+            np.int32)
+        (ranks, rank) = np.unique(column("rank"), return_inverse=True)
+        taxonomy.ranks = [r.decode() for r in ranks.tolist()]
+        taxonomy.rank = rank.astype(np.int16)
+
+        lineage = np.empty((len(ids), len(levels)), dtype=np.int32)
+        for (i, level) in enumerate(levels):
+            ancestors = column(level)
+            lineage[:, i] = np.where(ancestors == b'', -1,
+                                     taxonomy.index(ancestors))
+        taxonomy.lineage = lineage
+
+        names = [row[key_map["tax_name"]].encode('utf-8') for row in rows]
+        lengths = np.array([len(name) for name in names], dtype=np.int64)
+        taxonomy.name_offsets = np.concatenate(
+            [[0], np.cumsum(lengths)]).astype(np.int64)
+        taxonomy.name_table = np.frombuffer(b''.join(names), dtype=np.uint8)
+        return taxonomy
+
+    def index(self, ids):
+        '''Indices of an array of tax ids (bytes or str), -1 for the ones
+        not in the taxonomy'''
+        ids = np.asarray(ids)
+        if ids.dtype.kind == 'U':
+            ids = np.char.encode(ids, 'ascii')
+        if len(self.ids) == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        position = np.searchsorted(self.sorted_ids, ids)
+        position = np.minimum(position, len(self.ids) - 1)
+        found = self.sorted_ids[position] == ids
+        return np.where(found, self.by_id[position], -1)
+
+    def lineages(self, taxa):
+        '''
+        Index of the ancestor at each level of an array of taxa (a matrix of
+        len(taxa) x len(levels)), -1 where the lineage is undefined at that
+        level or the taxon is -1.
+        '''
+        taxa = np.asarray(taxa, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(taxa.shape + (len(self.levels),), -1,
+                           dtype=np.int32)
+        lineages = np.asarray(self.lineage)[np.maximum(taxa, 0)]
+        lineages[taxa < 0] = -1
+        return lineages
+
+    def tax_ids(self, taxa, missing='NA'):
+        '''Tax ids (str) of an array of taxa of any shape, missing where the
+        taxon is -1'''
+        taxa = np.asarray(taxa, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(taxa.shape, missing).tolist()
+        ids = np.asarray(self.ids)[np.maximum(taxa, 0)]
+        return np.where(taxa < 0, missing.encode(),
+                        ids).astype(str).tolist()
+
+    def name(self, i):
+        return self.name_table[
+            self.name_offsets[i]:self.name_offsets[i + 1]].tobytes().decode(
+                'utf-8')
+
+    def save(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for array in self.ARRAYS:
+            np.save(os.path.join(directory, array + ".npy"),
+                    getattr(self, array))
+        with open(os.path.join(directory, "taxonomy.json"), 'w') as f:
+            json.dump({"version": TAXONOMY_VERSION, "ranks": self.ranks,
+                       "levels": self.levels}, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        '''Loads a saved taxonomy, memory-mapping its arrays'''
+        with open(os.path.join(directory, "taxonomy.json")) as f:
+            description = json.load(f)
+        if description["version"] != TAXONOMY_VERSION:
+            raise ValueError("%s was saved by another version of TIPP" %
+                             directory)
+        arrays = [np.load(os.path.join(directory, array + ".npy"),
+                          mmap_mode='r' if mmap else None)
+                  for array in cls.ARRAYS]
+        return cls(*arrays, ranks=description["ranks"],
+                   levels=description["levels"])